@@ -0,0 +1,346 @@
+import os
+import sys
+import glob
+import json
+import time
+import zlib
+import signal
+import argparse
+import traceback
+from multiprocessing import Pool
+
+import numpy as np
+
+from create_ua import parse_urdf_to_structure_json, sample_labeled_pointcloud
+from mesh_cache import MeshCache
+
+# PartNet-Mobility などの大量の URDF を、URDFReasoningDataset がそのまま読める
+#   <out_dir>/json/<id>.json, <out_dir>/points/<id>.txt,
+#   <out_dir>/train_test_txt/{json,point}_{split}_{task_mode}.txt
+# に並列変換する。完了したものは ledger.jsonl に 1 行ずつ追記するので、途中で止めても再実行で続きから処理できる。
+
+DEFAULT_QUESTION = (
+    "Segment every part of this object with [SEG] and describe its kinematic structure "
+    "(joint type, parent, child, origin, axis and limits)."
+)
+
+_CONFIG = None
+_MESH_CACHE = None
+
+
+class ItemTimeout(Exception):
+    pass
+
+
+def _on_alarm(signum, frame):
+    raise ItemTimeout()
+
+
+def _init_worker(config):
+    global _CONFIG, _MESH_CACHE
+    _CONFIG = config
+    _MESH_CACHE = MeshCache(cache_dir=config["mesh_cache_dir"])
+    signal.signal(signal.SIGALRM, _on_alarm)
+
+
+# =============================================================================
+# 入力列挙・split 決定
+# =============================================================================
+def item_id_for(urdf_path, input_root):
+    """
+    PartNet-Mobility は <id>/mobility.urdf なので、ファイル名だけだと衝突する。
+    入力ルートからの相対パスを id にする。
+    """
+    rel = os.path.relpath(os.path.splitext(urdf_path)[0], input_root)
+    return rel.replace(os.sep, "_")
+
+
+def stable_split(item_id, test_ratio):
+    # 再実行しても同じ split になるよう、乱数ではなく id のハッシュで決める
+    return "test" if zlib.crc32(item_id.encode("utf-8")) % 10000 < test_ratio * 10000 else "train"
+
+
+def list_items(args):
+    """
+    returns: list of dict(id, urdf, split, category)
+    --input がディレクトリなら **/*.urdf を、ファイルなら 1 行 1 件の manifest（"path [split [category]]"）を読む。
+    """
+    items = []
+    if os.path.isdir(args.input):
+        root = os.path.abspath(args.input)
+        for path in sorted(glob.glob(os.path.join(root, "**", "*.urdf"), recursive=True)):
+            items.append((path, None, None))
+    else:
+        root = os.path.dirname(os.path.abspath(args.input))
+        with open(args.input, "r", encoding="utf-8") as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith("#"):
+                    continue
+                path = fields[0] if os.path.isabs(fields[0]) else os.path.join(root, fields[0])
+                items.append((os.path.abspath(path), fields[1] if len(fields) > 1 else None,
+                              fields[2] if len(fields) > 2 else None))
+
+    out, seen = [], set()
+    for path, split, category in items:
+        item_id = item_id_for(path, root)
+        if item_id in seen:
+            continue
+        seen.add(item_id)
+        out.append({"id": item_id, "urdf": path, "split": split or stable_split(item_id, args.test_ratio),
+                    "category": category})
+    return out
+
+
+# =============================================================================
+# リンク → パーツカテゴリ
+# =============================================================================
+def load_semantics(urdf_path):
+    """
+    PartNet-Mobility の semantics.txt（"link_0 hinge door" 形式）があれば {link: (joint_type, semantic)}
+    """
+    path = os.path.join(os.path.dirname(urdf_path), "semantics.txt")
+    if not os.path.exists(path):
+        return {}
+    semantics = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 3:
+                semantics[fields[0]] = (fields[1], fields[2])
+    return semantics
+
+
+def load_object_category(urdf_path):
+    """PartNet-Mobility の meta.json（{"model_cat": "Microwave", ...}）があれば物体カテゴリを返す"""
+    path = os.path.join(os.path.dirname(urdf_path), "meta.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("model_cat")
+    except (OSError, json.JSONDecodeError, AttributeError):
+        return None
+
+
+def resolve_category(link_name, semantics, category_map, part_categories, default_category):
+    joint_type, semantic = semantics.get(link_name, (None, None))
+    candidates = [category_map.get(link_name), category_map.get(semantic), semantic]
+    if semantic is not None:
+        # hinge/slider を持つ部品は rotation_* / translation_* が用意されていることが多い
+        prefix = {"hinge": "rotation", "slider": "translation"}.get(joint_type)
+        if prefix is not None:
+            candidates.insert(2, f"{prefix}_{semantic}")
+    candidates.append(default_category)
+    for c in candidates:
+        if c in part_categories:
+            return c
+    raise ValueError(f"link {link_name} (semantic={semantic}) has no category in PART_CATEGORIES")
+
+
+# =============================================================================
+# 1 件の変換（ワーカープロセス内）
+# =============================================================================
+def _write_atomic(path, write):
+    tmp = path + ".tmp"
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def _dump_json(obj, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+
+
+def _write_lines(lines, path):
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(line + "\n" for line in lines)
+
+
+def convert_item(item):
+    cfg = _CONFIG
+    start = time.time()
+    signal.alarm(cfg["timeout"])
+    try:
+        structure = parse_urdf_to_structure_json(item["urdf"], None, seg_token=cfg["seg_token"])
+        cloud, link_name_to_id, mapping = sample_labeled_pointcloud(
+            item["urdf"], cfg["num_points"], cfg["min_points_per_link"], seed=zlib.crc32(item["id"].encode("utf-8")),
+            mesh_cache=_MESH_CACHE)
+
+        # ルートリンク（どの joint の child でもない）は "base" として SEG 対象から外す
+        children = {j["child"] for j in structure["joints"]}
+        roots = [ln for ln in structure["links"] if ln not in children]
+        if not roots:
+            raise ValueError("no root link")
+        root = roots[0]
+
+        semantics = load_semantics(item["urdf"])
+        links, point_cloud, column_of = {}, {}, {}
+        for ln in structure["links"]:
+            if ln == root:
+                links[ln] = "base"
+                point_cloud["base"] = ln
+                continue
+            category = resolve_category(ln, semantics, cfg["category_map"], cfg["part_categories"], cfg["default_category"])
+            links[ln] = f"{category}{cfg['seg_token']}"
+            point_cloud[ln] = category
+            column_of[link_name_to_id[ln]] = cfg["part_categories"].index(category)
+        structure["links"] = links
+
+        # 各点のリンク id → PART_CATEGORIES の one-hot 列（base と対象外リンクは全 0）
+        link_ids = cloud[:, 6].astype(np.int64)
+        lut = np.full(len(link_name_to_id), -1, dtype=np.int64)
+        for link_id, col in column_of.items():
+            lut[link_id] = col
+        cols = lut[link_ids]
+        onehot = np.zeros((len(cloud), len(cfg["part_categories"])), dtype=np.uint8)
+        hit = cols >= 0
+        onehot[np.nonzero(hit)[0], cols[hit]] = 1
+
+        # _load_point_data は先頭 2 列を読み飛ばす：点番号とリンク id を入れておく
+        table = np.hstack([np.arange(len(cloud))[:, None], link_ids[:, None], cloud[:, :6], onehot])
+        fmt = ["%d", "%d"] + ["%.6f"] * 6 + ["%d"] * onehot.shape[1]
+
+        sample = {
+            "question": cfg["question"],
+            "answer": json.dumps(structure, ensure_ascii=False),
+            "point_cloud": point_cloud,
+            "urdf": item["urdf"],
+            # 評価時の物体カテゴリ別集計用（manifest の 3 列目 > meta.json の model_cat）
+            "category": item.get("category") or load_object_category(item["urdf"]) or "unknown",
+        }
+        json_path = os.path.join(cfg["out_dir"], "json", f"{item['id']}.json")
+        point_path = os.path.join(cfg["out_dir"], "points", f"{item['id']}.txt")
+        _write_atomic(point_path, lambda p: np.savetxt(p, table, fmt=fmt))
+        _write_atomic(json_path, lambda p: _dump_json(sample, p))
+
+        return {
+            "status": "ok", "id": item["id"], "split": item["split"], "urdf": item["urdf"],
+            "json": json_path, "point": point_path,
+            "num_points": int(len(cloud)), "num_parts": len(column_of),
+            "unmapped_meshes": len(mapping["unmapped_nodes"]) + len(mapping["invalid_meshes"]) + len(mapping["missing_files"]),
+            "elapsed": round(time.time() - start, 3),
+        }
+    except ItemTimeout:
+        return {"status": "failed", "id": item["id"], "urdf": item["urdf"],
+                "error": f"timeout after {cfg['timeout']}s", "elapsed": round(time.time() - start, 3)}
+    except Exception as e:
+        return {"status": "failed", "id": item["id"], "urdf": item["urdf"], "error": repr(e),
+                "traceback": traceback.format_exc(), "elapsed": round(time.time() - start, 3)}
+    finally:
+        signal.alarm(0)
+
+
+# =============================================================================
+# ledger / index
+# =============================================================================
+def read_jsonl(path):
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # 強制終了で途中まで書かれた最終行
+                continue
+    return records
+
+
+def write_indices(out_dir, records, task_mode):
+    """ledger の全件から train_test_txt/{json,point}_{split}_{task_mode}.txt を作り直す"""
+    list_dir = os.path.join(out_dir, "train_test_txt")
+    os.makedirs(list_dir, exist_ok=True)
+    by_split = {}
+    for r in records:
+        if os.path.exists(r["json"]) and os.path.exists(r["point"]):
+            by_split.setdefault(r["split"], {})[r["id"]] = r
+    for split, rs in by_split.items():
+        ordered = [rs[k] for k in sorted(rs)]
+        for kind in ("json", "point"):
+            path = os.path.join(list_dir, f"{kind}_{split}_{task_mode}.txt")
+            _write_atomic(path, lambda p: _write_lines([r[kind] for r in ordered], p))
+    return {split: len(rs) for split, rs in by_split.items()}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="URDF -> URDFReasoningDataset samples (parallel, resumable)")
+    ap.add_argument("--input", required=True, help="directory searched for **/*.urdf, or a manifest with 'path [split [category]]' per line")
+    ap.add_argument("--out_dir", required=True, help="data_root for URDFReasoningDataset")
+    ap.add_argument("--task_mode", default="all_parameters")
+    ap.add_argument("--test_ratio", type=float, default=0.1, help="used when the manifest gives no split")
+    ap.add_argument("--num_points", type=int, default=16384, help="points per sample, distributed by surface area")
+    ap.add_argument("--min_points_per_link", type=int, default=64)
+    ap.add_argument("--question", default=DEFAULT_QUESTION)
+    ap.add_argument("--seg_token", default="[SEG]")
+    ap.add_argument("--category_map", default=None, help="json {link name or semantic: PART_CATEGORIES name}")
+    ap.add_argument("--default_category", default=None, help="category for links without semantics")
+    ap.add_argument("--mesh_cache_dir", default=None, help="on-disk mesh cache shared by the workers (default: <out_dir>/mesh_cache)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    ap.add_argument("--timeout", type=int, default=300, help="seconds per URDF")
+    ap.add_argument("--max_tasks_per_child", type=int, default=50, help="recycle workers to bound trimesh memory growth")
+    ap.add_argument("--skip_failed", action="store_true", help="do not retry items already in failures.jsonl")
+    ap.add_argument("--limit", type=int, default=None)
+    args = ap.parse_args()
+
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils.reason_seg_dataset import PART_CATEGORIES
+
+    out_dir = os.path.abspath(args.out_dir)
+    for sub in ("json", "points", "train_test_txt"):
+        os.makedirs(os.path.join(out_dir, sub), exist_ok=True)
+    ledger_path = os.path.join(out_dir, "ledger.jsonl")
+    failures_path = os.path.join(out_dir, "failures.jsonl")
+
+    items = list_items(args)
+    done = {r["id"] for r in read_jsonl(ledger_path)}
+    if args.skip_failed:
+        done |= {r["id"] for r in read_jsonl(failures_path)}
+    todo = [it for it in items if it["id"] not in done]
+    print(f"{len(items)} URDFs, {len(items) - len(todo)} already done, {len(todo)} to convert")
+    todo = todo[:args.limit]
+
+    category_map = {}
+    if args.category_map is not None:
+        with open(args.category_map, "r", encoding="utf-8") as f:
+            category_map = json.load(f)
+    config = {
+        "out_dir": out_dir,
+        "num_points": args.num_points,
+        "min_points_per_link": args.min_points_per_link,
+        "question": args.question,
+        "seg_token": args.seg_token,
+        "category_map": category_map,
+        "default_category": args.default_category,
+        "part_categories": list(PART_CATEGORIES),
+        "timeout": args.timeout,
+        "mesh_cache_dir": args.mesh_cache_dir or os.path.join(out_dir, "mesh_cache"),
+    }
+
+    num_ok = num_failed = 0
+    start = time.time()
+    # 結果の追記は親プロセスだけが行う（ledger が壊れない）
+    with open(ledger_path, "a", encoding="utf-8") as ledger, open(failures_path, "a", encoding="utf-8") as failures, \
+            Pool(args.workers, initializer=_init_worker, initargs=(config,), maxtasksperchild=args.max_tasks_per_child) as pool:
+        for i, result in enumerate(pool.imap_unordered(convert_item, todo, chunksize=1), 1):
+            if result["status"] == "ok":
+                num_ok += 1
+                ledger.write(json.dumps(result, ensure_ascii=False) + "\n")
+                ledger.flush()
+            else:
+                num_failed += 1
+                failures.write(json.dumps(result, ensure_ascii=False) + "\n")
+                failures.flush()
+                print(f"❌ {result['id']}: {result['error']}")
+            if i % 100 == 0 or i == len(todo):
+                rate = i / max(time.time() - start, 1e-6)
+                print(f"[{i}/{len(todo)}] ok={num_ok} failed={num_failed} ({rate:.2f} URDF/s)")
+
+    counts = write_indices(out_dir, read_jsonl(ledger_path), args.task_mode)
+    print(f"✅ ok={num_ok} failed={num_failed} (failures: {failures_path})")
+    print(f"   indices: {counts} -> {os.path.join(out_dir, 'train_test_txt')}")
+
+
+if __name__ == "__main__":
+    main()
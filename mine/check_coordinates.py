@@ -1,11 +1,137 @@
-import numpy as np
-import yourdfpy
-import trimesh
 import os
+import json
+import time
+import argparse
+import traceback
+from multiprocessing import Pool
+
+import numpy as np
+
+from mesh_cache import MeshCache, default_mesh_cache
+from create_ua import dump_link_meshes, triangle_areas
 #メッシュから作った点群データがパーツごとにバラバラに配置されているため
 #URDFの関節位置と照らし合わせて確認するスクリプト
+#
+# データセット全体の検査（--ledger_dir / --manifest）:
+#   点群のリンク重心は bincount 1 回でまとめて出し、順運動学（関節 0）で置いたリンク形状の面積重心と比べる。
+#   create_ua の点群は「全点の重心を原点、最大距離 1」に正規化されているので、期待値にも同じ正規化をかけてから比べる。
+#   ずれているサンプル（学習に回すと GPU 時間の無駄）を JSON レポートに書き出す。
+
+
+# =============================================================================
+# 1 サンプル分の計算
+# =============================================================================
+def link_centroids(points, labels, num_links):
+    """returns: (centroids (L, 3), counts (L,))  点の無いリンクの重心は nan"""
+    labels = np.asarray(labels, dtype=np.int64)
+    counts = np.bincount(labels, minlength=num_links)[:num_links]
+    # (ラベル, xyz) を 1 次元に潰して 1 回の bincount で合計
+    slots = (labels[:, None] * 3 + np.arange(3)).ravel()
+    sums = np.bincount(slots, weights=np.asarray(points, dtype=np.float64).ravel(), minlength=num_links * 3)
+    sums = sums[:num_links * 3].reshape(num_links, 3)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts[:, None], counts
+
+
+def expected_link_geometry(entry, link_names):
+    """
+    順運動学（関節 0）でワールドに置いた各リンク形状の面積重心と、全頂点。
+    returns: (centroids (L, 3) 形状の無いリンクは nan, areas (L,), vertices (V, 3))
+    """
+    link_id = {n: i for i, n in enumerate(link_names)}
+    link_meshes, _ = dump_link_meshes(entry.scene, entry.node_to_link, entry.unmapped_nodes)
+    num_links = len(link_names)
+    if not link_meshes:
+        return np.full((num_links, 3), np.nan), np.zeros(num_links), np.zeros((0, 3))
+
+    tri = np.concatenate([np.asarray(m.vertices)[np.asarray(m.faces)] for _, _, m in link_meshes])
+    face_link = np.concatenate([np.full(len(m.faces), link_id[ln]) for ln, _, m in link_meshes])
+    areas = triangle_areas(tri)
+    link_areas = np.bincount(face_link, weights=areas, minlength=num_links)
+    centers = tri.mean(axis=1) * areas[:, None]
+    slots = (face_link[:, None] * 3 + np.arange(3)).ravel()
+    sums = np.bincount(slots, weights=centers.ravel(), minlength=num_links * 3).reshape(num_links, 3)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centroids = sums / link_areas[:, None]
+    vertices = np.concatenate([np.asarray(m.vertices) for _, _, m in link_meshes])
+    return centroids, link_areas, vertices
+
+
+def check_sample(points, labels, entry, tolerance=0.05, min_points=1):
+    """
+    points/labels: 点群とリンク id（create_ua の link_name_to_id = robot.link_map の順）
+    returns: dict（"ok" が False ならどこかずれている）。距離は正規化後（単位球）の単位
+    """
+    link_names = list(entry.robot.link_map.keys())
+    num_links = len(link_names)
+    labels = np.asarray(labels, dtype=np.int64)
+    issues = []
+
+    unknown = int(((labels < 0) | (labels >= num_links)).sum())
+    if unknown:
+        issues.append(f"{unknown} points have link ids outside 0..{num_links - 1}")
+        keep = (labels >= 0) & (labels < num_links)
+        points, labels = points[keep], labels[keep]
 
-def diagnose_dataset(npy_path, urdf_path):
+    actual, counts = link_centroids(points, labels, num_links)
+    expected, link_areas, vertices = expected_link_geometry(entry, link_names)
+    origins = np.stack([entry.link_transforms[ln][:3, 3] for ln in link_names])
+    has_geometry = link_areas > 0
+
+    # 期待値を点群と同じ正規化に載せる（重心は実際の点数で重み付け = サンプル平均の期待値）
+    normalized = bool(len(points)) and float(np.max(np.linalg.norm(points, axis=1))) <= 1.0 + 1e-3
+    present = has_geometry & (counts > 0)
+    center = (counts[present, None] * expected[present]).sum(axis=0) / max(counts[present].sum(), 1)
+    radius = float(np.max(np.linalg.norm(vertices - center, axis=1))) if len(vertices) else 1.0
+    radius = radius if radius > 0 else 1.0
+    if normalized:
+        predicted = (expected - center) / radius
+        origins_n = (origins - center) / radius
+    else:
+        # 正規化前の点群（ワールド座標のまま）：誤差だけ物体サイズで割る
+        predicted, origins_n = expected, origins
+    errors = np.linalg.norm(actual - predicted, axis=1) / (1.0 if normalized else radius)
+
+    links = []
+    for i, ln in enumerate(link_names):
+        rec = {"link": ln, "points": int(counts[i]), "has_geometry": bool(has_geometry[i]),
+               "origin": np.round(origins_n[i], 4).tolist()}
+        if counts[i] > 0:
+            rec["centroid"] = np.round(actual[i], 4).tolist()
+        if has_geometry[i]:
+            rec["expected_centroid"] = np.round(predicted[i], 4).tolist()
+        if present[i]:
+            rec["error"] = round(float(errors[i]), 4)
+        links.append(rec)
+
+    misaligned = [ln for i, ln in enumerate(link_names) if present[i] and errors[i] > tolerance]
+    if misaligned:
+        issues.append(f"{len(misaligned)} links off by more than {tolerance}")
+    missing = [ln for i, ln in enumerate(link_names) if has_geometry[i] and counts[i] < min_points]
+    if missing:
+        issues.append(f"{len(missing)} links with geometry have < {min_points} points")
+    stray = [ln for i, ln in enumerate(link_names) if not has_geometry[i] and counts[i] > 0]
+    if stray:
+        issues.append(f"{len(stray)} links without geometry have points")
+
+    size = (points.max(axis=0) - points.min(axis=0)) if len(points) else np.zeros(3)
+    return {
+        "ok": not issues,
+        "issues": issues,
+        "normalized": normalized,
+        "max_error": round(float(errors[present].max()), 4) if present.any() else None,
+        "misaligned_links": misaligned,
+        "missing_links": missing,
+        "stray_links": stray,
+        "size": np.round(size, 4).tolist(),
+        "links": links,
+    }
+
+
+# =============================================================================
+# 1 ペア（表を表示）
+# =============================================================================
+def diagnose_dataset(npy_path, urdf_path, mesh_cache=None, tolerance=0.05):
     print(f"🔍 Diagnosing Point Cloud vs URDF Kinematics")
     print(f"   NPY:  {npy_path}")
     print(f"   URDF: {urdf_path}")
@@ -19,60 +145,175 @@ def diagnose_dataset(npy_path, urdf_path):
 
     points = data[:, :3] # XYZ
     labels = data[:, 6]  # Label ID
-    
-    # 2. ロボット(URDF)の読み込み
-    robot = yourdfpy.URDF.load(urdf_path)
-    robot.update_cfg(configuration={j: 0.0 for j in robot.joint_map})
-    root_link = robot.scene.graph.base_frame
-
-    # リンク名リスト取得
-    link_names = list(robot.link_map.keys())
-    
-    print("\n" + "="*60)
-    print(f"{'Link Name':<20} | {'Expected (URDF)':<20} | {'Actual (Point Cloud)':<20}")
-    print("-" * 60)
-
-    for i, link_name in enumerate(link_names):
-        # --- A. 点群の重心 (Actual) ---
-        # ラベルID i に対応する点を抽出
-        part_points = points[labels == i]
-        
-        if len(part_points) == 0:
-            actual_pos_str = "No Points"
-        else:
-            # 重心を計算
-            centroid = np.mean(part_points, axis=0)
-            # 正規化を戻すヒントを得るため、値のスケール感を見る
-            actual_pos_str = f"[{centroid[0]:.3f}, {centroid[1]:.3f}, {centroid[2]:.3f}]"
-
-        # --- B. URDFのリンク原点 (Expected) ---
-        try:
-            # ワールド座標系でのリンク位置を取得
-            matrix = robot.get_transform(link_name, root_link)
-            # matrixは4x4、平行移動成分は [0:3, 3]
-            urdf_pos = matrix[0:3, 3]
-            expected_pos_str = f"[{urdf_pos[0]:.3f}, {urdf_pos[1]:.3f}, {urdf_pos[2]:.3f}]"
-        except:
-            expected_pos_str = "Error"
-
-        print(f"{link_name:<20} | {expected_pos_str:<20} | {actual_pos_str:<20}")
-    print("="*60)
-    
+
+    # 2. ロボット(URDF)の読み込み（リンクのワールド変換はキャッシュ済みのものを使う）
+    entry = (mesh_cache or default_mesh_cache()).load_scene(urdf_path)
+    result = check_sample(points, labels, entry, tolerance=tolerance)
+
+    def fmt(v):
+        return "-" if v is None else f"[{v[0]:.3f}, {v[1]:.3f}, {v[2]:.3f}]"
+
+    print("\n" + "="*96)
+    print(f"{'Link Name':<20} | {'Origin (URDF)':<22} | {'Expected centroid':<22} | {'Actual (Point Cloud)':<22}| Err")
+    print("-" * 96)
+    for rec in result["links"]:
+        actual = fmt(rec.get("centroid")) if rec["points"] else "No Points"
+        err = f"{rec['error']:.3f}" if "error" in rec else "-"
+        print(f"{rec['link']:<20} | {fmt(rec['origin']):<22} | {fmt(rec.get('expected_centroid')):<22} | {actual:<22}| {err}")
+    print("="*96)
+
     # 全体のバウンディングボックスサイズを確認
-    bbox_min = np.min(points, axis=0)
-    bbox_max = np.max(points, axis=0)
-    size = bbox_max - bbox_min
+    size = result["size"]
     print(f"\n📏 Total Robot Size (XYZ): [{size[0]:.3f}, {size[1]:.3f}, {size[2]:.3f}]")
-    if np.max(size) > 10.0:
+    if result["normalized"]:
+        print("ℹ️  Point cloud is normalized to the unit sphere; expected values are normalized the same way.")
+    elif np.max(size) > 10.0:
         print("⚠️  WARNING: The size is HUGE (>10). Likely unit mismatch (mm vs m).")
     elif np.max(size) < 0.05:
         print("⚠️  WARNING: The size is TINY (<0.05). Check scale.")
     else:
         print("✅ Size seems reasonable for a robot (meters).")
 
+    if result["ok"]:
+        print(f"✅ All links within {tolerance} of their kinematic placement.")
+    else:
+        for issue in result["issues"]:
+            print(f"⚠️  {issue}")
+    return result
+
+
+# =============================================================================
+# データセット全体（並列）
+# =============================================================================
+_CONFIG = None
+_MESH_CACHE = None
+
+
+def _init_worker(config):
+    global _CONFIG, _MESH_CACHE
+    _CONFIG = config
+    _MESH_CACHE = MeshCache(cache_dir=config["mesh_cache_dir"])
+
+
+def load_points(path):
+    """
+    .npy: [x, y, z, r, g, b, link_id]（create_ua）
+    .txt: [点番号, link_id, x, y, z, r, g, b, one-hot...]（batch_create_ua）
+    """
+    if path.endswith(".npy"):
+        data = np.load(path)
+        return data[:, :3], data[:, 6]
+    data = np.loadtxt(path, usecols=(1, 2, 3, 4), ndmin=2)
+    return data[:, 1:4], data[:, 0]
+
+
+def check_item(item):
+    cfg = _CONFIG
+    start = time.time()
+    try:
+        points, labels = load_points(item["points"])
+        entry = _MESH_CACHE.load_scene(item["urdf"])
+        result = check_sample(points, labels, entry, tolerance=cfg["tolerance"], min_points=cfg["min_points"])
+        if not cfg["keep_links"] and result["ok"]:
+            del result["links"]
+        return {"id": item["id"], "points": item["points"], "urdf": item["urdf"], "status": "ok",
+                **result, "elapsed": round(time.time() - start, 3)}
+    except Exception as e:
+        return {"id": item["id"], "points": item["points"], "urdf": item["urdf"], "status": "error",
+                "error": repr(e), "traceback": traceback.format_exc(), "elapsed": round(time.time() - start, 3)}
+
+
+def list_items(args):
+    """returns: list of dict(id, points, urdf)"""
+    items = []
+    if args.ledger_dir is not None:
+        # batch_create_ua.py の出力
+        with open(os.path.join(args.ledger_dir, "ledger.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                items.append({"id": r["id"], "points": r["point"], "urdf": r["urdf"]})
+    if args.manifest is not None:
+        # 1 行 "points urdf"（相対パスは manifest の場所から）
+        root = os.path.dirname(os.path.abspath(args.manifest))
+        with open(args.manifest, "r", encoding="utf-8") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2 or fields[0].startswith("#"):
+                    continue
+                pts, urdf = (p if os.path.isabs(p) else os.path.join(root, p) for p in fields[:2])
+                items.append({"id": os.path.splitext(os.path.basename(pts))[0], "points": pts, "urdf": urdf})
+    # 同じ id が重複したら後勝ち、順序は id で固定
+    return sorted({it["id"]: it for it in items}.values(), key=lambda it: it["id"])
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Check labeled point clouds against URDF forward kinematics")
+    ap.add_argument("--npy", default=None, help="single labeled npy (prints the per-link table)")
+    ap.add_argument("--urdf", default=None, help="URDF for --npy")
+    ap.add_argument("--ledger_dir", default=None, help="batch_create_ua.py out_dir (reads ledger.jsonl)")
+    ap.add_argument("--manifest", default=None, help="text file with 'points urdf' per line (.npy or .txt points)")
+    ap.add_argument("--report", default="kinematics_report.json", help="summary + misaligned samples")
+    ap.add_argument("--records", default=None, help="optional JSONL with every sample's result")
+    ap.add_argument("--tolerance", type=float, default=0.05, help="max centroid error (unit-sphere units)")
+    ap.add_argument("--min_points", type=int, default=1, help="links with geometry need at least this many points")
+    ap.add_argument("--keep_links", action="store_true", help="keep per-link details for passing samples too")
+    ap.add_argument("--mesh_cache_dir", default=os.environ.get("UA_MESH_CACHE_DIR"))
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    args = ap.parse_args()
+
+    if args.npy is not None:
+        diagnose_dataset(args.npy, args.urdf, MeshCache(cache_dir=args.mesh_cache_dir), tolerance=args.tolerance)
+        return
+
+    items = list_items(args)
+    if not items:
+        print("❌ No samples (give --ledger_dir or --manifest).")
+        return
+    config = {"tolerance": args.tolerance, "min_points": args.min_points, "keep_links": args.keep_links,
+              "mesh_cache_dir": args.mesh_cache_dir}
+    print(f"🔍 Checking {len(items)} samples with {args.workers} workers")
+
+    results = []
+    start = time.time()
+    records = open(args.records, "w", encoding="utf-8") if args.records else None
+    try:
+        with Pool(args.workers, initializer=_init_worker, initargs=(config,)) as pool:
+            # 同じ URDF が同じワーカーに行きやすいよう chunksize を取る（シーンのメモリキャッシュが効く）
+            for i, result in enumerate(pool.imap(check_item, items, chunksize=8), 1):
+                results.append(result)
+                if records is not None:
+                    records.write(json.dumps(result, ensure_ascii=False) + "\n")
+                if i % 500 == 0 or i == len(items):
+                    rate = i / max(time.time() - start, 1e-6)
+                    print(f"[{i}/{len(items)}] ({rate:.1f} samples/s)")
+    finally:
+        if records is not None:
+            records.close()
+
+    bad = [r for r in results if r["status"] == "ok" and not r["ok"]]
+    errors = [r for r in results if r["status"] == "error"]
+    max_errors = [r["max_error"] for r in results if r["status"] == "ok" and r["max_error"] is not None]
+    report = {
+        "summary": {
+            "samples": len(results),
+            "passed": len(results) - len(bad) - len(errors),
+            "misaligned": len(bad),
+            "errors": len(errors),
+            "tolerance": args.tolerance,
+            "max_error_p50": float(np.percentile(max_errors, 50)) if max_errors else None,
+            "max_error_p99": float(np.percentile(max_errors, 99)) if max_errors else None,
+        },
+        "misaligned": bad,
+        "errors": [{k: r[k] for k in ("id", "points", "urdf", "error")} for r in errors],
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.report)), exist_ok=True)
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"✅ passed={report['summary']['passed']} misaligned={len(bad)} errors={len(errors)} -> {args.report}")
+
+
 if __name__ == "__main__":
-    # ここに「今回生成されたNPYファイル」と「元のURDF」を指定してください
-    INPUT_NPY = "./output/ur3/merge_fixed_joint_ur3_gripper_labeled.npy"
-    INPUT_URDF = "./1126_merge_robots/merge_fixed_joint_ur3_gripper.urdf"
-    
-    diagnose_dataset(INPUT_NPY, INPUT_URDF)
\ No newline at end of file
+    main()
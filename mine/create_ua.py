@@ -1,9 +1,13 @@
 import os
+import glob
 import json
+import argparse
+from multiprocessing import Pool
 import numpy as np
 import xml.etree.ElementTree as ET
-import yourdfpy
 import trimesh
+
+from mesh_cache import default_mesh_cache
 #点群がパーツごとにバラバラになる問題があったが、secene.dumpという、
 #trimeshが提供する「SceneGraph を評価して、各 geometry に正しい変換を適用した “ワールド座標系の Trimesh（の集合）” を返す」関数
 #を使うことで解決できた。
@@ -12,9 +16,31 @@ import trimesh
 # Part 1: 構造パラメータ(JSON)抽出（そのまま残す）
 # =============================================================================
 
+def iter_robot_elements(urdf_path, tags=("link", "joint")):
+    """
+    <robot> 直下の link / joint を文書順に 1 つずつ返す（ET.iterparse）。
+    返した要素は次に進むときに clear して root から外すので、大きな URDF でも木全体を持たない。
+    """
+    root = None
+    depth = 0
+    for event, elem in ET.iterparse(urdf_path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if elem.tag in tags:
+            yield elem
+        elem.clear()
+        root.remove(elem)
+
+
 def parse_urdf_to_structure_json(
     urdf_path: str,
-    output_json_path: str,
+    output_json_path: str | None,
     seg_token: str = "[SEG]",
     default_category: str = "generic_part",
     exclude_links=("map", "odom"),
@@ -25,9 +51,6 @@ def parse_urdf_to_structure_json(
     default_effort: float = 1.0,
     default_velocity: float = 1.0,
 ):
-    tree = ET.parse(urdf_path)
-    root = tree.getroot()
-
     label_links = None
     if label_map_path is not None:
         lm = json.load(open(label_map_path, "r", encoding="utf-8"))
@@ -45,15 +68,15 @@ def parse_urdf_to_structure_json(
             return link_name in label_links
         return True
 
-    # links
-    for link in root.findall("link"):
-        link_name = link.get("name")
-        if not allowed(link_name):
+    # links / joints を 1 回の iterparse で（読み終えた要素はすぐ捨てる）
+    for elem in iter_robot_elements(urdf_path):
+        if elem.tag == "link":
+            link_name = elem.get("name")
+            if allowed(link_name):
+                links_map[link_name] = f"{default_category}{seg_token}"
             continue
-        links_map[link_name] = f"{default_category}{seg_token}"
 
-    # joints
-    for joint in root.findall("joint"):
+        joint = elem
         jname = joint.get("name")
         jtype = joint.get("type")
 
@@ -155,128 +178,156 @@ def parse_urdf_to_structure_json(
 
         joints_data.append(joint_dict)
 
-    with open(output_json_path, "w", encoding="utf-8") as f:
-        json.dump({"joints": joints_data, "links": links_map}, f, indent=4, ensure_ascii=False)
+    structure = {"joints": joints_data, "links": links_map}
+    # output_json_path=None ならファイルに書かず dict を返すだけ（バッチ変換用）
+    if output_json_path is not None:
+        with open(output_json_path, "w", encoding="utf-8") as f:
+            json.dump(structure, f, indent=4, ensure_ascii=False)
+    return structure
 # =============================================================================
-# dump出力の型ゆれを吸収
+# node -> link 表でワールド化（scene.dump と同じ変換、所属リンクは表引き）
 # =============================================================================
-def _as_named_meshes(dumped):
-    """
-    returns: list of (name_or_none, trimesh.Trimesh)
-    """
-    if dumped is None:
-        return []
-    if isinstance(dumped, trimesh.Trimesh):
-        return [(None, dumped)]
-    if isinstance(dumped, dict):
-        out = []
-        for k, v in dumped.items():
-            out.extend([(k, m) for _, m in _as_named_meshes(v)])
-        return out
-    if isinstance(dumped, (list, tuple)):
-        out = []
-        for v in dumped:
-            out.extend(_as_named_meshes(v))
-        return out
-    return []
-
 def _finite_mesh(m: trimesh.Trimesh) -> bool:
     if m is None or not hasattr(m, "vertices") or len(m.vertices) == 0:
         return False
     return np.isfinite(np.asarray(m.vertices)).all()
 
+def dump_link_meshes(scene, node_to_link, unmapped_nodes=()):
+    """
+    scene.dump(concatenate=False) と同じく各 geometry ノードをワールド座標に変換するが、
+    ノード名を保ったまま node_to_link で所属リンクを引く（親たどり・順番合わせはしない）。
+    returns: (list of (link_name, node, world_mesh), report)
+    """
+    out = []
+    report = {"unmapped_nodes": list(unmapped_nodes), "invalid_meshes": [], "non_mesh_nodes": []}
+    for node in scene.graph.nodes_geometry:
+        link_name = node_to_link.get(node)
+        if link_name is None:
+            if node not in report["unmapped_nodes"]:
+                report["unmapped_nodes"].append(node)
+            continue
+        transform, geom_name = scene.graph[node]
+        geom = scene.geometry.get(geom_name)
+        if not isinstance(geom, trimesh.Trimesh):
+            # Path3D などの面を持たない geometry
+            report["non_mesh_nodes"].append(node)
+            continue
+        mesh_world = geom.copy()
+        mesh_world.apply_transform(transform)
+        if not _finite_mesh(mesh_world):
+            report["invalid_meshes"].append(node)
+            continue
+        out.append((link_name, node, mesh_world))
+    return out, report
+
 # =============================================================================
-# Part 2: ラベル付き点群（scene.dumpベース：バラけない）
+# 面積比例の一括サンプリング
 # =============================================================================
-def generate_labeled_pointcloud_from_scene_dump(
-    urdf_path,
-    output_dir,
-    samples_per_mesh=2048,
-):
-    robot = yourdfpy.URDF.load(urdf_path, load_meshes=True, load_collision_meshes=False)
-    robot.update_cfg(configuration={j: 0.0 for j in robot.joint_map})
+def allocate_point_budget(link_areas, num_points, min_points_per_link):
+    """
+    総点数 num_points を面積比で各リンクに配分する（面積 0 のリンクは 0 点）。
+    面積のあるリンクには最低 min_points_per_link 点を保証し、端数は最大剰余法で合計をちょうど num_points にする。
+    """
+    link_areas = np.asarray(link_areas, dtype=np.float64)
+    counts = np.zeros(len(link_areas), dtype=np.int64)
+    active = np.nonzero(link_areas > 0)[0]
+    if len(active) == 0 or num_points <= 0:
+        return counts
 
-    scene = robot.scene
-    link_names = list(robot.link_map.keys())
-    link_set = set(link_names)
-    link_name_to_id = {n: i for i, n in enumerate(link_names)}
+    min_pts = min(min_points_per_link, num_points // len(active))
+    counts[active] = min_pts
+    rest = num_points - min_pts * len(active)
 
-    # node -> owner_link（親たどり）
-    def guess_owner_link(node):
-        cur = node
-        for _ in range(80):
-            if cur in link_set:
-                return cur
-            p = scene.graph.transforms.parents.get(cur)
-            if p is None:
-                break
-            cur = p
-        return None
-
-    # node <-> geom_name 対応
-    node_to_geom = {}
-    geom_to_nodes = {}
-    for node in list(scene.graph.nodes):
-        try:
-            geom = scene.graph[node][1]
-        except Exception:
-            geom = None
-        if geom is None:
-            continue
-        node_to_geom[node] = geom
-        geom_to_nodes.setdefault(geom, []).append(node)
+    share = rest * link_areas[active] / link_areas[active].sum()
+    extra = np.floor(share).astype(np.int64)
+    remainder = rest - extra.sum()
+    if remainder > 0:
+        extra[np.argsort(-(share - extra), kind="stable")[:remainder]] += 1
+    counts[active] += extra
+    return counts
 
-    # 1) dumpで「ワールド化済み」メッシュ群を得る（これが正）
-    try:
-        dumped = scene.dump(concatenate=False)
-    except TypeError:
-        dumped = scene.dump()
 
-    named_meshes = _as_named_meshes(dumped)
-    named_meshes = [(k, m) for (k, m) in named_meshes if _finite_mesh(m)]
+def triangle_areas(tri):
+    return 0.5 * np.linalg.norm(np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0]), axis=1)
 
-    if len(named_meshes) == 0:
-        raise RuntimeError("scene.dump() returned no valid meshes. (unexpected)")
 
-    # 2) 各メッシュにラベルを割り当ててサンプル
-    all_points, all_colors, all_labels = [], [], []
+def sample_faces_by_link(tri, areas, face_link, counts, rng):
+    """
+    連結済みメッシュの三角形 tri (F x 3 x 3) と face -> link 配列から、リンク l に counts[l] 点を
+    面積比で一括サンプルする。returns: (points, labels)
+    """
+    # リンク順に並べて面積の累積和を取ると、リンク l の面は区間 [start_l, start_l + area_l) に並ぶ
+    order = np.argsort(face_link, kind="stable")
+    cum = np.cumsum(areas[order])
+    link_area = np.bincount(face_link, weights=areas, minlength=len(counts))
+    link_start = np.concatenate([[0.0], np.cumsum(link_area)[:-1]])
+
+    labels = np.repeat(np.arange(len(counts)), counts)
+    u = link_start[labels] + rng.random(len(labels)) * link_area[labels]
+    # cum と link_start は丸め誤差でずれるので、境界付近の u が隣のリンクの面を指さないようリンクの面の範囲に収める
+    num_faces = np.bincount(face_link, minlength=len(counts))
+    face_start = np.concatenate([[0], np.cumsum(num_faces)[:-1]])
+    pos = np.searchsorted(cum, u, side="right")
+    pos = np.clip(pos, face_start[labels], face_start[labels] + np.maximum(num_faces[labels], 1) - 1)
+    picked = order[np.minimum(pos, len(order) - 1)]
+
+    # 三角形内の一様サンプル
+    r1 = np.sqrt(rng.random(len(labels)))[:, None]
+    r2 = rng.random(len(labels))[:, None]
+    t = tri[picked]
+    points = (1 - r1) * t[:, 0] + r1 * (1 - r2) * t[:, 1] + r1 * r2 * t[:, 2]
+    return points, labels
 
-    # dumpが名前付きで返る場合はそれを使って所属ノードを推定
-    #  - key が node名なら node->link
-    #  - key が geom名なら geom->node->link
-    #  - key が無いなら nodes_geometry と順番合わせ（最後の手段）
-    nodes_geom = list(getattr(scene.graph, "nodes_geometry", []))
 
-    for idx, (key, mesh_world) in enumerate(named_meshes):
-        owner_link = None
+# =============================================================================
+# Part 2: ラベル付き点群（scene.dumpベース：バラけない）
+# =============================================================================
+def sample_labeled_pointcloud(urdf_path, num_points=16384, min_points_per_link=64, seed=None, mesh_cache=None):
+    """
+    returns: (num_points x 7 float32 [xyz, rgb, link_id], {link_name: link_id}, mapping report)
+    """
+    entry = (mesh_cache or default_mesh_cache()).load_scene(urdf_path)
+    robot, scene = entry.robot, entry.scene
+    link_names = list(robot.link_map.keys())
+    link_name_to_id = {n: i for i, n in enumerate(link_names)}
 
-        if isinstance(key, str):
-            if key in node_to_geom:
-                owner_link = guess_owner_link(key)
-            elif key in geom_to_nodes:
-                owner_link = guess_owner_link(geom_to_nodes[key][0])
+    # 1) 各 geometry ノードをワールド化し、node -> link 表でラベル付け（O(1) 参照）
+    link_meshes, report = dump_link_meshes(scene, entry.node_to_link, entry.unmapped_nodes)
+    mapped_links = {ln for ln, _, _ in link_meshes}
+    report["links_without_geometry"] = [ln for ln in link_names if ln not in mapped_links]
+    report["missing_files"] = [list(x) for x in entry.missing_files]
 
-        if owner_link is None and idx < len(nodes_geom):
-            # 最後の手段：順番が一致している前提で合わせる（環境依存）
-            owner_link = guess_owner_link(nodes_geom[idx])
+    if len(link_meshes) == 0:
+        raise RuntimeError(f"No valid link meshes in the scene. (report: {report})")
 
-        if owner_link is None:
-            # ラベル取れないが点群は作れる
-            continue
+    # 2) 1 つに連結する（face -> link 配列付き）
+    all_vertices, all_faces, all_face_links = [], [], []
+    num_vertices = 0
 
+    for owner_link, _, mesh_world in link_meshes:
         label_id = link_name_to_id[owner_link]
 
-        pts, _ = trimesh.sample.sample_surface(mesh_world, samples_per_mesh)
-        all_points.append(pts)
-        all_colors.append(np.ones((len(pts), 3)))
-        all_labels.append(np.full(len(pts), label_id))
+        faces = np.asarray(mesh_world.faces, dtype=np.int64)
+        all_vertices.append(np.asarray(mesh_world.vertices, dtype=np.float64))
+        all_faces.append(faces + num_vertices)
+        all_face_links.append(np.full(len(faces), label_id, dtype=np.int64))
+        num_vertices += len(mesh_world.vertices)
 
-    if not all_points:
-        raise RuntimeError("Could not assign any labels from dump meshes. (key mapping failed)")
+    vertices = np.vstack(all_vertices)
+    faces = np.vstack(all_faces)
+    face_link = np.concatenate(all_face_links)
 
-    X = np.vstack(all_points)
-    C = np.vstack(all_colors)
-    L = np.concatenate(all_labels).reshape(-1, 1)
+    # 3) 総点数を面積比で配分し、一括サンプル（メッシュ数に依らず出力は num_points 点）
+    tri = vertices[faces]
+    areas = triangle_areas(tri)
+    link_areas = np.bincount(face_link, weights=areas, minlength=len(link_names))
+    counts = allocate_point_budget(link_areas, num_points, min_points_per_link)
+    if counts.sum() == 0:
+        raise RuntimeError("All labeled meshes have zero surface area.")
+
+    X, labels = sample_faces_by_link(tri, areas, face_link, counts, np.random.default_rng(seed))
+    C = np.ones((len(X), 3))
+    L = labels.reshape(-1, 1)
 
     # 正規化
     centroid = np.mean(X, axis=0)
@@ -286,22 +337,96 @@ def generate_labeled_pointcloud_from_scene_dump(
         X /= max_dist
 
     final = np.hstack((X, C, L)).astype(np.float32)
+    return final, link_name_to_id, report
+
+
+def generate_labeled_pointcloud_from_scene_dump(
+    urdf_path,
+    output_dir,
+    num_points=16384,
+    min_points_per_link=64,
+    seed=None,
+):
+    final, link_name_to_id, report = sample_labeled_pointcloud(urdf_path, num_points, min_points_per_link, seed)
 
     os.makedirs(output_dir, exist_ok=True)
     base = os.path.splitext(os.path.basename(urdf_path))[0]
     np.save(os.path.join(output_dir, f"{base}_labeled.npy"), final)
     with open(os.path.join(output_dir, f"{base}_label_map.json"), "w") as f:
         json.dump(link_name_to_id, f, indent=4)
+    with open(os.path.join(output_dir, f"{base}_mapping_report.json"), "w") as f:
+        json.dump(report, f, indent=4)
+    if report["unmapped_nodes"] or report["invalid_meshes"] or report["missing_files"]:
+        print(f"⚠️  {len(report['unmapped_nodes'])} unmapped / {len(report['invalid_meshes'])} invalid / "
+              f"{len(report['missing_files'])} missing meshes skipped "
+              f"(see {base}_mapping_report.json)")
 
     print("✅ Saved labeled point cloud (scene.dump based, no scatter)")
 
 
-if __name__ == "__main__":
-    INPUT_URDF = "./1126_merge_robots/merge_fixed_joint_ur3_gripper.urdf"
-    OUTPUT_DIR = "./output/ur3"
+# =============================================================================
+# 構造 JSON の一括書き出し（1 ロボット 1 ファイルではなく JSONL 1 本）
+# =============================================================================
+def _structure_record(args):
+    urdf_path, kwargs = args
+    try:
+        return {"urdf": urdf_path, "structure": parse_urdf_to_structure_json(urdf_path, None, **kwargs)}
+    except Exception as e:
+        return {"urdf": urdf_path, "error": repr(e)}
 
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    base = os.path.splitext(os.path.basename(INPUT_URDF))[0]
 
-    parse_urdf_to_structure_json(INPUT_URDF, os.path.join(OUTPUT_DIR, f"{base}_structure.json"))
-    generate_labeled_pointcloud_from_scene_dump(INPUT_URDF, OUTPUT_DIR, samples_per_mesh=2048)
+def export_structures_jsonl(urdf_paths, out_jsonl, workers=None, chunksize=16, **kwargs):
+    """
+    urdf_paths の構造を {"urdf": path, "structure": {...}} の 1 行ずつ out_jsonl に書く（入力と同じ順）。
+    パースはプロセスプールで、書き込みは親プロセスだけ。kwargs は parse_urdf_to_structure_json に渡す。
+    returns: (書けた件数, 失敗件数)
+    """
+    jobs = [(p, kwargs) for p in urdf_paths]
+    num_ok = num_failed = 0
+    tmp = f"{out_jsonl}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        if workers == 1:
+            records = map(_structure_record, jobs)
+            pool = None
+        else:
+            pool = Pool(workers)
+            records = pool.imap(_structure_record, jobs, chunksize=chunksize)
+        try:
+            for rec in records:
+                if "error" in rec:
+                    num_failed += 1
+                    print(f"❌ {rec['urdf']}: {rec['error']}")
+                else:
+                    num_ok += 1
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    os.replace(tmp, out_jsonl)
+    return num_ok, num_failed
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--urdf", default="./1126_merge_robots/merge_fixed_joint_ur3_gripper.urdf")
+    ap.add_argument("--out_dir", default="./output/ur3")
+    ap.add_argument("--num_points", type=int, default=16384)
+    ap.add_argument("--min_points_per_link", type=int, default=64)
+    ap.add_argument("--structures_jsonl", default=None,
+                    help="batch mode: write the structure of every URDF under --urdf (a directory) to this JSONL")
+    ap.add_argument("--workers", type=int, default=None)
+    args = ap.parse_args()
+
+    if args.structures_jsonl is not None:
+        paths = sorted(glob.glob(os.path.join(args.urdf, "**", "*.urdf"), recursive=True)) \
+            if os.path.isdir(args.urdf) else [args.urdf]
+        num_ok, num_failed = export_structures_jsonl(paths, args.structures_jsonl, workers=args.workers)
+        print(f"✅ {num_ok} structures -> {args.structures_jsonl} (failed: {num_failed})")
+    else:
+        os.makedirs(args.out_dir, exist_ok=True)
+        base = os.path.splitext(os.path.basename(args.urdf))[0]
+
+        parse_urdf_to_structure_json(args.urdf, os.path.join(args.out_dir, f"{base}_structure.json"))
+        generate_labeled_pointcloud_from_scene_dump(args.urdf, args.out_dir, num_points=args.num_points,
+                                                    min_points_per_link=args.min_points_per_link)
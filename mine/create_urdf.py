@@ -1,8 +1,15 @@
 import os
 import json
+import shutil
+import hashlib
 import argparse
 import numpy as np
-import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree, ConvexHull
+
+# ball pivoting の既定パラメータ（キャッシュキーにも入る）
+BPA_PARAMS = {"normal_radius": 0.02, "max_nn": 30, "orient_k": 50, "radius_scales": [1.5, 2.5, 4.0]}
 
 def try_import_open3d():
     try:
@@ -33,21 +40,38 @@ def load_part_pointclouds(parts_dir: str, link_names):
         pcs[ln] = (xyz, rgb)
     return pcs
 
-def pointcloud_to_mesh_obj_open3d(o3d, xyz: np.ndarray, out_obj_path: str):
+def estimate_spacing_and_normals(xyz: np.ndarray, normal_radius=0.02, max_nn=30):
+    """
+    One KD-tree query gives both the nearest-neighbour spacing (for the BPA radii) and the
+    neighbourhoods for normals (same hybrid radius/max_nn search as Open3D's estimate_normals).
+    """
+    if len(xyz) < 2:
+        raise ValueError("point cloud is empty")
+    k = min(max_nn + 1, len(xyz))
+    dist, idx = cKDTree(xyz).query(xyz, k=k)
+    avg = float(np.mean(dist[:, 1]))
+
+    # PCA normal per point over neighbours inside normal_radius (self included)
+    mask = (dist <= normal_radius)[..., None]
+    cnt = mask.sum(axis=1)
+    nbr = xyz[idx]
+    mean = (nbr * mask).sum(axis=1) / cnt
+    c = (nbr - mean[:, None]) * mask
+    cov = np.einsum("nki,nkj->nij", c, c) / cnt[:, :, None]
+    normals = np.linalg.eigh(cov)[1][:, :, 0]
+    normals[cnt[:, 0] < 3] = [0.0, 0.0, 1.0]
+    return avg, normals
+
+def pointcloud_to_mesh_obj_open3d(o3d, xyz: np.ndarray, out_obj_path: str, params=BPA_PARAMS):
     # Ball Pivoting: requires normals
     pcd = o3d.geometry.PointCloud()
     pcd.points = o3d.utility.Vector3dVector(xyz)
 
-    # normals
-    pcd.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=0.02, max_nn=30))
-    pcd.orient_normals_consistent_tangent_plane(50)
-
-    # heuristic radii based on point spacing
-    dists = np.asarray(pcd.compute_nearest_neighbor_distance())
-    if len(dists) == 0:
-        raise ValueError("point cloud is empty")
-    avg = float(np.mean(dists))
-    radii = [avg * 1.5, avg * 2.5, avg * 4.0]
+    # normals + heuristic radii based on point spacing (single KD-tree)
+    avg, normals = estimate_spacing_and_normals(xyz, params["normal_radius"], params["max_nn"])
+    pcd.normals = o3d.utility.Vector3dVector(normals)
+    pcd.orient_normals_consistent_tangent_plane(params["orient_k"])
+    radii = [avg * r for r in params["radius_scales"]]
 
     mesh = o3d.geometry.TriangleMesh.create_from_point_cloud_ball_pivoting(
         pcd, o3d.utility.DoubleVector(radii)
@@ -61,6 +85,216 @@ def pointcloud_to_mesh_obj_open3d(o3d, xyz: np.ndarray, out_obj_path: str):
     o3d.io.write_triangle_mesh(out_obj_path, mesh)
     return out_obj_path
 
+def write_obj(out_obj_path: str, vertices: np.ndarray, faces: np.ndarray):
+    os.makedirs(os.path.dirname(out_obj_path) or ".", exist_ok=True)
+    with open(out_obj_path, "w") as f:
+        np.savetxt(f, vertices, fmt="v %.6f %.6f %.6f")
+        np.savetxt(f, faces + 1, fmt="f %d %d %d")
+    return out_obj_path
+
+# --- fast paths for collision geometry (full fidelity is wasted there) ---
+def convex_hull_obj(xyz: np.ndarray, out_obj_path: str, params=None):
+    hull = ConvexHull(xyz)
+    faces = hull.simplices.copy()
+    # qhull does not orient simplices; make every normal point away from the centroid
+    tri = xyz[faces]
+    n = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+    flip = np.einsum("ij,ij->i", n, tri.mean(axis=1) - xyz[hull.vertices].mean(axis=0)) < 0
+    faces[flip] = faces[flip][:, ::-1]
+    used, inverse = np.unique(faces, return_inverse=True)
+    return write_obj(out_obj_path, xyz[used], inverse.reshape(-1, 3))
+
+def voxel_marching_cubes_obj(xyz: np.ndarray, out_obj_path: str, params=None):
+    from scipy import ndimage
+    from skimage.measure import marching_cubes
+
+    resolution = (params or {}).get("resolution", 32)
+    mn, mx = xyz.min(axis=0), xyz.max(axis=0)
+    pitch = max(float((mx - mn).max()) / resolution, 1e-6)
+    close = (params or {}).get("close_iterations", 2)
+    pad = close + 2
+    ijk = np.floor((xyz - mn) / pitch).astype(np.int64) + pad
+    grid = np.zeros(ijk.max(axis=0) + pad + 1, dtype=bool)
+    grid[ijk[:, 0], ijk[:, 1], ijk[:, 2]] = True
+    # surface samples -> solid: dilate to seal gaps between samples, fill the inside, erode back
+    grid = ndimage.binary_dilation(grid, iterations=close)
+    grid = ndimage.binary_erosion(ndimage.binary_fill_holes(grid), iterations=close)
+    verts, faces, _, _ = marching_cubes(grid.astype(np.float32), level=0.5, allow_degenerate=False)
+    # skimage winds faces towards increasing values (inside); flip to outward normals
+    return write_obj(out_obj_path, (verts - pad + 0.5) * pitch + mn, faces[:, ::-1])
+
+COLLISION_MESHERS = {
+    "convex_hull": convex_hull_obj,
+    "voxel": voxel_marching_cubes_obj,
+}
+
+# --- per-link meshing jobs (process pool + content-hash cache) ---
+def mesh_cache_key(xyz: np.ndarray, mode: str, params) -> str:
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(xyz, dtype=np.float64).tobytes())
+    h.update(json.dumps({"mode": mode, "params": params}, sort_keys=True).encode())
+    return h.hexdigest()
+
+def run_mesh_job(job):
+    """job: (link, xyz, mode, params, out_obj, cached_obj) -> (link, mode, out_obj or None, error)"""
+    ln, xyz, mode, params, out_obj, cached_obj = job
+    try:
+        if mode == "bpa":
+            o3d = try_import_open3d()
+            if o3d is None:
+                raise RuntimeError("open3d not found")
+            pointcloud_to_mesh_obj_open3d(o3d, xyz, out_obj, params)
+        else:
+            COLLISION_MESHERS[mode](xyz, out_obj, params)
+        if cached_obj is not None:
+            os.makedirs(os.path.dirname(cached_obj), exist_ok=True)
+            tmp = f"{cached_obj}.{os.getpid()}.tmp"
+            shutil.copyfile(out_obj, tmp)
+            os.replace(tmp, cached_obj)
+        return ln, mode, out_obj, None
+    except Exception as e:
+        return ln, mode, None, repr(e)
+
+def mesh_links(pcs, jobs, cache_dir=None, workers=None):
+    """
+    jobs: list of (link, mode, params, out_obj). Links whose (points, mode, params) hash is already in
+    cache_dir are copied from there; the rest are meshed in a process pool.
+    returns: {(link, mode): out_obj}, {(link, mode): error}
+    """
+    done, errors, todo = {}, {}, []
+    for ln, mode, params, out_obj in jobs:
+        xyz = pcs[ln][0]
+        cached_obj = None
+        if cache_dir is not None:
+            cached_obj = os.path.join(cache_dir, mesh_cache_key(xyz, mode, params) + ".obj")
+            if os.path.exists(cached_obj):
+                os.makedirs(os.path.dirname(out_obj) or ".", exist_ok=True)
+                shutil.copyfile(cached_obj, out_obj)
+                done[(ln, mode)] = out_obj
+                continue
+        todo.append((ln, xyz, mode, params, out_obj, cached_obj))
+
+    if len(todo) > 1 and workers != 1:
+        # largest clouds first so the pool does not end on one long BPA job
+        todo.sort(key=lambda j: -len(j[1]))
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            results = list(ex.map(run_mesh_job, todo))
+    else:
+        results = [run_mesh_job(j) for j in todo]
+
+    for ln, mode, out_obj, err in results:
+        if err is None:
+            done[(ln, mode)] = out_obj
+        else:
+            errors[(ln, mode)] = err
+    return done, errors
+
+# --- collision simplification stage (triangle budget per link) ---
+def decimate_obj(o3d, src_obj: str, out_obj: str, max_triangles: int):
+    mesh = o3d.io.read_triangle_mesh(src_obj)
+    if len(mesh.triangles) > max_triangles:
+        mesh = mesh.simplify_quadric_decimation(target_number_of_triangles=max_triangles)
+        mesh.remove_degenerate_triangles()
+        mesh.remove_unreferenced_vertices()
+    os.makedirs(os.path.dirname(out_obj) or ".", exist_ok=True)
+    o3d.io.write_triangle_mesh(out_obj, mesh)
+    return [out_obj]
+
+def convex_decompose_obj(o3d, src_obj: str, out_obj: str, max_triangles: int, max_hulls=16, threshold=0.05):
+    """CoACD pieces (one OBJ per hull, <collision> per piece); a single convex hull if coacd is missing"""
+    mesh = o3d.io.read_triangle_mesh(src_obj)
+    vertices, faces = np.asarray(mesh.vertices), np.asarray(mesh.triangles)
+    try:
+        import coacd
+        parts = coacd.run_coacd(coacd.Mesh(vertices, faces), threshold=threshold, max_convex_hull=max_hulls)
+    except ImportError:
+        parts = [(vertices, faces)]
+
+    stem = os.path.splitext(out_obj)[0]
+    budget = max(max_triangles // len(parts), 4)
+    outs = []
+    for i, (v, _) in enumerate(parts):
+        piece = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.asarray(v))).compute_convex_hull()[0]
+        if len(piece.triangles) > budget:
+            piece = piece.simplify_quadric_decimation(target_number_of_triangles=budget)
+        out = f"{stem}_{i}.obj"
+        os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+        o3d.io.write_triangle_mesh(out, piece)
+        outs.append(out)
+    return outs
+
+COLLISION_SIMPLIFIERS = {
+    "decimate": decimate_obj,
+    "convex": convex_decompose_obj,
+}
+
+def run_simplify_job(job):
+    """job: (link, src_obj, out_obj, method, max_triangles, cached_dir) -> (link, [out objs] or None, error)"""
+    ln, src_obj, out_obj, method, max_triangles, cached_dir = job
+    try:
+        o3d = try_import_open3d()
+        if o3d is None:
+            raise RuntimeError("open3d not found")
+        outs = COLLISION_SIMPLIFIERS[method](o3d, src_obj, out_obj, max_triangles)
+        if cached_dir is not None:
+            tmp = f"{cached_dir}.{os.getpid()}.tmp"
+            os.makedirs(tmp, exist_ok=True)
+            for i, out in enumerate(outs):
+                shutil.copyfile(out, os.path.join(tmp, f"{i}.obj"))
+            try:
+                os.replace(tmp, cached_dir)
+            except OSError:
+                # 同じ内容のメッシュ（同じ run の別リンク / cache_dir を共有する別 run）が先に書いていた
+                if not os.path.isdir(cached_dir):
+                    raise
+                shutil.rmtree(tmp, ignore_errors=True)
+        return ln, outs, None
+    except Exception as e:
+        return ln, None, repr(e)
+
+def simplify_collision_meshes(sources, out_dir, method="decimate", max_triangles=2000, cache_dir=None, workers=None):
+    """
+    sources: {link: source mesh path}. Writes <out_dir>/<link>_collision_simple*.obj with at most
+    max_triangles triangles per link, in parallel and memoized by hash(source file, method, budget).
+    returns: {link: [collision mesh paths]}, {link: error}
+    """
+    done, errors, todo = {}, {}, []
+    for ln, src_obj in sources.items():
+        out_obj = os.path.join(out_dir, f"{ln}_collision_simple.obj")
+        cached_dir = None
+        if cache_dir is not None:
+            h = hashlib.sha1()
+            with open(src_obj, "rb") as f:
+                h.update(f.read())
+            h.update(json.dumps({"method": method, "max_triangles": max_triangles}).encode())
+            cached_dir = os.path.join(cache_dir, h.hexdigest())
+            if os.path.isdir(cached_dir):
+                cached = sorted(os.listdir(cached_dir), key=lambda n: int(n.split(".")[0]))
+                # same file names as decimate_obj / convex_decompose_obj write
+                if method == "decimate":
+                    outs = [out_obj]
+                else:
+                    outs = [f"{os.path.splitext(out_obj)[0]}_{i}.obj" for i in range(len(cached))]
+                os.makedirs(out_dir, exist_ok=True)
+                for name, out in zip(cached, outs):
+                    shutil.copyfile(os.path.join(cached_dir, name), out)
+                done[ln] = outs
+                continue
+        todo.append((ln, src_obj, out_obj, method, max_triangles, cached_dir))
+
+    if len(todo) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            results = list(ex.map(run_simplify_job, todo))
+    else:
+        results = [run_simplify_job(j) for j in todo]
+
+    for ln, outs, err in results:
+        if err is None:
+            done[ln] = outs
+        else:
+            errors[ln] = err
+    return done, errors
+
 def bbox_size_from_xyz(xyz: np.ndarray):
     mn = xyz.min(axis=0)
     mx = xyz.max(axis=0)
@@ -68,79 +302,131 @@ def bbox_size_from_xyz(xyz: np.ndarray):
     # avoid zero-size boxes
     size = np.maximum(size, 1e-4)
     return size.tolist()
-def build_urdf(structure, mesh_map, geometry_fallback_box_map,
-               out_urdf_path: str, robot_name="urdf_anything_like",
-               default_effort=1.0, default_velocity=1.0):
-    robot = ET.Element("robot", {"name": robot_name})
-
-    # Links
-    for link_name in structure["links"].keys():
-        link_el = ET.SubElement(robot, "link", {"name": link_name})
-
-        # visual
-        vis = ET.SubElement(link_el, "visual")
-        geom = ET.SubElement(vis, "geometry")
-
-        if link_name in mesh_map:
-            ET.SubElement(geom, "mesh", {"filename": mesh_map[link_name]})
-        else:
-            # fallback to box primitive
-            size = geometry_fallback_box_map.get(link_name, [0.1, 0.1, 0.1])
-            ET.SubElement(geom, "box", {"size": f"{size[0]} {size[1]} {size[2]}"})
-
-        # collision (mirror visual)
-        col = ET.SubElement(link_el, "collision")
-        cgeom = ET.SubElement(col, "geometry")
-        if link_name in mesh_map:
-            ET.SubElement(cgeom, "mesh", {"filename": mesh_map[link_name]})
+def _xml_attr(value) -> str:
+    # ElementTree と同じエスケープ（属性は常にダブルクォート）
+    return escape(str(value), {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#09;"})
+
+
+class URDFWriter:
+    """
+    URDF を 1 要素ずつファイルに書き出す（ElementTree の木を作らない）。
+    出力は ET.indent(space="  ") + tree.write(xml_declaration=True) と同じバイト列。
+
+        with URDFWriter(f, robot_name) as w:
+            w.link(name, visual, collisions)
+            w.joint(j)
+    """
+
+    def __init__(self, f, robot_name, default_effort=1.0, default_velocity=1.0):
+        self.f = f
+        self.robot_name = robot_name
+        self.default_effort = default_effort
+        self.default_velocity = default_velocity
+        self.empty = True
+
+    def _tag(self, depth, name, attrs=None, close=False):
+        attr = "".join(f' {k}="{_xml_attr(v)}"' for k, v in (attrs or {}).items())
+        self.f.write(f"{'  ' * depth}<{name}{attr}{' /' if close else ''}>\n".encode("utf-8"))
+
+    def _end(self, depth, name):
+        self.f.write(f"{'  ' * depth}</{name}>\n".encode("utf-8"))
+
+    def _open_robot(self):
+        if self.empty:
+            self.f.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+            self._tag(0, "robot", {"name": self.robot_name})
+            self.empty = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+
+    def close(self):
+        if self.empty:
+            # 子の無い robot は <robot ... /> になる（ET と同じ）
+            self.f.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+            self.f.write(f'<robot name="{_xml_attr(self.robot_name)}" />'.encode("utf-8"))
+            self.empty = False
+            return
+        self.f.write(b"</robot>")
+
+    def _geometry(self, depth, kind, geometry):
+        # geometry: ("mesh", filename) or ("box", [sx, sy, sz])
+        self._tag(depth, kind)
+        self._tag(depth + 1, "geometry")
+        shape, value = geometry
+        if shape == "mesh":
+            self._tag(depth + 2, "mesh", {"filename": value}, close=True)
         else:
-            size = geometry_fallback_box_map.get(link_name, [0.1, 0.1, 0.1])
-            ET.SubElement(cgeom, "box", {"size": f"{size[0]} {size[1]} {size[2]}"})
-
-    # Joints
-    for j in structure["joints"]:
-        jname = j["id"]
+            self._tag(depth + 2, "box", {"size": f"{value[0]} {value[1]} {value[2]}"}, close=True)
+        self._end(depth + 1, "geometry")
+        self._end(depth, kind)
+
+    def link(self, name, visual, collisions):
+        self._open_robot()
+        self._tag(1, "link", {"name": name})
+        self._geometry(2, "visual", visual)
+        for c in collisions:
+            self._geometry(2, "collision", c)
+        self._end(1, "link")
+
+    def joint(self, j):
+        self._open_robot()
         jtype = j["type"]
-        parent = j["parent"]
-        child = j["child"]
-
-        joint_el = ET.SubElement(robot, "joint", {"name": jname, "type": jtype})
-        ET.SubElement(joint_el, "parent", {"link": parent})
-        ET.SubElement(joint_el, "child", {"link": child})
-
+        self._tag(1, "joint", {"name": j["id"], "type": jtype})
+        self._tag(2, "parent", {"link": j["parent"]}, close=True)
+        self._tag(2, "child", {"link": j["child"]}, close=True)
         xyz = j["origin"]["xyz"]
         rpy = j["origin"]["rpy"]
-        ET.SubElement(
-            joint_el, "origin",
-            {"xyz": f"{xyz[0]} {xyz[1]} {xyz[2]}", "rpy": f"{rpy[0]} {rpy[1]} {rpy[2]}"}
-        )
-
+        self._tag(2, "origin", {"xyz": f"{xyz[0]} {xyz[1]} {xyz[2]}", "rpy": f"{rpy[0]} {rpy[1]} {rpy[2]}"}, close=True)
         axis = j.get("axis", [0, 0, 0])
-        ET.SubElement(joint_el, "axis", {"xyz": f"{axis[0]} {axis[1]} {axis[2]}"})
+        self._tag(2, "axis", {"xyz": f"{axis[0]} {axis[1]} {axis[2]}"}, close=True)
 
         # limit: Choreonoid等のため effort/velocity を必ず出す（revolute/prismatic/continuous）
         if jtype in ("revolute", "prismatic", "continuous"):
             lim = j.get("limit", {}) or {}
-
             attrs = {}
-
             # revolute/prismatic は lower/upper があると嬉しい（無いなら省略可）
             if jtype in ("revolute", "prismatic"):
                 if "lower" in lim:
                     attrs["lower"] = str(lim["lower"])
                 if "upper" in lim:
                     attrs["upper"] = str(lim["upper"])
-
             # effort/velocity は必須寄りなのでデフォルト補完
-            attrs["effort"] = str(lim.get("effort", default_effort))
-            attrs["velocity"] = str(lim.get("velocity", default_velocity))
+            attrs["effort"] = str(lim.get("effort", self.default_effort))
+            attrs["velocity"] = str(lim.get("velocity", self.default_velocity))
+            self._tag(2, "limit", attrs, close=True)
+        self._end(1, "joint")
 
-            ET.SubElement(joint_el, "limit", attrs)
 
-    tree = ET.ElementTree(robot)
-    ET.indent(tree, space="  ", level=0)
-    with open(out_urdf_path, "wb") as f:
-        tree.write(f, encoding="utf-8", xml_declaration=True)
+def build_urdf(structure, mesh_map, geometry_fallback_box_map,
+               out_urdf_path: str, robot_name="urdf_anything_like",
+               default_effort=1.0, default_velocity=1.0, collision_mesh_map=None):
+    # collision_mesh_map: link -> collision mesh, or list of convex pieces (defaults to the visual mesh)
+    collision_mesh_map = collision_mesh_map or {}
+    with open(out_urdf_path, "wb") as f, URDFWriter(f, robot_name, default_effort, default_velocity) as w:
+        # Links
+        for link_name in structure["links"].keys():
+            if link_name in mesh_map:
+                visual = ("mesh", mesh_map[link_name])
+            else:
+                # fallback to box primitive
+                visual = ("box", geometry_fallback_box_map.get(link_name, [0.1, 0.1, 0.1]))
+
+            # collision (dedicated collision mesh(es), else mirror visual)
+            if link_name in collision_mesh_map:
+                pieces = collision_mesh_map[link_name]
+                collisions = [("mesh", piece) for piece in ([pieces] if isinstance(pieces, str) else pieces)]
+            else:
+                collisions = [visual]
+            w.link(link_name, visual, collisions)
+
+        # Joints
+        for j in structure["joints"]:
+            w.joint(j)
 
 def main():
     ap = argparse.ArgumentParser()
@@ -149,6 +435,14 @@ def main():
     ap.add_argument("--out_urdf", default="./output/ur3/ua.urdf", help="output urdf path")
     ap.add_argument("--mesh_dir", default="ua_meshes", help="directory to export meshes")
     ap.add_argument("--robot_name", default="urdf_anything_like")
+    ap.add_argument("--workers", type=int, default=None, help="processes for per-link meshing (1 = serial)")
+    ap.add_argument("--cache_dir", default=None, help="meshes memoized by hash(points, params); default <mesh_dir>/.cache")
+    ap.add_argument("--collision_mode", default="same", choices=["same"] + sorted(COLLISION_MESHERS),
+                    help="collision geometry: same as visual, or a fast convex hull / voxel marching cubes")
+    ap.add_argument("--voxel_resolution", type=int, default=32)
+    ap.add_argument("--collision_simplify", default="decimate", choices=["none"] + sorted(COLLISION_SIMPLIFIERS),
+                    help="reduce collision meshes to --collision_max_triangles (visual meshes stay full resolution)")
+    ap.add_argument("--collision_max_triangles", type=int, default=2000, help="triangle budget per link")
     args = ap.parse_args()
 
     structure = load_structure(args.structure)
@@ -158,7 +452,9 @@ def main():
 
     o3d = try_import_open3d()
     mesh_map = {}
+    collision_mesh_map = {}
     box_map = {}
+    jobs = []
 
     for ln in link_names:
         if ln not in pcs:
@@ -169,20 +465,38 @@ def main():
         xyz, _ = pcs[ln]
         box_map[ln] = bbox_size_from_xyz(xyz)
 
-        if o3d is None:
-            # no open3d -> box fallback
-            continue
-
-        out_obj = os.path.join(args.mesh_dir, f"{ln}.obj")
-        try:
-            pointcloud_to_mesh_obj_open3d(o3d, xyz, out_obj)
-            # URDF mesh path: keep relative if possible
+        # no open3d -> box fallback for visual
+        if o3d is not None:
+            jobs.append((ln, "bpa", BPA_PARAMS, os.path.join(args.mesh_dir, f"{ln}.obj")))
+        if args.collision_mode != "same":
+            params = {"resolution": args.voxel_resolution} if args.collision_mode == "voxel" else {}
+            jobs.append((ln, args.collision_mode, params, os.path.join(args.mesh_dir, f"{ln}_collision.obj")))
+
+    cache_dir = args.cache_dir or os.path.join(args.mesh_dir, ".cache")
+    done, errors = mesh_links(pcs, jobs, cache_dir=cache_dir, workers=args.workers)
+    for (ln, mode), out_obj in done.items():
+        # URDF mesh path: keep relative if possible
+        if mode == "bpa":
             mesh_map[ln] = out_obj
-        except Exception:
-            # if meshing fails, fallback box
-            pass
-
-    build_urdf(structure, mesh_map, box_map, args.out_urdf, robot_name=args.robot_name)
+        else:
+            collision_mesh_map[ln] = out_obj
+    for (ln, mode), err in errors.items():
+        # if meshing fails, fallback box (or the visual mesh for collision)
+        print(f"[warn] {mode} meshing failed for {ln}: {err}")
+
+    # collision simplification: start from the dedicated collision mesh, else the dense visual mesh
+    if args.collision_simplify != "none" and o3d is not None:
+        sources = {ln: collision_mesh_map.get(ln, mesh_map.get(ln)) for ln in link_names}
+        sources = {ln: src for ln, src in sources.items() if src is not None}
+        simplified, errors = simplify_collision_meshes(
+            sources, args.mesh_dir, method=args.collision_simplify, max_triangles=args.collision_max_triangles,
+            cache_dir=cache_dir, workers=args.workers)
+        collision_mesh_map.update(simplified)
+        for ln, err in errors.items():
+            print(f"[warn] collision simplification failed for {ln}: {err}")
+
+    build_urdf(structure, mesh_map, box_map, args.out_urdf, robot_name=args.robot_name,
+               collision_mesh_map=collision_mesh_map)
     print(f"Wrote URDF: {args.out_urdf}")
     if o3d is None:
         print("open3d not found -> used box fallback (no mesh export).")
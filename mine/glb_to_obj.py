@@ -1,119 +1,359 @@
+import os
+import glob
+import json
+import time
+import zlib
+import argparse
+import traceback
+from multiprocessing import Pool
+
 import trimesh
 import numpy as np
-import os
+
+# 生成 GLB（Tripo など）-> URDF-Anything 入力点群 (N, 6) [x, y, z, r, g, b]
+# 色は to_color() でテクスチャを面の色に焼き込まず、サンプル点の重心座標で UV を補間してテクスチャから直接読む。
+# バッチ時は各ワーカーが点群を作り、親プロセスだけがバイナリシャードに追記する:
+#   <out_dir>/shard_00000.bin  float32 の (target_count, 6) レコードを連結したもの
+#   <out_dir>/index.jsonl      {"name", "glb", "shard", "row", ...}（np.memmap で 1 件ずつ読める）
+#   <out_dir>/meta.json        {"target_count", "channels", "dtype"}
+
+WHITE = np.ones(3)
+
+
+# =============================================================================
+# GLB 読み込み・正規化
+# =============================================================================
+def load_glb_parts(glb_path):
+    """シーン内の全メッシュを（ワールド座標にして、visual を保ったまま）返す"""
+    loaded = trimesh.load(glb_path)
+    meshes = loaded.dump(concatenate=False) if isinstance(loaded, trimesh.Scene) else [loaded]
+    return [m for m in meshes if isinstance(m, trimesh.Trimesh) and len(m.faces) > 0]
+
+
+def normalize_parts(parts, rotate=True):
+    """
+    全パーツをまとめて回転 -> 面積重心を原点へ -> 単位球に収める（パーツごとではなく全体で 1 つの変換）。
+    returns: 適用した 4x4 変換, 元のサイズ
+    """
+    matrix = np.eye(4)
+    # 回転補正 (Tripoのモデルが寝ている場合。X軸 +90度で Z-up にする)
+    if rotate:
+        matrix = trimesh.transformations.rotation_matrix(np.pi / 2, [1, 0, 0])
+
+    vertices = np.concatenate([trimesh.transform_points(p.vertices, matrix) for p in parts])
+    offsets = np.cumsum([0] + [len(p.vertices) for p in parts[:-1]])
+    tri = np.concatenate([vertices[p.faces + o] for p, o in zip(parts, offsets)])
+    areas = np.linalg.norm(np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0]), axis=1) / 2
+    # mesh.centroid と同じ面積重み付き重心
+    centroid = (areas[:, None] * tri.mean(axis=1)).sum(axis=0) / max(areas.sum(), 1e-12)
+
+    max_dist = np.max(np.linalg.norm(vertices - centroid, axis=1))
+    scale = 1.0 / max_dist if max_dist > 0 else 1.0
+    T = np.eye(4)
+    T[:3, 3] = -centroid
+    S = np.diag([scale, scale, scale, 1.0])
+    matrix = S @ T @ matrix
+    for p in parts:
+        p.apply_transform(matrix)
+    return matrix, max_dist
+
+
+# =============================================================================
+# 色
+# =============================================================================
+def _to_unit_rgb(colors):
+    colors = np.asarray(colors, dtype=np.float64)[..., :3]
+    return colors / 255.0 if colors.size and colors.max() > 1.1 else colors
+
+
+def texture_lookup(image, uv):
+    """uv (M, 2) -> RGB (M, 3) [0, 1]。trimesh の uv_to_color と同じ最近傍・繰り返し"""
+    h, w = image.shape[:2]
+    uv = np.asarray(uv, dtype=np.float64) % 1.0
+    x = np.round(uv[:, 0] * (w - 1)).astype(np.int64)
+    y = np.round((1.0 - uv[:, 1]) * (h - 1)).astype(np.int64)
+    return _to_unit_rgb(image[y, x])
+
+
+class PartColors:
+    """
+    1 メッシュ分の色の引き方。kind は texture / vertex / face / constant。
+    sample(face_idx, bary) で表面点、vertex_rgb で頂点の色を返す。
+    """
+
+    def __init__(self, mesh):
+        self.kind, self.constant = "constant", WHITE
+        visual = mesh.visual
+        if visual.kind == "texture":
+            material = visual.material
+            image = getattr(material, "baseColorTexture", None)
+            if image is None:
+                image = getattr(material, "image", None)
+            factor = getattr(material, "baseColorFactor", None)
+            self.factor = WHITE if factor is None else _to_unit_rgb(factor)
+            if image is not None and visual.uv is not None and len(visual.uv) == len(mesh.vertices):
+                self.kind = "texture"
+                self.image = np.asarray(image.convert("RGB"))
+                self.uv = np.asarray(visual.uv, dtype=np.float64)
+            else:
+                # テクスチャ無しの PBR（baseColorFactor だけ）
+                main = getattr(material, "main_color", None)
+                self.constant = self.factor if factor is not None or main is None else _to_unit_rgb(main)
+        elif visual.kind == "vertex":
+            self.kind = "vertex"
+            self.vertex_colors = _to_unit_rgb(visual.vertex_colors)
+        elif visual.kind == "face":
+            self.kind = "face"
+            self.face_colors = _to_unit_rgb(visual.face_colors)
+        self.faces = np.asarray(mesh.faces)
+        self.num_vertices = len(mesh.vertices)
+
+    def sample(self, face_idx, bary):
+        if self.kind == "texture":
+            uv = np.einsum("mk,mkj->mj", bary, self.uv[self.faces[face_idx]])
+            return texture_lookup(self.image, uv) * self.factor
+        if self.kind == "vertex":
+            return np.einsum("mk,mkj->mj", bary, self.vertex_colors[self.faces[face_idx]])
+        if self.kind == "face":
+            return self.face_colors[face_idx]
+        return np.broadcast_to(self.constant, (len(face_idx), 3))
+
+    def vertex_rgb(self):
+        if self.kind == "texture":
+            return texture_lookup(self.image, self.uv) * self.factor
+        if self.kind == "vertex":
+            return self.vertex_colors
+        rgb = np.broadcast_to(self.constant, (self.num_vertices, 3)).copy()
+        if self.kind == "face":
+            # 頂点は接する面のどれかの色（後勝ち）
+            rgb[self.faces.ravel()] = np.repeat(self.face_colors, 3, axis=0)
+        return rgb
+
+
+# =============================================================================
+# サンプリング
+# =============================================================================
+def sample_colored_points(parts, target_count=8192, surface_ratio=0.7, rng=None):
+    """
+    (A) 表面サンプリング（全パーツ合わせて面積比例）+ (B) メッシュ頂点（形状のエッジを保つため）。
+    returns: (target_count, 6) float32
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    colorers = [PartColors(p) for p in parts]
+
+    # (A) 全パーツの三角形を連結して、面積の累積和から一括で面を引く
+    tri = np.concatenate([p.vertices[p.faces] for p in parts])
+    face_part = np.repeat(np.arange(len(parts)), [len(p.faces) for p in parts])
+    face_local = np.concatenate([np.arange(len(p.faces)) for p in parts])
+    areas = np.linalg.norm(np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0]), axis=1) / 2
+    cum = np.cumsum(areas)
+
+    count_surface = int(target_count * surface_ratio)
+    faces = np.minimum(np.searchsorted(cum, rng.random(count_surface) * cum[-1], side="right"), len(tri) - 1)
+    r = rng.random((count_surface, 2))
+    flip = r.sum(axis=1) > 1
+    r[flip] = 1 - r[flip]
+    bary = np.column_stack([1 - r.sum(axis=1), r])
+    points_surface = np.einsum("mk,mkj->mj", bary, tri[faces])
+
+    colors_surface = np.empty((count_surface, 3))
+    order = np.argsort(face_part[faces], kind="stable")
+    bounds = np.searchsorted(face_part[faces][order], np.arange(len(parts) + 1))
+    for i, colorer in enumerate(colorers):
+        idx = order[bounds[i]:bounds[i + 1]]
+        if len(idx):
+            colors_surface[idx] = colorer.sample(face_local[faces[idx]], bary[idx])
+
+    # (B) 頂点（数が足りなければ重複許可）
+    count_verts = target_count - count_surface
+    verts = np.concatenate([p.vertices for p in parts])
+    vert_rgb = np.concatenate([c.vertex_rgb() for c in colorers])
+    indices = rng.choice(len(verts), count_verts, replace=len(verts) < count_verts)
+
+    points = np.vstack((points_surface, verts[indices]))
+    colors = np.vstack((colors_surface, vert_rgb[indices]))
+    return np.hstack((points, np.clip(colors, 0.0, 1.0))).astype(np.float32)
+
+
+def glb_to_point_cloud(glb_path, target_count=8192, rotate=True, export_obj_path=None, seed=None):
+    parts = load_glb_parts(glb_path)
+    if not parts:
+        raise ValueError(f"no triangle meshes in {glb_path}")
+    _, size = normalize_parts(parts, rotate=rotate)
+
+    # 確認用OBJ (この時点での形状がAIに入力される)。頼まれたときだけ
+    if export_obj_path is not None:
+        os.makedirs(os.path.dirname(export_obj_path) or ".", exist_ok=True)
+        trimesh.util.concatenate(parts).export(export_obj_path)
+    return sample_colored_points(parts, target_count, rng=np.random.default_rng(seed)), size
+
 
 def glb_to_urdf_anything_input(glb_path, export_obj_path, npy_path, target_count=8192):
     """
     GLBファイルを読み込み、URDF-Anything学習/推論用の点群データ(.npy)を作成する。
-    
+
     Args:
         glb_path (str): 入力GLBファイルのパス
-        export_obj_path (str): 確認用OBJファイルの保存先
+        export_obj_path (str | None): 確認用OBJファイルの保存先 (None なら保存しない)
         npy_path (str): 出力NPYファイルの保存先
         target_count (int): 点群の点数 (デフォルト8192)
     """
     print(f"🔄 Processing: {glb_path}")
+    point_cloud_data, size = glb_to_point_cloud(glb_path, target_count, export_obj_path=export_obj_path)
+    print(f"   -> Applied Scaling: {1.0 / size if size > 0 else 1.0:.4f} (Original Size: {size:.4f})")
+    if export_obj_path is not None:
+        print(f"   -> Saved Debug OBJ: {export_obj_path}")
 
-    # 1. GLB読み込み
-    mesh = trimesh.load(glb_path)
-    if isinstance(mesh, trimesh.Scene):
-        mesh = mesh.dump(concatenate=True)
-
-    # 2. 回転補正 (Tripoのモデルが寝ている場合のみ有効化。通常は不要な場合も多いが、一応入れる)
-    # ※ モデルが直立しているならこのブロックはコメントアウトしてもOK
-    print("   -> Applying Rotation (X-axis -90 deg for Z-up correction)")
-    matrix = trimesh.transformations.rotation_matrix(np.pi/2, [1, 0, 0])
-    mesh.apply_transform(matrix)
-    
-
-    # 3. 原点合わせ (Centering)
-    mesh.apply_translation(-mesh.centroid)
-
-    # 4. 正規化 (Normalization) - 単位球(半径1)に収める
-    # これがニューラルネット入力には必須
-    max_dist = np.max(np.linalg.norm(mesh.vertices, axis=1))
-    if max_dist > 0:
-        scale = 1.0 / max_dist
-        mesh.apply_scale(scale)
-        print(f"   -> Applied Scaling: {scale:.4f} (Original Size: {max_dist:.4f})")
-
-    # 5. 確認用OBJ保存 (この時点での形状がAIに入力される)
-    os.makedirs(os.path.dirname(export_obj_path), exist_ok=True)
-    mesh.export(export_obj_path)
-    print(f"   -> Saved Debug OBJ: {export_obj_path}")
-
-    # 6. ハイブリッド・サンプリング
-    # (A) 表面サンプリング (70%)
-    count_surface = int(target_count * 0.7)
-    points_surface, face_indices = trimesh.sample.sample_surface(mesh, count_surface)
-    
-    # 色情報の取得 (表面サンプリング分)
-    colors_surface = np.ones((count_surface, 3)) # デフォルトは白
-    
-    # テクスチャ/頂点カラーがある場合、それを取得する努力をする
-    if hasattr(mesh.visual, 'to_color'):
-        try:
-            # UVマッピングなどから色を取得できる場合
-            visual_color = mesh.visual.to_color()
-            if hasattr(visual_color, 'face_colors'):
-                # face_indicesを使ってサンプリング点の色を取得
-                colors_surface = visual_color.face_colors[face_indices][:, :3]
-                # 0-255なら0-1に正規化
-                if colors_surface.max() > 1.1:
-                    colors_surface = colors_surface / 255.0
-        except Exception as e:
-            print(f"   -> Warning: Color extraction failed ({e}). Using white.")
-
-    # (B) メッシュの頂点を混ぜる (30%) - 形状のエッジを保つため
-    count_verts = target_count - count_surface
-    verts = mesh.vertices
-    if len(verts) > 0:
-        # 頂点数が足りない場合は重複許可(replace=True)、足りるならFalse
-        replace = len(verts) < count_verts
-        indices = np.random.choice(len(verts), count_verts, replace=replace)
-        points_verts = verts[indices]
-        
-        # 頂点の色取得
-        colors_verts = np.ones((count_verts, 3))
-        if hasattr(mesh.visual, 'vertex_colors') and len(mesh.visual.vertex_colors) == len(verts):
-             colors_verts = mesh.visual.vertex_colors[indices][:, :3]
-             if colors_verts.max() > 1.1:
-                    colors_verts = colors_verts / 255.0
-    else:
-        points_verts = np.empty((0, 3))
-        colors_verts = np.empty((0, 3))
-
-    # 7. 結合 (Merge)
-    points = np.vstack((points_surface, points_verts))
-    colors = np.vstack((colors_surface, colors_verts))
-    
-    # 点数が厳密に target_count になるように調整 (稀にズレるため)
-    if len(points) > target_count:
-        points = points[:target_count]
-        colors = colors[:target_count]
-    elif len(points) < target_count:
-        # 足りない分は最後の点をコピーして埋める
-        pad_size = target_count - len(points)
-        points = np.vstack((points, points[-pad_size:]))
-        colors = np.vstack((colors, colors[-pad_size:]))
-
-    # 8. 保存 (XYZ + RGB = 6次元)
-    # shape: (8192, 6)
-    point_cloud_data = np.hstack((points, colors)).astype(np.float32)
-    
-    os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+    # 保存 (XYZ + RGB = 6次元)
+    os.makedirs(os.path.dirname(npy_path) or ".", exist_ok=True)
     np.save(npy_path, point_cloud_data)
     print(f"✅ Saved NPY: {npy_path} (Shape: {point_cloud_data.shape})")
+    return point_cloud_data
 
-# --- 実行 ---
-if __name__ == "__main__":
-    # パスは適宜書き換えてください
-    INPUT_GLB = "./output/arm/arm.glb"
-    DEBUG_OBJ = "./output/arm/check_me.obj"
-    OUTPUT_NPY = "./output/arm/arm.npy"
-    
-    # ファイルがあるか確認
-    if os.path.exists(INPUT_GLB):
-        glb_to_urdf_anything_input(INPUT_GLB, DEBUG_OBJ, OUTPUT_NPY)
+
+# =============================================================================
+# バッチ（プール + シャード）
+# =============================================================================
+_CONFIG = None
+
+
+def _init_worker(config):
+    global _CONFIG
+    _CONFIG = config
+
+
+def convert_glb(glb_path):
+    cfg = _CONFIG
+    name = os.path.splitext(os.path.relpath(glb_path, cfg["input_root"]))[0].replace(os.sep, "_")
+    start = time.time()
+    try:
+        obj_path = os.path.join(cfg["obj_dir"], f"{name}.obj") if cfg["obj_dir"] else None
+        cloud, size = glb_to_point_cloud(glb_path, cfg["target_count"], cfg["rotate"], obj_path,
+                                         seed=zlib.crc32(name.encode("utf-8")))
+        return {"status": "ok", "name": name, "glb": glb_path, "cloud": cloud,
+                "size": float(size), "elapsed": round(time.time() - start, 3)}
+    except Exception as e:
+        return {"status": "failed", "name": name, "glb": glb_path, "error": repr(e),
+                "traceback": traceback.format_exc(), "elapsed": round(time.time() - start, 3)}
+
+
+class ShardWriter:
+    """(target_count, 6) float32 のレコードを shard_XXXXX.bin に追記する。shard_size 件ごとに次のファイルへ"""
+
+    def __init__(self, out_dir, shard_size, first_shard=0):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        self.shard = first_shard
+        self.row = 0
+        self.f = None
+
+    def write(self, cloud):
+        if self.f is None or self.row == self.shard_size:
+            self.close()
+            self.f = open(os.path.join(self.out_dir, f"shard_{self.shard:05d}.bin"), "wb")
+        self.f.write(np.ascontiguousarray(cloud, dtype=np.float32).tobytes())
+        location = (self.shard, self.row)
+        self.row += 1
+        return location
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            self.shard += 1
+            self.row = 0
+
+
+def read_index(out_dir):
+    path = os.path.join(out_dir, "index.jsonl")
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # 強制終了で途中まで書かれた最終行
+                continue
+    return records
+
+
+def load_shard_item(out_dir, record):
+    """index.jsonl の 1 行 -> (target_count, 6) float32（memmap なのでシャード全体は読まない）"""
+    with open(os.path.join(out_dir, "meta.json"), "r") as f:
+        meta = json.load(f)
+    n, c = meta["target_count"], meta["channels"]
+    shard = np.memmap(os.path.join(out_dir, f"shard_{record['shard']:05d}.bin"), dtype=meta["dtype"], mode="r")
+    return np.asarray(shard[record["row"] * n * c:(record["row"] + 1) * n * c]).reshape(n, c)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Folder of GLBs -> URDF-Anything input point clouds in binary shards")
+    ap.add_argument("--input", required=True, help="directory searched for **/*.glb")
+    ap.add_argument("--out_dir", required=True)
+    ap.add_argument("--target_count", type=int, default=8192)
+    ap.add_argument("--no_rotate", action="store_true", help="skip the X +90deg (Y-up -> Z-up) correction")
+    ap.add_argument("--obj_dir", default=None, help="also export debug OBJs here")
+    ap.add_argument("--shard_size", type=int, default=1024, help="clouds per shard file")
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    ap.add_argument("--max_tasks_per_child", type=int, default=50, help="recycle workers to bound trimesh memory growth")
+    args = ap.parse_args()
+
+    out_dir = os.path.abspath(args.out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    if args.obj_dir is not None:
+        os.makedirs(args.obj_dir, exist_ok=True)
+
+    meta_path = os.path.join(out_dir, "meta.json")
+    meta = {"target_count": args.target_count, "channels": 6, "dtype": "float32"}
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            if json.load(f) != meta:
+                raise ValueError(f"{meta_path} was written with different settings")
     else:
-        print(f"Error: Input file not found: {INPUT_GLB}")
\ No newline at end of file
+        with open(meta_path, "w") as f:
+            json.dump(meta, f, indent=2)
+
+    input_root = os.path.abspath(args.input)
+    paths = sorted(glob.glob(os.path.join(input_root, "**", "*.glb"), recursive=True))
+    records = read_index(out_dir)
+    done = {r["glb"] for r in records}
+    todo = [p for p in paths if p not in done]
+    # 再実行時は既存シャードに追記せず、次の番号から書く
+    first_shard = max((r["shard"] for r in records), default=-1) + 1
+    print(f"{len(paths)} GLBs, {len(paths) - len(todo)} already done, {len(todo)} to convert")
+
+    config = {"input_root": input_root, "target_count": args.target_count, "rotate": not args.no_rotate,
+              "obj_dir": args.obj_dir}
+    writer = ShardWriter(out_dir, args.shard_size, first_shard)
+    num_ok = num_failed = 0
+    start = time.time()
+    # シャードと index への書き込みは親プロセスだけが行う
+    with open(os.path.join(out_dir, "index.jsonl"), "a", encoding="utf-8") as index, \
+            open(os.path.join(out_dir, "failures.jsonl"), "a", encoding="utf-8") as failures, \
+            Pool(args.workers, initializer=_init_worker, initargs=(config,), maxtasksperchild=args.max_tasks_per_child) as pool:
+        try:
+            for i, result in enumerate(pool.imap_unordered(convert_glb, todo, chunksize=1), 1):
+                if result["status"] == "ok":
+                    num_ok += 1
+                    shard, row = writer.write(result.pop("cloud"))
+                    writer.f.flush()
+                    index.write(json.dumps({**result, "shard": shard, "row": row}, ensure_ascii=False) + "\n")
+                    index.flush()
+                else:
+                    num_failed += 1
+                    failures.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    failures.flush()
+                    print(f"❌ {result['name']}: {result['error']}")
+                if i % 100 == 0 or i == len(todo):
+                    rate = i / max(time.time() - start, 1e-6)
+                    print(f"[{i}/{len(todo)}] ok={num_ok} failed={num_failed} ({rate:.2f} GLB/s)")
+        finally:
+            writer.close()
+
+    print(f"✅ ok={num_ok} failed={num_failed} -> {out_dir}")
+
+
+if __name__ == "__main__":
+    main()
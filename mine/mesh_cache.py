@@ -0,0 +1,167 @@
+import os
+import hashlib
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import yourdfpy
+import trimesh
+
+# データセット全体では同じメッシュファイルが多数の URDF から参照される。
+# create_ua.py / rebuild_scene_obj.py / check_coordinates.py が毎回
+# yourdfpy.URDF.load(load_meshes=True) でメッシュをパースし直さないよう、
+#   - メッシュ: (絶対パス, mtime, size) をキーに、頂点 float32 / 面 uint32 の npz としてディスクに保存
+#   - URDF: (パス, mtime) をキーに、シーン（リンクフレーム + メッシュ）とリンクのワールド変換をメモリに保持
+# する。ディスク側はプロセス間で共有できるので、バッチ変換の各ワーカーからも使える。
+
+MESH_CACHE_DIR_ENV = "UA_MESH_CACHE_DIR"
+
+# node_to_link: シーンの geometry ノード -> 所属リンク。unmapped_nodes: どのリンクにも属さない geometry ノード
+# missing_files: 見つからなかった <mesh> ファイル [(link, filename)]
+SceneEntry = namedtuple("SceneEntry", ["robot", "scene", "link_transforms", "node_to_link", "unmapped_nodes", "missing_files"])
+
+
+def _file_key(path):
+    st = os.stat(path)
+    return f"{os.path.abspath(path)}:{st.st_mtime_ns}:{st.st_size}"
+
+
+class MeshCache:
+    def __init__(self, cache_dir=None, max_meshes=2048, max_scenes=8):
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.max_meshes = max_meshes
+        self.max_scenes = max_scenes
+        self.meshes = OrderedDict()
+        self.scenes = OrderedDict()
+        self.hits = {"memory": 0, "disk": 0, "parse": 0, "scene": 0}
+
+    # -------------------------------------------------------------------------
+    # メッシュ 1 ファイル
+    # -------------------------------------------------------------------------
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npz")
+
+    def load(self, path):
+        """
+        path のメッシュを 1 つの Trimesh として返す（force="mesh" 相当）。
+        返り値はキャッシュと共有しているので、変形するときは copy() すること。
+        """
+        key = _file_key(path)
+        mesh = self.meshes.get(key)
+        if mesh is not None:
+            self.meshes.move_to_end(key)
+            self.hits["memory"] += 1
+            return mesh
+
+        disk_path = self._disk_path(key) if self.cache_dir is not None else None
+        if disk_path is not None and os.path.exists(disk_path):
+            with np.load(disk_path) as data:
+                mesh = trimesh.Trimesh(vertices=data["vertices"], faces=data["faces"], process=False)
+            self.hits["disk"] += 1
+        else:
+            mesh = trimesh.load(path, force="mesh", ignore_broken=True, skip_materials=True)
+            mesh = trimesh.Trimesh(
+                vertices=np.asarray(mesh.vertices, dtype=np.float32),
+                faces=np.asarray(mesh.faces, dtype=np.uint32),
+                process=False,
+            )
+            self.hits["parse"] += 1
+            if disk_path is not None:
+                # 複数プロセスが同時に書いても壊れないよう tmp -> rename
+                tmp = f"{disk_path}.{os.getpid()}.tmp.npz"
+                np.savez(tmp, vertices=mesh.vertices.astype(np.float32), faces=mesh.faces.astype(np.uint32))
+                os.replace(tmp, disk_path)
+
+        mesh.metadata["file_path"] = os.path.abspath(path)
+        mesh.metadata["file_name"] = os.path.basename(path)
+        self.meshes[key] = mesh
+        if len(self.meshes) > self.max_meshes:
+            self.meshes.popitem(last=False)
+        return mesh
+
+    def geometry_mesh(self, geometry, mesh_dir):
+        """URDF の <mesh> を読み込んで scale を適用する（box/sphere/cylinder は yourdfpy 側で作られる）"""
+        filename = yourdfpy.filename_handler_magic(geometry.mesh.filename, dir=mesh_dir)
+        if not os.path.isfile(filename):
+            return None
+        mesh = self.load(filename)
+        if geometry.mesh.scale is not None:
+            mesh = mesh.copy()
+            scale = np.broadcast_to(np.asarray(geometry.mesh.scale, dtype=np.float64), (3,))
+            S = np.eye(4)
+            S[:3, :3] = np.diag(scale)
+            mesh.apply_transform(S)
+        return mesh
+
+    # -------------------------------------------------------------------------
+    # URDF 1 つ（シーン + リンク変換）
+    # -------------------------------------------------------------------------
+    def load_scene(self, urdf_path):
+        """
+        returns: SceneEntry(robot, scene, link_transforms, node_to_link, unmapped_nodes, missing_files)
+        load_meshes=True と同じ構造（base_frame -> link -> visual geometry）のシーンを、メッシュだけキャッシュから組み立てる。
+        関節は全て 0。scene と link_transforms は共有オブジェクトなので書き換えないこと。
+        """
+        key = _file_key(urdf_path)
+        entry = self.scenes.get(key)
+        if entry is not None:
+            self.scenes.move_to_end(key)
+            self.hits["scene"] += 1
+            return entry
+
+        # メッシュ以外（リンクフレーム・プリミティブ形状）は yourdfpy に任せる
+        robot = yourdfpy.URDF.load(urdf_path, load_meshes=False, build_scene_graph=True, load_collision_meshes=False)
+        robot.update_cfg(configuration={j: 0.0 for j in robot.joint_map})
+        scene = robot.scene
+        mesh_dir = os.path.dirname(os.path.abspath(urdf_path))
+
+        # プリミティブ形状は yourdfpy が link 直下に追加済み（_add_geometries_to_scene）
+        node_to_link = {}
+        unmapped_nodes = []
+        missing_files = []
+        for node in scene.graph.nodes_geometry:
+            parent = scene.graph.transforms.parents.get(node)
+            if parent in robot.link_map:
+                node_to_link[node] = parent
+            else:
+                unmapped_nodes.append(node)
+
+        for link_name, link in robot.link_map.items():
+            for v in link.visuals:
+                if v.geometry is None or v.geometry.mesh is None:
+                    continue
+                mesh = self.geometry_mesh(v.geometry, mesh_dir)
+                if mesh is None:
+                    missing_files.append((link_name, v.geometry.mesh.filename))
+                    continue
+                node = scene.add_geometry(
+                    geometry=mesh,
+                    geom_name=v.name,
+                    parent_node_name=link_name,
+                    transform=v.origin if v.origin is not None else np.eye(4),
+                )
+                node_to_link[node] = link_name
+
+        base = scene.graph.base_frame
+        link_transforms = {ln: scene.graph.get(frame_to=ln, frame_from=base)[0] for ln in robot.link_map}
+
+        entry = SceneEntry(robot, scene, link_transforms, node_to_link, unmapped_nodes, missing_files)
+        self.scenes[key] = entry
+        if len(self.scenes) > self.max_scenes:
+            self.scenes.popitem(last=False)
+        return entry
+
+    def stats(self):
+        return {"meshes": len(self.meshes), "scenes": len(self.scenes), **self.hits}
+
+
+_default_cache = None
+
+
+def default_mesh_cache():
+    """プロセス内で共有するキャッシュ。ディスク側は環境変数 UA_MESH_CACHE_DIR で有効になる"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = MeshCache(cache_dir=os.environ.get(MESH_CACHE_DIR_ENV))
+    return _default_cache
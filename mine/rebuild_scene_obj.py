@@ -1,8 +1,9 @@
 import os
 import numpy as np
-import yourdfpy
 import trimesh
 
+from mesh_cache import default_mesh_cache
+
 def as_mesh_list(dumped):
     """
     trimeshのバージョン差を吸収して、dump結果を list[Trimesh] に揃える
@@ -36,13 +37,11 @@ def mesh_is_valid(m: trimesh.Trimesh) -> bool:
         return False
     return True
 
-def main(urdf_path, out_dir="./output"):
+def main(urdf_path, out_dir="./output", mesh_cache=None):
     os.makedirs(out_dir, exist_ok=True)
 
-    robot = yourdfpy.URDF.load(urdf_path, load_meshes=True, load_collision_meshes=False)
-    robot.update_cfg(configuration={j: 0.0 for j in robot.joint_map})
-
-    scene = robot.scene
+    # メッシュはキャッシュ経由（create_ua.py と同じ URDF なら再パースしない）
+    robot, scene, *_ = (mesh_cache or default_mesh_cache()).load_scene(urdf_path)
 
     print("[info] scene.geometry count =", len(scene.geometry))
     print("[info] graph.nodes count    =", len(list(scene.graph.nodes)))
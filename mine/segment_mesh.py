@@ -1,80 +1,150 @@
 import trimesh
 import numpy as np
 from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
 import os
 
-def split_mesh_using_labels(mesh_path, npy_path, output_dir):
+# 点群のラベル（任意個のパーツ）をメッシュに転写して、パーツごとのサブメッシュに分割する。
+# 数百万面でも回るよう、k-NN 投票・面の多数決はすべて bincount でまとめて計算する。
+
+
+def knn_vote(tree, point_labels, query, num_labels, k=8, eps=1e-6, chunk=1 << 20):
+    """
+    query の各点について、近傍 k 点のラベルを距離の逆数で重み付け投票する。
+    returns: (labels (M,), confidence (M,)  勝ったラベルの得票率)
+    """
+    k = min(k, len(point_labels))
+    out_labels = np.empty(len(query), dtype=np.int64)
+    out_conf = np.empty(len(query), dtype=np.float64)
+    for start in range(0, len(query), chunk):
+        q = query[start:start + chunk]
+        dist, idx = tree.query(q, k=k, workers=-1)
+        dist, idx = dist.reshape(len(q), k), idx.reshape(len(q), k)
+        w = 1.0 / (dist + eps)
+        # (行, ラベル) を 1 次元に潰して一括集計
+        slots = np.arange(len(q))[:, None] * num_labels + point_labels[idx]
+        votes = np.bincount(slots.ravel(), weights=w.ravel(), minlength=len(q) * num_labels).reshape(len(q), num_labels)
+        best = votes.argmax(axis=1)
+        out_labels[start:start + chunk] = best
+        out_conf[start:start + chunk] = votes[np.arange(len(q)), best] / w.sum(axis=1)
+    return out_labels, out_conf
+
+
+def face_majority(faces, vertex_labels, vertex_conf, num_labels, chunk=1 << 20):
+    """
+    面の 3 頂点のラベルで多数決（同票なら頂点の得票率が高い方）。
+    2 ラベルの「平均 > 0.5」と違い、3 パーツ以上でも正しい。
+    """
+    out = np.empty(len(faces), dtype=np.int64)
+    for start in range(0, len(faces), chunk):
+        f = faces[start:start + chunk]
+        slots = np.arange(len(f))[:, None] * num_labels + vertex_labels[f]
+        # 1 票 = 1 + confidence（<1）なので、票数が優先され、同票のときだけ confidence が効く
+        weights = 1.0 + vertex_conf[f]
+        votes = np.bincount(slots.ravel(), weights=weights.ravel(), minlength=len(f) * num_labels).reshape(len(f), num_labels)
+        out[start:start + chunk] = votes.argmax(axis=1)
+    return out
+
+
+def extract_submesh(vertices, faces, face_idx):
+    """trimesh.submesh と同じだが、使う頂点の抽出と面の張り替えを np.unique 1 回で行う"""
+    sub_faces = faces[face_idx]
+    used, inverse = np.unique(sub_faces, return_inverse=True)
+    return vertices[used], inverse.reshape(-1, 3)
+
+
+def _export_part(args):
+    vertices, faces, path = args
+    # process=False: 頂点のマージ等をせず元の位置をキープ（重要）
+    trimesh.Trimesh(vertices=vertices, faces=faces, process=False).export(path)
+    return path
+
+
+def segment_mesh_by_labels(mesh, points, labels, k=8):
+    """
+    returns: (face_labels (F,) 元のラベル値, label_values)
+    """
+    label_values, point_labels = np.unique(labels.astype(np.int64), return_inverse=True)
+    tree = cKDTree(points)
+    vertex_labels, vertex_conf = knn_vote(tree, point_labels, np.asarray(mesh.vertices), len(label_values), k=k)
+    face_labels = face_majority(np.asarray(mesh.faces), vertex_labels, vertex_conf, len(label_values))
+    return label_values[face_labels], label_values
+
+
+def split_mesh_using_labels(mesh_path, npy_path, output_dir, label_map_path=None, k=8, workers=4, ext="obj"):
     print(f"📂 Mesh: {mesh_path}")
     print(f"📂 Labels: {npy_path}")
 
     # 1. データの読み込み
     try:
-        # 位置合わせ済みのメッシュを読む
-        mesh = trimesh.load(mesh_path)
-        
+        # 位置合わせ済みのメッシュを読む（Scene なら 1 つに結合）
+        mesh = trimesh.load(mesh_path, force="mesh")
+
         # ラベル付き点群を読む [x, y, z, r, g, b, label]
         data = np.load(npy_path)
         points = data[:, :3]
-        labels = data[:, 6] # 0 or 1
-        
+        labels = data[:, 6]
+
     except Exception as e:
         print(f"❌ 読み込みエラー: {e}")
-        return
+        return None
+
+    # ラベル ID -> 名前（create_ua.py の *_label_map.json: {link_name: id}）
+    names = {}
+    if label_map_path is not None:
+        with open(label_map_path, "r") as f:
+            names = {int(v): name for name, v in json.load(f).items()}
 
-    print(f"   Mesh Vertices: {len(mesh.vertices)}")
+    print(f"   Mesh Vertices: {len(mesh.vertices)}  Faces: {len(mesh.faces)}")
     print(f"   Labeled Points: {len(points)}")
 
-    # 2. k-NNで「点群のラベル」を「メッシュの頂点」にコピーする
-    print("🔄 k-NNを実行中 (点群 -> メッシュ頂点)...")
-    
-    # 点群で検索ツリーを作る
-    tree = cKDTree(points)
-    
-    # メッシュの各頂点について、一番近い点群の点を探す
-    distances, indices = tree.query(mesh.vertices, k=1)
-    
-    # 近かった点のラベルを採用
-    vertex_labels = labels[indices]
-
-    # 3. 面 (Face) 単位での分割
-    # ポリゴン（三角形）は3つの頂点でできているので、頂点のラベルの多数決をとる
-    # (例: 3つのうち2つが「頭」なら、その面は「頭」)
-    face_labels_mean = vertex_labels[mesh.faces].mean(axis=1)
-    
-    # 0.5より大きければ Head(1), 以下なら Body(0)
-    head_faces_mask = face_labels_mean > 0.5
-    body_faces_mask = ~head_faces_mask # 反転
-
-    print(f"   Head Faces: {np.sum(head_faces_mask)}")
-    print(f"   Body Faces: {np.sum(body_faces_mask)}")
-
-    # 4. サブメッシュの作成と保存
-    # process=False にすると、座標を勝手に動かさず、元の位置をキープします（重要）
-    head_mesh = mesh.submesh([head_faces_mask], append=True)
-    body_mesh = mesh.submesh([body_faces_mask], append=True)
+    # 2. k-NN 投票で頂点ラベル -> 面の多数決
+    print(f"🔄 k-NN 投票中 (k={k}, 点群 -> メッシュ頂点 -> 面)...")
+    face_labels, label_values = segment_mesh_by_labels(mesh, points, labels, k=k)
+
+    # 3. ラベルごとに面をまとめる（argsort 1 回で全パーツの面インデックスを得る）
+    order = np.argsort(face_labels, kind="stable")
+    bounds = np.searchsorted(face_labels[order], label_values)
+    bounds = np.append(bounds, len(order))
 
+    vertices = np.asarray(mesh.vertices)
+    faces = np.asarray(mesh.faces)
     os.makedirs(output_dir, exist_ok=True)
-    
-    # 保存
-    head_out = os.path.join(output_dir, "link_head.obj")
-    body_out = os.path.join(output_dir, "link_body.obj")
-    
-    head_mesh.export(head_out)
-    body_mesh.export(body_out)
+    jobs = []
+    for i, value in enumerate(label_values):
+        face_idx = order[bounds[i]:bounds[i + 1]]
+        name = names.get(int(value), f"part_{int(value)}")
+        print(f"   {name}: {len(face_idx)} faces")
+        if len(face_idx) == 0:
+            continue
+        sub_vertices, sub_faces = extract_submesh(vertices, faces, face_idx)
+        jobs.append((sub_vertices, sub_faces, os.path.join(output_dir, f"{name}.{ext}")))
+
+    # 4. 保存（パーツごとに並列）
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as ex:
+            outputs = list(ex.map(_export_part, jobs))
+    else:
+        outputs = [_export_part(job) for job in jobs]
 
     print("\n✅ 分割成功！")
-    print(f"   -> {head_out}")
-    print(f"   -> {body_out}")
-    print("   (Blenderなどでこの2つを同時に開いてみてください)")
+    for out in outputs:
+        print(f"   -> {out}")
+    return outputs
+
 
 if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
     # 【注意】必ず「位置合わせ済み」のOBJファイルを使うこと！
-    INPUT_MESH = "./output/check_me.obj" 
-    
-    # ラベル付き点群
-    INPUT_NPY = "./output/snowman_labeled.npy"
-    
-    # 出力先
-    OUTPUT_DIR = "./output"
-
-    split_mesh_using_labels(INPUT_MESH, INPUT_NPY, OUTPUT_DIR)
\ No newline at end of file
+    ap.add_argument("--mesh", default="./output/check_me.obj", help="aligned mesh")
+    ap.add_argument("--npy", default="./output/snowman_labeled.npy", help="labeled point cloud [x, y, z, r, g, b, label]")
+    ap.add_argument("--label_map", default=None, help="json {part name: label id} used for output file names")
+    ap.add_argument("--out_dir", default="./output")
+    ap.add_argument("--k", type=int, default=8, help="neighbours per vertex")
+    ap.add_argument("--workers", type=int, default=4, help="parallel part writers")
+    ap.add_argument("--ext", default="obj")
+    args = ap.parse_args()
+
+    split_mesh_using_labels(args.mesh, args.npy, args.out_dir, args.label_map, k=args.k, workers=args.workers, ext=args.ext)
@@ -1,91 +1,285 @@
+import os
+import glob
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.signal import find_peaks
 
-def find_boundaries_and_multi_segment(npy_path, prominence_ratio=0.15, min_dist_bins=5):
+# 主成分軸に沿った点密度の「くびれ（谷）」でパーツを切り分ける。
+# 大量のラベル無しスキャンにラベルを付けるための下ごしらえ用なので、
+#   - 複数の点群をまとめて（PCA・ヒストグラムは bincount で一括）処理
+#   - NumPy だけで完結（scipy / matplotlib 不要、図は頼まれたときだけ）
+#   - ラベルは点ごとの uint8/uint16 配列（*_labels.npy）で出力
+
+
+# =============================================================================
+# 谷検出（scipy.signal.find_peaks(max - hist, prominence, distance) 相当）
+# =============================================================================
+def find_valleys(hist, prominence_ratio=0.15, min_dist_bins=5, min_part_ratio=0.0):
     """
-    Args:
-        npy_path: 点群データのパス
-        prominence_ratio: くびれの深さ判定 (0.0~1.0)。大きいほど深い谷だけ拾う。
-        min_dist_bins: くびれ同士の最小間隔 (ビン数)。近すぎる谷を無視する。
+    hist: (bins,) の 1 本。returns: 谷のビン位置（昇順）
+    平坦な谷（空ビンが続くところ）はその中央を返す。端のビンは谷にしない。
+    min_part_ratio > 0 なら、点数がその割合未満のパーツができる谷を浅い方から外す
+    （パーツ間の隙間にまばらな点があると、隙間の両端に谷が 2 つできるため）。
     """
-    # 1. 点群データの読み込み
-    data = np.load(npy_path)
-    points = data[:, :3] # [x, y, z]
-    
-    # 高さ (Z軸)
-    height_coords = points[:, 2] 
-    
-    # 2. ヒストグラムを作成
-    # binsを少し増やして分解能を上げます (50 -> 100)
-    bins_count = 100
-    hist, bin_edges = np.histogram(height_coords, bins=bins_count)
-    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-    
-    # 3. 「くびれ（谷）」をすべて見つける
-    # 山を探す関数なので、データを反転させて谷を探します
-    inverted_hist = np.max(hist) - hist
-    
-    # パラメータ設定
-    # prominence: 周りよりどれくらい深いか
-    # distance: 隣のピークとどれくらい離れているか (ビン単位)
-    peaks, properties = find_peaks(
-        inverted_hist, 
-        prominence=np.max(inverted_hist) * prominence_ratio,
-        distance=min_dist_bins
-    )
-    
-    # くびれのZ座標リスト
-    boundaries = bin_centers[peaks]
-    boundaries.sort() # 下から順に並べる
-    
-    print(f"✅ 検出されたくびれ数: {len(boundaries)}")
-    for i, b in enumerate(boundaries):
-        print(f"   - Boundary {i+1}: Z = {b:.4f}")
-
-    # --- 可視化 ---
+    hist = np.asarray(hist)
+    # 同じ値の連続（plateau）を 1 つの run にまとめる
+    starts = np.flatnonzero(np.r_[True, hist[1:] != hist[:-1]])
+    ends = np.r_[starts[1:] - 1, len(hist) - 1]
+    v = hist[starts]
+    if len(v) < 3:
+        return np.zeros(0, dtype=np.int64)
+    k = np.flatnonzero((v[1:-1] < v[:-2]) & (v[1:-1] < v[2:])) + 1
+    if len(k) == 0:
+        return np.zeros(0, dtype=np.int64)
+    pos = (starts[k] + ends[k]) // 2
+
+    # distance: 深い（値の小さい）谷から順に採用し、近すぎる谷を落とす（同じ深さなら左から）
+    keep = np.ones(len(k), dtype=bool)
+    for i in np.argsort(v[k], kind="stable"):
+        if keep[i]:
+            close = np.abs(pos - pos[i]) < min_dist_bins
+            close[i] = False
+            keep &= ~close
+    k, pos = k[keep], pos[keep]
+
+    # prominence: 両側で自分より低い run に当たるまでの最大値のうち、低い方 - 自分
+    threshold = (hist.max() - hist.min()) * prominence_ratio
+    prominent = []
+    for kk in k:
+        lower_left = np.flatnonzero(v[:kk] < v[kk])
+        lower_right = np.flatnonzero(v[kk + 1:] < v[kk])
+        left_max = v[(lower_left[-1] + 1 if len(lower_left) else 0):kk].max()
+        right_max = v[kk + 1:(kk + 1 + lower_right[0] if len(lower_right) else len(v))].max()
+        prominent.append(min(left_max, right_max) - v[kk] >= threshold)
+    pos = np.sort(pos[np.asarray(prominent, dtype=bool)])
+
+    if min_part_ratio > 0 and len(pos):
+        cum = np.r_[0, np.cumsum(hist)]
+        while len(pos):
+            # 谷ビンは右側のパーツに入る（np.digitize と同じ向き）
+            mass = np.diff(cum[np.r_[0, pos, len(hist)]])
+            small = mass.argmin()
+            if mass[small] >= min_part_ratio * cum[-1]:
+                break
+            # 小さいパーツに接する谷のうち、浅い（値の大きい）方を外す
+            sides = [c for c in (small - 1, small) if 0 <= c < len(pos)]
+            pos = np.delete(pos, max(sides, key=lambda c: hist[pos[c]]))
+    return pos
+
+
+# =============================================================================
+# まとめて PCA + ヒストグラム
+# =============================================================================
+def principal_axes(points, cloud_ids, num_clouds):
+    """
+    points: (N, 3) 連結済み, cloud_ids: (N,) 所属点群。
+    returns: (centroids (B, 3), axes (B, 3, 3)  axes[b, i] が第 i 主成分、分散の大きい順)
+    """
+    counts = np.bincount(cloud_ids, minlength=num_clouds).astype(np.float64)[:, None]
+    centroids = np.stack([np.bincount(cloud_ids, weights=points[:, i], minlength=num_clouds) for i in range(3)], 1) / counts
+    c = points - centroids[cloud_ids]
+    cov = np.stack([
+        np.bincount(cloud_ids, weights=c[:, i] * c[:, j], minlength=num_clouds)
+        for i in range(3) for j in range(3)
+    ], 1).reshape(num_clouds, 3, 3) / counts[:, :, None]
+    _, vecs = np.linalg.eigh(cov)
+    axes = vecs[:, :, ::-1].transpose(0, 2, 1)
+    # 符号を決める（絶対値最大の成分を正に）ので、同じ形なら同じ向き
+    sign = np.sign(np.take_along_axis(axes, np.abs(axes).argmax(axis=2)[..., None], axis=2))
+    sign[sign == 0] = 1
+    return centroids, axes * sign
+
+
+MIN_CLOUD_POINTS = 3
+
+
+def segment_along_principal_axes(clouds, num_axes=1, bins=100, prominence_ratio=0.15, min_dist_bins=5,
+                                 min_part_ratio=0.01):
+    """
+    clouds: list of (N_b, >=3) 点群。
+    returns: (labels list of (N_b,) uint8/uint16, cuts list of [axis][cut positions (主成分座標)], info)
+    num_axes > 1 のときは各軸の区間番号の組み合わせをパーツとし、点群ごとに 0.. へ詰め直す。
+    点が 3 点未満の点群（空の npy など）は PCA できないので、全点ラベル 0・切断なしにする
+    （1 つのせいでバッチ全体が止まらないように。info["skipped"] に番号が入る）。
+    """
+    valid = [b for b, c in enumerate(clouds) if len(c) >= MIN_CLOUD_POINTS]
+    if len(valid) == len(clouds):
+        return _segment_batch(clouds, num_axes, bins, prominence_ratio, min_dist_bins, min_part_ratio)
+
+    labels = [np.zeros(len(c), dtype=np.uint8) for c in clouds]
+    cuts = [[np.zeros(0) for _ in range(num_axes)] for _ in clouds]
+    info = {
+        "centroids": np.full((len(clouds), 3), np.nan),
+        "axes": np.full((len(clouds), 3, 3), np.nan),
+        "hist": np.zeros((len(clouds), num_axes, bins), dtype=np.int64),
+        "lo": np.zeros((len(clouds), num_axes)),
+        "width": np.zeros((len(clouds), num_axes)),
+    }
+    if valid:
+        sub_labels, sub_cuts, sub_info = _segment_batch(
+            [clouds[b] for b in valid], num_axes, bins, prominence_ratio, min_dist_bins, min_part_ratio)
+        for i, b in enumerate(valid):
+            labels[b], cuts[b] = sub_labels[i], sub_cuts[i]
+        for k in info:
+            info[k][valid] = sub_info[k]
+    info["skipped"] = [b for b in range(len(clouds)) if b not in set(valid)]
+    return labels, cuts, info
+
+
+def _segment_batch(clouds, num_axes, bins, prominence_ratio, min_dist_bins, min_part_ratio):
+    sizes = np.array([len(c) for c in clouds])
+    num_clouds = len(clouds)
+    offsets = np.r_[0, np.cumsum(sizes)]
+    points = np.concatenate([np.asarray(c)[:, :3] for c in clouds]).astype(np.float64)
+    cloud_ids = np.repeat(np.arange(num_clouds), sizes)
+
+    centroids, axes = principal_axes(points, cloud_ids, num_clouds)
+    # (N, num_axes) 主成分座標
+    proj = np.einsum("nj,naj->na", points - centroids[cloud_ids], axes[cloud_ids, :num_axes])
+
+    # 点群 x 軸ごとの範囲 -> ビン番号 -> bincount 1 回で (B, A, bins) のヒストグラム
+    lo = np.minimum.reduceat(proj, offsets[:-1], axis=0)
+    hi = np.maximum.reduceat(proj, offsets[:-1], axis=0)
+    width = np.maximum(hi - lo, 1e-12) / bins
+    bin_idx = np.clip(((proj - lo[cloud_ids]) / width[cloud_ids]).astype(np.int64), 0, bins - 1)
+    slots = (cloud_ids[:, None] * num_axes + np.arange(num_axes)) * bins + bin_idx
+    hist = np.bincount(slots.ravel(), minlength=num_clouds * num_axes * bins).reshape(num_clouds, num_axes, bins)
+
+    # 谷 -> 切断位置（ビン中心）。ragged なので +inf で埋めて (B, A, K) にする
+    cuts = [[lo[b, a] + (find_valleys(hist[b, a], prominence_ratio, min_dist_bins, min_part_ratio) + 0.5) * width[b, a]
+             for a in range(num_axes)] for b in range(num_clouds)]
+    max_cuts = max([len(x) for row in cuts for x in row] + [0])
+    padded = np.full((num_clouds, num_axes, max_cuts), np.inf)
+    for b in range(num_clouds):
+        for a in range(num_axes):
+            padded[b, a, :len(cuts[b][a])] = cuts[b][a]
+
+    # np.digitize と同じ：自分より下にある切断面の数 = 区間番号
+    segment = (proj[:, :, None] >= padded[cloud_ids]).sum(axis=2)
+    num_segments = np.array([[len(x) + 1 for x in row] for row in cuts])
+    labels = np.zeros(len(points), dtype=np.int64)
+    for a in range(num_axes):
+        labels = labels * num_segments[cloud_ids, a] + segment[:, a]
+
+    out = []
+    for b in range(num_clouds):
+        lab = labels[offsets[b]:offsets[b + 1]]
+        if num_axes > 1:
+            lab = np.unique(lab, return_inverse=True)[1].reshape(-1)
+        out.append(lab.astype(np.uint8 if lab.max(initial=0) < 256 else np.uint16))
+    info = {"centroids": centroids, "axes": axes, "hist": hist, "lo": lo, "width": width, "skipped": []}
+    return out, cuts, info
+
+
+def plot_histogram(hist, lo, width, cuts, out_png, axis_name="PC1"):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    bin_centers = lo + (np.arange(len(hist)) + 0.5) * width
     plt.figure(figsize=(8, 5))
     plt.plot(bin_centers, hist, label='Point Density')
-    
     # 検出されたすべての境界線を引く
-    for b in boundaries:
+    for b in cuts:
         plt.axvline(x=b, color='r', linestyle='--', alpha=0.7)
-        
-    plt.title(f"Z-axis Point Density ({len(boundaries)} cuts found)")
-    plt.xlabel("Height (Z)")
+    plt.title(f"{axis_name} Point Density ({len(cuts)} cuts found)")
+    plt.xlabel(axis_name)
     plt.ylabel("Number of Points")
     plt.legend()
-    plt.savefig("debug_histogram_multi.png")
-    print("📊 分布図を 'debug_histogram_multi.png' に保存しました。")
-    # --------------
-
-    # 4. ラベル付け (Multi-segmentation)
-    # np.digitize を使うと、境界線リストを使って一発で 0, 1, 2... に振り分けてくれます
-    # boundaries = [z1, z2] の場合:
-    #   z < z1  -> 0
-    #   z1 <= z < z2 -> 1
-    #   z2 <= z -> 2
-    labels = np.digitize(height_coords, boundaries)
-    
-    # 5. 保存
-    # [x, y, z, r, g, b, label]
+    plt.savefig(out_png)
+    plt.close()
+
+
+def find_boundaries_and_multi_segment(npy_path, prominence_ratio=0.15, min_dist_bins=5, num_axes=1, bins=100,
+                                      min_part_ratio=0.01, plot_path=None):
+    """
+    Args:
+        npy_path: 点群データのパス
+        prominence_ratio: くびれの深さ判定 (0.0~1.0)。大きいほど深い谷だけ拾う。
+        min_dist_bins: くびれ同士の最小間隔 (ビン数)。近すぎる谷を無視する。
+        num_axes: 切断面を探す主成分軸の数 (1~3)
+        min_part_ratio: これより点数の割合が小さいパーツは作らない
+        plot_path: 指定したときだけ第 1 主成分のヒストグラムを保存
+    """
+    data = np.load(npy_path)
+    labels, cuts, info = segment_along_principal_axes(
+        [data], num_axes=num_axes, bins=bins, prominence_ratio=prominence_ratio, min_dist_bins=min_dist_bins,
+        min_part_ratio=min_part_ratio)
+    labels, cuts = labels[0], cuts[0]
+
+    print(f"✅ 検出されたくびれ数: {sum(len(c) for c in cuts)}")
+    for a, axis_cuts in enumerate(cuts):
+        for i, b in enumerate(axis_cuts):
+            print(f"   - PC{a + 1} Boundary {i + 1}: {b:.4f}")
+
+    if plot_path is not None:
+        plot_histogram(info["hist"][0, 0], info["lo"][0, 0], info["width"][0, 0], cuts[0], plot_path)
+        print(f"📊 分布図を '{plot_path}' に保存しました。")
+
+    # [x, y, z, r, g, b, label]（segment_mesh.py が読む形式）
     labeled_data = np.hstack((data, labels.reshape(-1, 1)))
-    
     output_path = npy_path.replace(".npy", "_labeled_multi.npy")
     np.save(output_path, labeled_data)
     print(f"💾 ラベル付き点群を保存しました: {output_path}")
-    print(f"   -> 合計パーツ数: {len(boundaries) + 1}")
-    
-    return labeled_data, boundaries
+    print(f"   -> 合計パーツ数: {int(labels.max(initial=0)) + 1}")
+
+    return labeled_data, cuts
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Bootstrap part labels by cutting clouds at density valleys along PCA axes")
+    ap.add_argument("--input", default="./output/arm/arm.npy", help="npy file, directory of npy files, or glob")
+    ap.add_argument("--out_dir", default=None, help="where <stem>_labels.npy go (default: next to the input)")
+    ap.add_argument("--num_axes", type=int, default=1, choices=[1, 2, 3])
+    ap.add_argument("--bins", type=int, default=100)
+    # パラメータ調整のコツ:
+    # - prominence_ratio: くびれを逃すなら下げる (0.1)、ゴミを拾うなら上げる (0.2)
+    # - min_dist_bins: 近すぎる2本線が出るなら値を大きくする (5 -> 10)
+    ap.add_argument("--prominence_ratio", type=float, default=0.15)
+    ap.add_argument("--min_dist_bins", type=int, default=8)
+    ap.add_argument("--min_part_ratio", type=float, default=0.01, help="drop cuts that leave a part with fewer points")
+    ap.add_argument("--batch_size", type=int, default=256, help="clouds per vectorized pass")
+    ap.add_argument("--plot", action="store_true", help="also save <stem>_hist.png (PC1)")
+    ap.add_argument("--with_points", action="store_true", help="also save <stem>_labeled_multi.npy [data, label]")
+    args = ap.parse_args()
+
+    if os.path.isdir(args.input):
+        paths = sorted(glob.glob(os.path.join(args.input, "*.npy")))
+    else:
+        paths = sorted(glob.glob(args.input))
+    paths = [p for p in paths if not p.endswith(("_labels.npy", "_labeled_multi.npy"))]
+    if not paths:
+        print("❌ ファイルが見つかりません。")
+        return
+    if args.out_dir is not None:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    parts = []
+    for start in range(0, len(paths), args.batch_size):
+        batch = paths[start:start + args.batch_size]
+        clouds = [np.load(p) for p in batch]
+        labels, cuts, info = segment_along_principal_axes(
+            clouds, num_axes=args.num_axes, bins=args.bins,
+            prominence_ratio=args.prominence_ratio, min_dist_bins=args.min_dist_bins,
+            min_part_ratio=args.min_part_ratio)
+        skipped = set(info["skipped"])
+        for b, (path, data, lab) in enumerate(zip(batch, clouds, labels)):
+            stem = os.path.splitext(os.path.basename(path))[0]
+            out_dir = args.out_dir or os.path.dirname(path)
+            np.save(os.path.join(out_dir, f"{stem}_labels.npy"), lab)
+            if b in skipped:
+                print(f"⚠️  {path}: {len(data)} points (< {MIN_CLOUD_POINTS}), labeled as a single part")
+                parts.append(1)
+                continue
+            if args.with_points:
+                np.save(os.path.join(out_dir, f"{stem}_labeled_multi.npy"), np.hstack((data, lab.reshape(-1, 1))))
+            if args.plot:
+                plot_histogram(info["hist"][b, 0], info["lo"][b, 0], info["width"][b, 0], cuts[b][0],
+                               os.path.join(out_dir, f"{stem}_hist.png"))
+            parts.append(int(lab.max(initial=0)) + 1)
+        print(f"[{min(start + args.batch_size, len(paths))}/{len(paths)}] clouds labeled")
+
+    print(f"✅ {len(paths)} clouds, parts per cloud: mean {np.mean(parts):.2f}, max {max(parts)}")
+
 
 if __name__ == "__main__":
-    input_npy = "./output/arm/arm.npy"
-    
-    try:
-        # パラメータ調整のコツ:
-        # - prominence_ratio: くびれを逃すなら下げる (0.1)、ゴミを拾うなら上げる (0.2)
-        # - min_dist_bins: 近すぎる2本線が出るなら値を大きくする (5 -> 10)
-        find_boundaries_and_multi_segment(input_npy, prominence_ratio=0.15, min_dist_bins=8)
-        
-    except FileNotFoundError:
-        print("❌ ファイルが見つかりません。")
\ No newline at end of file
+    main()
@@ -1,86 +1,233 @@
+import os
+import glob
+import time
+import argparse
+from multiprocessing import Pool
+
 import numpy as np
-import matplotlib.pyplot as plt
+import matplotlib
 
-def visualize_labeled_pointcloud(npy_path):
-    print(f"📂 Reading: {npy_path}")
-    
-    # データ読み込み [x, y, z, r, g, b, label]
-    try:
-        data = np.load(npy_path)
-    except FileNotFoundError:
-        print("❌ ファイルが見つかりません。パスを確認してください。")
-        return
+# 10 万点超のスキャンを全点 scatter すると数分・数 GB かかるので、
+# ラベルごとにボクセルで間引いて点数を max_points 程度に抑えてから描く（LOD）。
+# バッチではヘッドレス（Agg）でサムネイルを並列に書き出す。
 
-    # 座標とラベルを取得
-    points = data[:, :3]      # [x, y, z]
-    colors_original = data[:, 3:6] 
-    labels = data[:, 6]       # 0, 1, 2, ...
-    
-    # ラベルの種類（パーツ数）を確認
+
+# =============================================================================
+# LOD（ラベルごとのボクセル間引き）
+# =============================================================================
+def voxel_downsample_per_label(points, labels, colors=None, voxel_size=None, max_points=20000, max_iters=8):
+    """
+    (ラベル, ボクセル) ごとに 1 点（位置・色はボクセル内の平均）にまとめる。
+    ラベルをまたいでまとめないので、小さいパーツも最低 1 点は残る。
+    voxel_size が None なら、結果が max_points 以下になる大きさを探す。
+    returns: (points, labels, colors)
+    """
+    points = np.asarray(points, dtype=np.float64)
+    labels = np.asarray(labels)
+    if voxel_size is None and len(points) <= max_points:
+        return points, labels, colors
+
+    label_values, label_idx = np.unique(labels, return_inverse=True)
+    label_idx = label_idx.reshape(-1)
+    lo = points.min(axis=0)
+    extent = max(float((points.max(axis=0) - lo).max()), 1e-12)
+
+    def group(size):
+        grid = np.floor((points - lo) / size).astype(np.int64)
+        dims = grid.max(axis=0) + 1
+        keys = np.ravel_multi_index((label_idx, grid[:, 0], grid[:, 1], grid[:, 2]),
+                                    (len(label_values), dims[0], dims[1], dims[2]))
+        return np.unique(keys, return_inverse=True)
+
+    if voxel_size is not None:
+        keys, inverse = group(voxel_size)
+    else:
+        # 表面の点群なので点数 ~ (extent / size)^2。はみ出したら比の平方根だけ粗くする
+        size = extent / np.sqrt(max_points)
+        for _ in range(max_iters):
+            keys, inverse = group(size)
+            if len(keys) <= max_points:
+                break
+            size *= np.sqrt(len(keys) / max_points) * 1.05
+    inverse = inverse.reshape(-1)
+
+    counts = np.bincount(inverse, minlength=len(keys))[:, None]
+
+    def mean(values):
+        return np.stack([np.bincount(inverse, weights=values[:, i], minlength=len(keys))
+                         for i in range(values.shape[1])], 1) / counts
+
+    # 代表ラベルはボクセルの最初の点のもの（キーにラベルが入っているので全点同じ）
+    first = np.full(len(keys), len(points))
+    np.minimum.at(first, inverse, np.arange(len(points)))
+    out_colors = None if colors is None else mean(np.asarray(colors, dtype=np.float64))
+    return mean(points), labels[first], out_colors
+
+
+def label_colors(labels):
+    import matplotlib.pyplot as plt
+
+    unique_labels = np.unique(labels)
+    # パーツが 10 個を超えたら tab20（ラベル番号で色が決まるので、同じラベルはどの図でも同じ色）
+    cmap = plt.get_cmap("tab10" if unique_labels.max(initial=0) < 10 else "tab20")
+    return np.asarray(cmap(np.asarray(labels, dtype=np.int64) % cmap.N))[:, :3]
+
+
+# =============================================================================
+# 描画
+# =============================================================================
+def render_labeled_pointcloud(points, colors_original, labels, output_img, max_points=20000, figsize=(14, 7),
+                              dpi=150, show=False, point_size=None):
+    import matplotlib.pyplot as plt
+
+    num_input = len(points)
     unique_labels = np.unique(labels)
     num_parts = len(unique_labels)
-    print(f"   -> 検出されたパーツ数: {num_parts} (Labels: {unique_labels})")
+    points, labels, colors_original = voxel_downsample_per_label(points, labels, colors_original, max_points=max_points)
+    # 間引いた分だけ点を大きくして、見た目の密度を揃える
+    s = point_size if point_size is not None else float(np.clip(np.sqrt(num_input / max(len(points), 1)), 1, 6))
 
     # --- 可視化設定 ---
-    fig = plt.figure(figsize=(14, 7))
-    
+    fig = plt.figure(figsize=figsize)
+
     # ==========================================
     # 1. 元の色で表示 (Original Colors)
     # ==========================================
     ax1 = fig.add_subplot(121, projection='3d')
     ax1.set_title("Original Colors")
-    
+
     # ほぼ白の場合は見やすくグレーにする
-    if np.mean(colors_original) > 0.95: 
+    if colors_original is None or np.mean(colors_original) > 0.95:
         c_show = 'gray'
     else:
-        c_show = colors_original
+        c_show = np.clip(colors_original, 0, 1)
 
     # Z-upデータなので、そのまま x, y, z でプロットします
-    ax1.scatter(points[:, 0], points[:, 1], points[:, 2], s=1, c=c_show, alpha=0.5)
-    
-    ax1.set_xlabel('X')
-    ax1.set_ylabel('Y')
-    ax1.set_zlabel('Z (Height)')
-    # 見やすい角度に調整 (Elev=高さ角度, Azim=回転角度)
-    ax1.view_init(elev=20, azim=30) 
+    ax1.scatter(points[:, 0], points[:, 1], points[:, 2], s=s, c=c_show, alpha=0.5, linewidths=0)
 
     # ==========================================
     # 2. セグメンテーション結果 (Segmentation Labels)
     # ==========================================
     ax2 = fig.add_subplot(122, projection='3d')
     ax2.set_title(f"Segmentation Result ({num_parts} Parts)")
-    
-    # --- 【ここが修正ポイント】パーツごとに自動で色を作る ---
-    colors_seg = np.zeros_like(points)
-    
-    # Matplotlibのカラーマップ 'tab10' (10色のパレット) を使用
-    # パーツが10個以上ある場合は 'tab20' に変えてください
-    cmap = plt.get_cmap("tab10") 
-    
-    for i, label in enumerate(unique_labels):
-        # ラベル番号に基づいて色を取得 (RGBAのうちRGBだけ使う)
-        # int(label) % 10 にすることで、ラベルが10を超えても色が循環してエラーにならない
-        color = cmap(int(label) % 10)[:3]
-        
-        # そのラベルを持つ点だけに色を塗る
-        colors_seg[labels == label] = color
-        
-    ax2.scatter(points[:, 0], points[:, 1], points[:, 2], s=1, c=colors_seg, alpha=0.8)
-    
-    ax2.set_xlabel('X')
-    ax2.set_ylabel('Y')
-    ax2.set_zlabel('Z (Height)')
-    ax2.view_init(elev=20, azim=30)
+    ax2.scatter(points[:, 0], points[:, 1], points[:, 2], s=s, c=label_colors(labels), alpha=0.8, linewidths=0)
+
+    for ax in (ax1, ax2):
+        ax.set_xlabel('X')
+        ax.set_ylabel('Y')
+        ax.set_zlabel('Z (Height)')
+        # 見やすい角度に調整 (Elev=高さ角度, Azim=回転角度)
+        ax.view_init(elev=20, azim=30)
+
+    if output_img is not None:
+        plt.savefig(output_img, dpi=dpi)
+    if show:
+        plt.show()
+    plt.close(fig)
+    return len(points)
+
+
+def load_labeled(npy_path):
+    """
+    [x, y, z, r, g, b, label] の npy か、[x, y, z, (r, g, b)] + 隣の <stem>_labels.npy（segment_pointcloud.py の出力）
+    returns: (points, colors or None, labels)
+    """
+    data = np.load(npy_path)
+    if data.shape[1] >= 7:
+        return data[:, :3], data[:, 3:6], data[:, 6]
+    labels_path = npy_path[:-len(".npy")] + "_labels.npy"
+    if not os.path.exists(labels_path):
+        raise ValueError(f"{npy_path} has no label column and no {os.path.basename(labels_path)}")
+    colors = data[:, 3:6] if data.shape[1] >= 6 else None
+    return data[:, :3], colors, np.load(labels_path)
+
+
+def visualize_labeled_pointcloud(npy_path, max_points=20000, show=True):
+    print(f"📂 Reading: {npy_path}")
+
+    # データ読み込み [x, y, z, r, g, b, label]
+    try:
+        points, colors_original, labels = load_labeled(npy_path)
+    except FileNotFoundError:
+        print("❌ ファイルが見つかりません。パスを確認してください。")
+        return
+
+    # ラベルの種類（パーツ数）を確認
+    unique_labels = np.unique(labels)
+    print(f"   -> 検出されたパーツ数: {len(unique_labels)} (Labels: {unique_labels})")
 
     # 保存
     output_img = npy_path.replace(".npy", "_vis.png")
-    plt.savefig(output_img, dpi=150)
+    drawn = render_labeled_pointcloud(points, colors_original, labels, output_img, max_points=max_points, show=show)
+    print(f"   -> 描画点数: {drawn} / {len(points)}")
     print(f"✅ 確認画像を出力しました: {output_img}")
-    plt.show()
 
-if __name__ == "__main__":
+
+# =============================================================================
+# バッチ（サムネイル）
+# =============================================================================
+_CONFIG = None
+
+
+def _init_worker(config):
+    global _CONFIG
+    _CONFIG = config
+    matplotlib.use("Agg")
+
+
+def render_thumbnail(npy_path):
+    cfg = _CONFIG
+    stem = os.path.splitext(os.path.relpath(npy_path, cfg["input_root"]))[0].replace(os.sep, "_")
+    out = os.path.join(cfg["out_dir"], f"{stem}_vis.png")
+    try:
+        points, colors, labels = load_labeled(npy_path)
+        render_labeled_pointcloud(points, colors, labels, out, max_points=cfg["max_points"],
+                                  figsize=cfg["figsize"], dpi=cfg["dpi"])
+        return npy_path, out, None
+    except Exception as e:
+        return npy_path, None, repr(e)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Render labeled point clouds (LOD) to PNG, one file or a whole directory")
     # 複数分割したファイルパス ( _multi.npy ) を指定してください
-    input_npy = "./output/ur3/merge_fixed_joint_ur3_gripper_labeled.npy"
-    
-    visualize_labeled_pointcloud(input_npy)
\ No newline at end of file
+    ap.add_argument("--input", default="./output/ur3/merge_fixed_joint_ur3_gripper_labeled.npy",
+                    help="labeled npy, or a directory searched for **/*.npy (thumbnails)")
+    ap.add_argument("--out_dir", default=None, help="thumbnail directory (default: <input>/thumbnails)")
+    ap.add_argument("--max_points", type=int, default=20000, help="point budget after per-label voxel downsampling")
+    ap.add_argument("--thumb_width", type=float, default=6.0, help="thumbnail width in inches (height is half)")
+    ap.add_argument("--dpi", type=int, default=80)
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    ap.add_argument("--show", action="store_true", help="open a window for a single file")
+    args = ap.parse_args()
+
+    if not os.path.isdir(args.input):
+        if not args.show:
+            matplotlib.use("Agg")
+        visualize_labeled_pointcloud(args.input, max_points=args.max_points, show=args.show)
+        return
+
+    input_root = os.path.abspath(args.input)
+    out_dir = args.out_dir or os.path.join(input_root, "thumbnails")
+    os.makedirs(out_dir, exist_ok=True)
+    paths = [p for p in sorted(glob.glob(os.path.join(input_root, "**", "*.npy"), recursive=True))
+             if not p.endswith("_labels.npy") and not p.startswith(os.path.abspath(out_dir) + os.sep)]
+    config = {"input_root": input_root, "out_dir": out_dir, "max_points": args.max_points,
+              "figsize": (args.thumb_width, args.thumb_width / 2), "dpi": args.dpi}
+
+    num_ok = num_failed = 0
+    start = time.time()
+    with Pool(args.workers, initializer=_init_worker, initargs=(config,)) as pool:
+        for i, (path, out, error) in enumerate(pool.imap_unordered(render_thumbnail, paths, chunksize=4), 1):
+            if error is None:
+                num_ok += 1
+            else:
+                num_failed += 1
+                print(f"❌ {path}: {error}")
+            if i % 100 == 0 or i == len(paths):
+                print(f"[{i}/{len(paths)}] ({i / max(time.time() - start, 1e-6):.1f} images/s)")
+    print(f"✅ ok={num_ok} failed={num_failed} -> {out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ import types
 
 from .llava.model.language_model.llava_llama import (LlavaLlamaForCausalLM,
                                                      LlavaLlamaModel)
+from .llava.model.prefix_cache import PointPrefixCache
 from utils.loss import dice_loss
 from .Uni3D.models.uni3d import create_uni3d
 from utils.pointnet_util import PointNetFeaturePropagation
@@ -184,6 +185,50 @@ class LISAForCausalLM(LlavaLlamaForCausalLM):
         pc_feat = self.seg_emb_head(xyz, centers, H4, H8, H12)
         return pc_feat
 
+    def get_cached_visual_embs(self, points, input_ids, prefix_cache=None, prefix_end=None):
+        if prefix_cache is None:
+            return self.get_visual_embs(points)
+        prefix_end = self.point_prefix_end(input_ids, prefix_end)
+        key = PointPrefixCache.make_key(points, input_ids[0, :prefix_end])
+        entry = prefix_cache.entries.get(key)
+        if entry is not None and "seg_point_feat" in entry.extras:
+            return entry.extras["seg_point_feat"]
+        pc_feat = self.get_visual_embs(points)
+        prefix_cache.attach(key, "seg_point_feat", pc_feat)
+        return pc_feat
+
+    def decode_seg_mask(self, last_hidden, prev_hidden, point_feat):
+        """Turn the hidden state (1, D) that emitted a [SEG] token into a sigmoid mask over `point_feat` (N, C)."""
+        h_seg = self.text_hidden_fcs[0](last_hidden)
+        if self.context_fusion:
+            prev = prev_hidden if prev_hidden is not None else last_hidden
+            h_seg = torch.cat([self.text_hidden_fcs[0](prev), h_seg], dim=-1)
+        logits = self.seg_decoder(h_seg.to(point_feat.dtype), point_feat)
+        return torch.sigmoid(logits)[0]
+
+    @torch.inference_mode()
+    def stream_generate(self, points, colors, input_ids, prefix_cache=None, **generate_kwargs):
+        """
+        Generate the answer for one object and decode a mask as soon as each [SEG] token is
+        emitted, instead of re-running the full sequence with output_hidden_states=True.
+        Yields {"output_ids", "token", "mask"} per step; `mask` is the sigmoid mask over the
+        N input points on [SEG] steps and None otherwise.
+        """
+        points = torch.cat([points, colors], dim=-1)
+        prefix_end = generate_kwargs.get("prefix_end", None)
+        point_feat = None
+        prev_hidden = None
+
+        for output_ids, next_token, last_hidden in self.iter_decode_with_prefix_cache(
+                input_ids, points, prefix_cache=prefix_cache, **generate_kwargs):
+            mask = None
+            if next_token.item() == self.seg_token_idx:
+                if point_feat is None:
+                    point_feat = self.get_cached_visual_embs(points, input_ids, prefix_cache, prefix_end)[0]
+                mask = self.decode_seg_mask(last_hidden, prev_hidden, point_feat)
+            prev_hidden = last_hidden
+            yield {"output_ids": output_ids, "token": next_token, "mask": mask}
+
     def forward(self, **kwargs):
         if "past_key_values" in kwargs:
             return super().forward(**kwargs)
@@ -4,33 +4,61 @@ import argparse
 import jsonlines
 import numpy as np
 from tqdm import tqdm
-import concurrent.futures
 
 
-def get_iou(bbox1, bbox2):
-
-    def calculate_volume(bbox):
-        min_coords = np.min(bbox, axis=0)
-        max_coords = np.max(bbox, axis=0)
-        side_lengths = np.maximum(0.0, max_coords - min_coords)
-        volume = np.prod(side_lengths)
-        return volume
-
-    def calculate_intersection(bbox1, bbox2):
-        min_coords = np.maximum(np.min(bbox1, axis=0), np.min(bbox2, axis=0))
-        max_coords = np.minimum(np.max(bbox1, axis=0), np.max(bbox2, axis=0))
-        side_lengths = np.maximum(0.0, max_coords - min_coords)
-        intersection_volume = np.prod(side_lengths)
-        return intersection_volume
+CATEGORIES = [
+    # "Bucket",
+    # "CoffeeMachine",
+    # "Printer",
+    # "Camera",
+    # "Toaster",
+    "StorageFurniture",
+    "Toilet",
+    "Box",
+    "WashingMachine",
+    "Dishwasher",
+    "Microwave",
+]
+BBOX_PATTERN = re.compile(r"\[\[.*\], \[.*\], \[.*\], \[.*\], \[.*\], \[.*\], \[.*\], \[.*\]\]")
+
+
+def parse_bboxes(model_ans):
+    bboxes = []
+    for pred in model_ans.split("]]"):
+        pred = BBOX_PATTERN.findall(pred + ']]')
+        if len(pred) > 0:
+            bboxes.append(json.loads(pred[0]))
+    return bboxes
+
+
+def to_corners(bbox):
+    """(8, 3) float array, or all-NaN when the box is malformed (its IoU is then 0)."""
+    try:
+        corners = np.asarray(bbox, dtype=np.float64)
+    except (TypeError, ValueError):
+        corners = None
+    if corners is None or corners.shape != (8, 3):
+        return np.full((8, 3), np.nan)
+    return corners
 
-    volume_bbox1 = calculate_volume(bbox1)
-    volume_bbox2 = calculate_volume(bbox2)
 
-    intersection_volume = calculate_intersection(bbox1, bbox2)
-    union_volume = volume_bbox1 + volume_bbox2 - intersection_volume
-    iou = intersection_volume / union_volume if union_volume > 0 else 0.0
-
-    return iou
+def get_iou(bbox1, bbox2):
+    """
+    Axis-aligned IoU of the corner sets, vectorized over leading dimensions:
+    (..., 8, 3) vs (..., 8, 3) -> (...). NaN boxes give 0.
+    """
+    bbox1 = np.asarray(bbox1, dtype=np.float64)
+    bbox2 = np.asarray(bbox2, dtype=np.float64)
+    min1, max1 = bbox1.min(axis=-2), bbox1.max(axis=-2)
+    min2, max2 = bbox2.min(axis=-2), bbox2.max(axis=-2)
+
+    volume1 = np.prod(np.maximum(0.0, max1 - min1), axis=-1)
+    volume2 = np.prod(np.maximum(0.0, max2 - min2), axis=-1)
+    intersection = np.prod(np.maximum(0.0, np.minimum(max1, max2) - np.maximum(min1, min2)), axis=-1)
+    union = volume1 + volume2 - intersection
+    with np.errstate(invalid="ignore", divide="ignore"):
+        iou = np.where(union > 0, intersection / np.where(union > 0, union, 1.0), 0.0)
+    return np.nan_to_num(iou, nan=0.0)
 
 
 def main(args):
@@ -38,85 +66,60 @@ def main(args):
     gt_lines = args.gt_file.readlines()
     assert len(ans_lines) == len(gt_lines)
 
-    output_file = args.output_file
-    open(output_file, 'w').write("")
-
-    ans_dict = {
-        # "Bucket": [],
-        # "CoffeeMachine": [],
-        # "Printer": [],
-        # "Camera": [],
-        # "Toaster": [],
-        "StorageFurniture": [],
-        "Toilet": [],
-        "Box": [],
-        "WashingMachine": [],
-        "Dishwasher": [],
-        "Microwave": [],
-        "Overall": [],
-    }
-    pattern = r"\[\[.*\], \[.*\], \[.*\], \[.*\], \[.*\], \[.*\], \[.*\], \[.*\]\]"
-
-    with tqdm(total=len(ans_lines), desc="Processing tasks", unit="task") as pbar:
-        def process_task(i):
-            model_output = json.loads(ans_lines[i])
-            gt = json.loads(gt_lines[i])
-            question = model_output['prompt']
-            model_ans = model_output['text']
-            gt_ans = gt['text']
-            gt_bboxes = gt['bboxes']
+    # 1. Parse everything once, flattening the (pred, gt) box pairs of all samples.
+    samples = []
+    pred_corners, gt_corners, pair_sample = [], [], []
+    for i in tqdm(range(len(ans_lines)), desc="Parsing", unit="task"):
+        model_output = json.loads(ans_lines[i])
+        gt = json.loads(gt_lines[i])
+        bboxes = parse_bboxes(model_output['text'])
+        gt_bboxes = gt['bboxes']
+        # Predictions beyond the number of ground-truth parts have nothing to match.
+        for j in range(min(len(bboxes), len(gt_bboxes))):
+            pred_corners.append(to_corners(bboxes[j]))
+            gt_corners.append(to_corners(gt_bboxes[j]))
+            pair_sample.append(i)
+        samples.append((model_output, gt))
+
+    # 2. One IoU call over all pairs, then per-sample sums with bincount.
+    num_samples = len(samples)
+    if pred_corners:
+        ious = get_iou(np.stack(pred_corners), np.stack(gt_corners))
+    else:
+        ious = np.zeros(0)
+    pair_sample = np.asarray(pair_sample, dtype=np.int64)
+    iou_sum = np.bincount(pair_sample, weights=ious, minlength=num_samples)
+    hit_sum = np.bincount(pair_sample, weights=(ious > 0.25).astype(np.float64), minlength=num_samples)
+    num_gt = np.array([max(len(gt['bboxes']), 1) for _, gt in samples], dtype=np.float64)
+    miou = np.round(iou_sum / num_gt * 100, 2)
+    acc = np.round(hit_sum / num_gt * 100, 2)
+
+    # 3. Single writer, input order.
+    ans_dict = {category: [] for category in CATEGORIES}
+    ans_dict["Overall"] = []
+    with jsonlines.open(args.output_file, mode='w') as writer:
+        for i, (model_output, gt) in enumerate(samples):
             category = gt['category']
-
-            bboxes = []
-            for pred in model_ans.split("]]"):
-                pred = re.findall(pattern, pred + ']]')
-                if len(pred) > 0:
-                    bbox = json.loads(pred[0])
-                    bboxes.append(bbox)
-
-            iou_list = []
-            acc_list = []
-            for j in range(len(bboxes)):
-                iou = get_iou(bboxes[j], gt_bboxes[j])
-                iou_list.append(iou)
-                if iou > 0.25:
-                    acc_list.append(1)
-                else:
-                    acc_list.append(0)
-            miou = round(sum(iou_list) / len(gt_bboxes) * 100, 2)
-            acc = round(sum(acc_list) / len(gt_bboxes) * 100, 2)
-
-            ans_dict[category].append(acc)
-            ans_dict["Overall"].append(acc)
-
-            data = {
+            ans_dict.setdefault(category, []).append(float(acc[i]))
+            ans_dict["Overall"].append(float(acc[i]))
+            writer.write({
                 "question_id": gt['question_id'],
                 "answer_id": model_output['answer_id'],
-                "question": question,
-                "answer_model": model_ans,
-                "answer_label": gt_ans,
-                "mIoU": miou,
-                "acc": acc,
-            }
-            jsonlines.open(output_file, mode='a').write(data)
-            pbar.update(1)
-            return f"{gt['question_id']} {miou}%"
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_workers) as executor:
-            futures = [executor.submit(process_task, i) for i in range(len(ans_lines))]
-
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    result = future.result()
-                    print("Task completed:", result)
-                except Exception as e:
-                    print("Task encountered an exception:", e)
+                "question": model_output['prompt'],
+                "answer_model": model_output['text'],
+                "answer_label": gt['text'],
+                "mIoU": float(miou[i]),
+                "acc": float(acc[i]),
+            })
 
     category_acc_list = []
     for category in ans_dict:
-        acc = round(sum(ans_dict[category]) / len(ans_dict[category]), 1)
-        category_acc_list.append(acc)
-        print(f"{category} Acc: {acc}%")
+        if not ans_dict[category]:
+            print(f"{category} Acc: n/a (no samples)")
+            continue
+        category_acc = round(sum(ans_dict[category]) / len(ans_dict[category]), 1)
+        category_acc_list.append(category_acc)
+        print(f"{category} Acc: {category_acc}%")
     print(f"Mean Acc: {round(sum(category_acc_list) / len(category_acc_list), 1)}%")
 
 
@@ -125,7 +128,7 @@ if __name__ == "__main__":
     parser.add_argument("--answers-file", type=argparse.FileType('r'), default="tables/answer.jsonl")
     parser.add_argument("--gt-file", type=argparse.FileType('r'), default="tables/gt.jsonl")
     parser.add_argument("--output-file", type=str, default="tables/result.jsonl")
-    parser.add_argument("--max_workers", type=int, default=4)
+    parser.add_argument("--max_workers", type=int, default=4)  # * unused: scoring is a single vectorized pass
     parser.add_argument("--times", type=int, default=5)
     args = parser.parse_args()
 
@@ -2,15 +2,15 @@ import argparse
 from tqdm import tqdm
 
 import torch
-from transformers import StoppingCriteria
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from llava.conversation import conv_templates, SeparatorStyle
 from llava.utils import disable_torch_init
 from llava.model.builder import load_pretrained_model
 from llava.eval.data import ObjectPointCloudDataset
 from llava.eval.evaluator import start_evaluation
-from llava.mm_utils import tokenizer_point_token, get_model_name_from_path
-from llava.constants import POINT_TOKEN_INDEX, DEFAULT_POINT_TOKEN, DEFAULT_PT_START_TOKEN, DEFAULT_PT_END_TOKEN
+from llava.mm_utils import get_model_name_from_path, KeywordsStoppingCriteria, left_pad_input_ids
+from llava.prompt_template import PromptTemplate
+from llava.constants import DEFAULT_POINT_TOKEN
 
 import os
 import json
@@ -22,30 +22,6 @@ PROMPT_LISTS = [
 ]
 
 
-class KeywordsStoppingCriteria(StoppingCriteria):
-    def __init__(self, keywords, tokenizer, input_ids):
-        self.keywords = keywords
-        self.keyword_ids = [tokenizer(keyword).input_ids for keyword in keywords]
-        self.keyword_ids = [keyword_id[0] for keyword_id in self.keyword_ids if
-                            type(keyword_id) is list and len(keyword_id) == 1]
-        self.tokenizer = tokenizer
-        self.start_len = None
-        self.input_ids = input_ids
-
-    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        if self.start_len is None:
-            self.start_len = self.input_ids.shape[1]
-        else:
-            for keyword_id in self.keyword_ids:
-                if output_ids[0, -1] == keyword_id:
-                    return True
-            outputs = self.tokenizer.batch_decode(output_ids[:, self.start_len:], skip_special_tokens=True)[0]
-            for keyword in self.keywords:
-                if keyword in outputs:
-                    return True
-        return False
-
-
 def init_model(args):
     # Model
     disable_torch_init()
@@ -76,65 +52,92 @@ def get_dataloader(dataset, batch_size, shuffle=False, num_workers=4):
     return dataloader
 
 
-def start_generation(model, tokenizer, conv, dataloader, annos, prompt_index, output_dir, output_file):
+def load_finished(partial_path):
+    """Records already written to the JSONL of an interrupted run, keyed by sample index."""
+    finished = {}
+    if os.path.exists(partial_path):
+        with open(partial_path, 'r') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # * truncated last line of a killed run
+                finished[record["sample_index"]] = record
+    return finished
+
+
+def start_generation(model, tokenizer, conv, dataset, annos, prompt_index, output_dir, output_file, batch_size=1, num_workers=4):
     qs = PROMPT_LISTS[prompt_index]
 
     results = {"prompt": qs}
 
-    if model.config.mm_use_pt_start_end:
-        qs = DEFAULT_PT_START_TOKEN + DEFAULT_POINT_TOKEN + DEFAULT_PT_END_TOKEN + '\n' + qs
-    else:
-        qs = DEFAULT_POINT_TOKEN + '\n' + qs
-
-    conv.append_message(conv.roles[0], qs)
-    conv.append_message(conv.roles[1], None)
-    prompt = conv.get_prompt()
+    prompt_template = PromptTemplate(tokenizer, conv, mm_use_pt_start_end=model.config.mm_use_pt_start_end)
+    prompt_ids, _ = prompt_template.encode(DEFAULT_POINT_TOKEN + '\n' + qs)
+    stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
 
-    input_ids = tokenizer_point_token(prompt, tokenizer, POINT_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).cuda()
+    # * results are appended as JSONL per batch, so an interrupted run resumes where it stopped
+    os.makedirs(output_dir, exist_ok=True)
+    partial_path = os.path.join(output_dir, output_file.replace(".json", ".jsonl"))
+    finished = load_finished(partial_path)
+    remaining = [i for i in range(len(dataset)) if i not in finished]
+    print(f"[INFO] {len(finished)} samples already generated, {len(remaining)} remaining.")
+    dataloader = get_dataloader(Subset(dataset, remaining), batch_size, False, num_workers)
+
+    position = 0
+    with open(partial_path, 'a') as partial_fp:
+        for batch in tqdm(dataloader):
+            points = batch["point_clouds"].cuda().to(model.dtype)  # * tensor of B, N, C(3)
+            object_ids = batch["object_ids"]  # * list of string
+            sample_indices = remaining[position:position + len(object_ids)]
+            position += len(object_ids)
+
+            pts_tensor = points.to(model.device, dtype=torch.float16)
+            input_ids, attention_mask = left_pad_input_ids([prompt_ids] * len(object_ids), tokenizer.pad_token_id)
+            input_ids, attention_mask = input_ids.cuda(), attention_mask.cuda()
+            stopping_criteria = KeywordsStoppingCriteria([stop_str], tokenizer, input_ids)
+
+            with torch.inference_mode():
+                output_ids = model.generate(
+                    input_ids,
+                    attention_mask=attention_mask,
+                    points=pts_tensor,
+                    do_sample=True if args.temperature > 0 and args.num_beams == 1 else False,
+                    temperature=args.temperature,
+                    top_k=args.top_k,
+                    top_p=args.top_p,
+                    num_beams=args.num_beams,
+                    max_new_tokens=1024,
+                    pad_token_id=tokenizer.pad_token_id,
+                    stopping_criteria=[stopping_criteria],
+                    use_cache=True)
+
+            input_token_len = input_ids.shape[1]
+            n_diff_input_output = (input_ids != output_ids[:, :input_token_len]).sum().item()
+            if n_diff_input_output > 0:
+                print(f'[Warning] {n_diff_input_output} output_ids are not the same as the input_ids')
+            outputs = tokenizer.batch_decode(output_ids[:, input_token_len:], skip_special_tokens=True)
+            # * rows that stopped early keep decoding until the whole batch is done; cut at the first stop
+            outputs = [output.split(stop_str)[0].strip() for output in outputs]
+
+            # saving results
+            for sample_index, obj_id, output in zip(sample_indices, object_ids, outputs):
+                record = {
+                    "sample_index": sample_index,
+                    "object_id": obj_id,
+                    "ground_truth": annos[obj_id],
+                    "model_output": output
+                }
+                finished[sample_index] = record
+                partial_fp.write(json.dumps(record) + "\n")
+            partial_fp.flush()
 
     responses = []
-
-    for batch in tqdm(dataloader):
-        points = batch["point_clouds"].cuda().to(model.dtype)  # * tensor of B, N, C(3)
-        object_ids = batch["object_ids"]  # * list of string
-
-        pts_tensor = points.to(model.device, dtype=torch.float16)
-
-        stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
-
-        with torch.inference_mode():
-            output_ids = model.generate(
-                input_ids,
-                points=pts_tensor,
-                do_sample=True if args.temperature > 0 and args.num_beams == 1 else False,
-                temperature=args.temperature,
-                top_k=args.top_k,
-                top_p=args.top_p,
-                num_beams=args.num_beams,
-                max_new_tokens=1024,
-                use_cache=True)
-
-        input_token_len = input_ids.shape[1]
-        n_diff_input_output = (input_ids != output_ids[:, :input_token_len]).sum().item()
-        if n_diff_input_output > 0:
-            print(f'[Warning] {n_diff_input_output} output_ids are not the same as the input_ids')
-        outputs = tokenizer.batch_decode(output_ids[:, input_token_len:], skip_special_tokens=True)[0]
-        outputs = outputs.strip()
-        if outputs.endswith(stop_str):
-            outputs = outputs[:-len(stop_str)]
-        outputs = [outputs.strip()]
-
-        # saving results
-        for obj_id, output in zip(object_ids, outputs):
-            responses.append({
-                "object_id": obj_id,
-                "ground_truth": annos[obj_id],
-                "model_output": output
-            })
-
+    for sample_index in sorted(finished):
+        record = dict(finished[sample_index])
+        record.pop("sample_index")
+        responses.append(record)
     results["results"] = responses
 
-    os.makedirs(output_dir, exist_ok=True)
     # save the results to a JSON file
     with open(os.path.join(output_dir, output_file), 'w') as fp:
         json.dump(results, fp, indent=2)
@@ -162,7 +165,7 @@ def main(args):
             annos = json.load(fp)
 
         dataset = load_dataset(args.data_path, args.anno_path, args.pointnum, ("simple_description",), args.use_color)
-        dataloader = get_dataloader(dataset, 1, args.shuffle, args.num_workers)
+        assert args.shuffle is False, "Resuming relies on a fixed sample order, so shuffle should be False."
 
         model, tokenizer, conv = init_model(args)
 
@@ -170,8 +173,8 @@ def main(args):
         annos = {anno["object_id"]: anno["conversations"][1]['value'] for anno in annos}
 
         print(f'[INFO] Start generating results for {args.output_file}.')
-        results = start_generation(model, tokenizer, conv, dataloader, annos, args.prompt_index, args.output_dir,
-                                   args.output_file)
+        results = start_generation(model, tokenizer, conv, dataset, annos, args.prompt_index, args.output_dir,
+                                   args.output_file, args.batch_size, args.num_workers)
 
         # * release model and tokenizer, and release cuda memory
         del model
@@ -211,7 +214,8 @@ if __name__ == "__main__":
     parser.add_argument("--pointnum", type=int, default=10000)
     parser.add_argument("--use_color", action="store_true", default=True)
 
-    # * data loader, shuffle, num_workers
+    # * data loader, batch_size, shuffle, num_workers
+    parser.add_argument("--batch_size", type=int, default=8)
     parser.add_argument("--shuffle", type=bool, default=False)
     parser.add_argument("--num_workers", type=int, default=8)
 
@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+if REPO_ROOT not in sys.path:
+    sys.path.append(REPO_ROOT)
+from utils.reason_seg_dataset import PART_CATEGORIES, read_path_list, load_instruction_and_response
+
+
+MOVABLE_JOINTS = ("revolute", "prismatic", "continuous")
+
+
+def parse_structure(text):
+    """
+    Pull the {"joints": [...], "links": {...}} object out of a model answer.
+    Returns None if there is no parsable structure.
+    """
+    if isinstance(text, dict):
+        return text
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start:
+        return None
+    try:
+        structure = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(structure, dict) or not isinstance(structure.get("joints"), list):
+        return None
+    return structure
+
+
+def part_ious(pred_masks, gt_masks):
+    """
+    pred_masks, gt_masks: (K, N) bool tensors, one row per [SEG] part.
+    Returns (K,) IoU; a part that is empty in both counts as 1.
+    """
+    inter = (pred_masks & gt_masks).sum(dim=1).float()
+    union = (pred_masks | gt_masks).sum(dim=1).float()
+    return torch.where(union > 0, inter / union.clamp(min=1), torch.ones_like(union))
+
+
+def match_joints(pred_joints, gt_joints):
+    """
+    Pair every ground-truth joint with a predicted one: same child link first, then same id,
+    then the unused prediction at the same position. Returns a list aligned with gt_joints (None = missing).
+    """
+    by_child, by_id = {}, {}
+    for i, j in enumerate(pred_joints):
+        by_child.setdefault(j.get("child"), i)
+        by_id.setdefault(j.get("id"), i)
+    used = set()
+    matched = []
+    for pos, gt in enumerate(gt_joints):
+        candidates = [by_child.get(gt.get("child")), by_id.get(gt.get("id")), pos if pos < len(pred_joints) else None]
+        idx = next((c for c in candidates if c is not None and c not in used), None)
+        if idx is not None:
+            used.add(idx)
+        matched.append(None if idx is None else pred_joints[idx])
+    return matched
+
+
+def _vec3(value, default=(0.0, 0.0, 0.0)):
+    try:
+        v = np.asarray(value, dtype=np.float64).reshape(-1)
+        return v[:3] if v.size >= 3 else np.asarray(default, dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.asarray(default, dtype=np.float64)
+
+
+def joint_errors(pred_structure, gt_structure):
+    """
+    Returns one record per ground-truth joint with type_correct, axis_error (deg, sign-agnostic,
+    movable joints only) and origin_error (same units as the URDF).
+    """
+    gt_joints = gt_structure.get("joints", [])
+    pred_joints = pred_structure.get("joints", []) if pred_structure is not None else []
+    matched = match_joints([j for j in pred_joints if isinstance(j, dict)], gt_joints)
+    if not gt_joints:
+        return []
+
+    found = np.array([p is not None for p in matched])
+    gt_axes = np.stack([_vec3(j.get("axis")) for j in gt_joints])
+    gt_xyz = np.stack([_vec3(j.get("origin", {}).get("xyz")) for j in gt_joints])
+    pred_axes = np.stack([_vec3(p.get("axis")) if p is not None else np.zeros(3) for p in matched])
+    pred_xyz = np.stack([_vec3((p.get("origin") or {}).get("xyz")) if p is not None else np.zeros(3) for p in matched])
+
+    # All joints of the object at once: |cos| so that a flipped axis is not an error.
+    norms = np.linalg.norm(gt_axes, axis=1) * np.linalg.norm(pred_axes, axis=1)
+    cos = np.abs((gt_axes * pred_axes).sum(axis=1)) / np.where(norms > 0, norms, 1.0)
+    axis_error = np.where(norms > 0, np.degrees(np.arccos(np.clip(cos, 0.0, 1.0))), 90.0)
+    origin_error = np.linalg.norm(gt_xyz - pred_xyz, axis=1)
+
+    records = []
+    for i, (gt, pred) in enumerate(zip(gt_joints, matched)):
+        rec = {
+            "id": gt.get("id"),
+            "type": gt.get("type"),
+            "matched": bool(found[i]),
+            "pred_type": pred.get("type") if pred is not None else None,
+            "type_correct": bool(found[i]) and pred.get("type") == gt.get("type"),
+        }
+        if found[i]:
+            rec["origin_error"] = float(origin_error[i])
+            if gt.get("type") in MOVABLE_JOINTS:
+                rec["axis_error"] = float(axis_error[i])
+        records.append(rec)
+    return records
+
+
+def load_gt_masks(point_path, part_names):
+    """(K, N) bool masks from the one-hot PART_CATEGORIES columns of a URDFReasoningDataset point file."""
+    cols = [2 + 6 + PART_CATEGORIES.index(name) for name in part_names]
+    if not cols:
+        return np.zeros((0, 0), dtype=bool)
+    data = np.loadtxt(point_path, usecols=cols, ndmin=2)
+    return data.T > 0.5
+
+
+def load_pred_masks(value, base_dir):
+    """Predicted masks are given inline ((K, N) lists) or as a path to .npy / .npz (key 'masks')."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        path = value if os.path.isabs(value) else os.path.join(base_dir, value)
+        if path.endswith(".npz"):
+            with np.load(path) as data:
+                return data["masks"] > 0.5
+        return np.load(path) > 0.5
+    return np.asarray(value) > 0.5
+
+
+def object_category(meta):
+    """
+    Object category of a sample: the "category" written by mine/batch_create_ua.py, else the
+    PartNet-Mobility meta.json ("model_cat") next to the sample's URDF, else "unknown".
+    """
+    if meta.get("category"):
+        return meta["category"]
+    urdf = meta.get("urdf")
+    if urdf:
+        path = os.path.join(os.path.dirname(urdf), "meta.json")
+        try:
+            with open(path, "r") as f:
+                category = json.load(f).get("model_cat")
+            if category:
+                return category
+        except (OSError, ValueError, AttributeError):
+            pass
+    return "unknown"
+
+
+def evaluate_sample(task):
+    gt_json, point_path, pred, pred_dir = task
+    with open(gt_json, "r") as f:
+        meta = json.load(f)
+    part_names = [meta["point_cloud"][key] for key in meta["point_cloud"] if key != "base"]
+    _, answer = load_instruction_and_response(gt_json)
+    gt_structure = parse_structure(answer) or {"joints": []}
+
+    record = {
+        "json_path": gt_json,
+        "category": object_category(meta),
+        "answered": pred is not None,
+    }
+    pred = pred or {}
+    pred_structure = parse_structure(pred.get("text", ""))
+    record["structure_parsed"] = pred_structure is not None
+
+    # Part IoU: one batched op over all [SEG] masks of the object.
+    gt_masks = torch.from_numpy(load_gt_masks(point_path, part_names))
+    pred_masks = load_pred_masks(pred.get("pred_masks"), pred_dir)
+    if pred_masks is None:
+        pred_masks = np.zeros(tuple(gt_masks.shape), dtype=bool)
+    pred_masks = np.atleast_2d(pred_masks)
+    if len(part_names) and pred_masks.shape[1] != gt_masks.shape[1]:
+        raise ValueError(f"{gt_json}: predicted masks have {pred_masks.shape[1]} points, ground truth {gt_masks.shape[1]}")
+    # Missing masks count as empty predictions, extra masks are ignored.
+    padded = np.zeros(tuple(gt_masks.shape), dtype=bool)
+    k = min(len(pred_masks), len(padded))
+    padded[:k] = pred_masks[:k]
+    ious = part_ious(torch.from_numpy(padded), gt_masks).tolist()
+    record["parts"] = [{"category": name, "iou": iou} for name, iou in zip(part_names, ious)]
+    record["mIoU"] = float(np.mean(ious)) if ious else None
+    record["num_pred_masks"] = int(len(pred_masks))
+
+    record["joints"] = joint_errors(pred_structure, gt_structure)
+    return record
+
+
+def evaluate_task(task):
+    """evaluate_sample for the pool: a broken sample becomes an error row instead of ending the run."""
+    try:
+        return evaluate_sample(task)
+    except Exception as e:
+        return {"json_path": task[0], "error": repr(e)}
+
+
+def _init_worker():
+    torch.set_num_threads(1)
+
+
+def _mean(values):
+    return round(float(np.mean(values)), 4) if values else None
+
+
+def _median(values):
+    return round(float(np.median(values)), 4) if values else None
+
+
+def summarize(records):
+    """
+    Overall numbers plus breakdowns by object category, part category and joint type.
+    Error rows are left out of every metric and counted in overall["failed"].
+    """
+    failed = [r for r in records if "error" in r]
+    records = [r for r in records if "error" not in r]
+
+    def block(recs):
+        joints = [j for r in recs for j in r["joints"]]
+        axis = [j["axis_error"] for j in joints if "axis_error" in j]
+        origin = [j["origin_error"] for j in joints if "origin_error" in j]
+        return {
+            "objects": len(recs),
+            "mIoU": _mean([r["mIoU"] for r in recs if r["mIoU"] is not None]),
+            "structure_parse_rate": _mean([float(r["structure_parsed"]) for r in recs]),
+            "joints": len(joints),
+            "joint_type_acc": _mean([float(j["type_correct"]) for j in joints]),
+            "axis_error_mean": _mean(axis),
+            "axis_error_median": _median(axis),
+            "origin_error_mean": _mean(origin),
+            "origin_error_median": _median(origin),
+        }
+
+    by_category = defaultdict(list)
+    for r in records:
+        by_category[r["category"]].append(r)
+
+    part_ious_by_category = defaultdict(list)
+    for r in records:
+        for p in r["parts"]:
+            part_ious_by_category[p["category"]].append(p["iou"])
+
+    joints_by_type = defaultdict(list)
+    for r in records:
+        for j in r["joints"]:
+            joints_by_type[j["type"]].append(j)
+
+    return {
+        "overall": dict(block(records), failed=len(failed)),
+        "by_category": {c: block(rs) for c, rs in sorted(by_category.items())},
+        "by_part": {c: {"parts": len(v), "mIoU": _mean(v)} for c, v in sorted(part_ious_by_category.items())},
+        "by_joint_type": {
+            t: {
+                "joints": len(js),
+                "type_acc": _mean([float(j["type_correct"]) for j in js]),
+                "axis_error_mean": _mean([j["axis_error"] for j in js if "axis_error" in j]),
+                "origin_error_mean": _mean([j["origin_error"] for j in js if "origin_error" in j]),
+            }
+            for t, js in sorted(joints_by_type.items(), key=lambda kv: str(kv[0]))
+        },
+    }
+
+
+def load_predictions(pred_file, json_files):
+    """Predictions keyed by ground-truth json path ("json_path") or by position in the split ("index")."""
+    by_path = {}
+    with open(pred_file, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            pred = json.loads(line)
+            if "json_path" in pred:
+                by_path[os.path.abspath(pred["json_path"])] = pred
+            elif "index" in pred:
+                by_path[os.path.abspath(json_files[int(pred["index"])])] = pred
+    return by_path
+
+
+def main(args):
+    list_dir = os.path.join(args.data_root, "train_test_txt")
+    json_files = read_path_list(os.path.join(list_dir, f"json_{args.split}_{args.task_mode}.txt"))
+    point_files = read_path_list(os.path.join(list_dir, f"point_{args.split}_{args.task_mode}.txt"))
+    assert len(json_files) == len(point_files)
+
+    predictions = load_predictions(args.pred_file, json_files)
+    pred_dir = os.path.dirname(os.path.abspath(args.pred_file))
+    tasks = [(j, p, predictions.get(os.path.abspath(j)), pred_dir) for j, p in zip(json_files, point_files)]
+    if args.subset_nums > 0:
+        tasks = tasks[:args.subset_nums]
+    print(f"Evaluating {len(tasks)} {args.split} samples ({sum(t[2] is not None for t in tasks)} answered).")
+
+    records = []
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_file)), exist_ok=True)
+    # * map keeps the split order, and only this process writes the JSONL
+    with ProcessPoolExecutor(max_workers=args.num_workers, initializer=_init_worker) as executor, \
+            open(args.output_file, "w") as fp:
+        for record in tqdm(executor.map(evaluate_task, tasks, chunksize=args.chunksize), total=len(tasks)):
+            records.append(record)
+            fp.write(json.dumps(record) + "\n")
+
+    summary = summarize(records)
+    summary_file = args.summary_file or os.path.splitext(args.output_file)[0] + "_summary.json"
+    with open(summary_file, "w") as fp:
+        json.dump(summary, fp, indent=2)
+
+    overall = summary["overall"]
+    print(f"mIoU: {overall['mIoU']}  joint type acc: {overall['joint_type_acc']}  "
+          f"axis err (deg): {overall['axis_error_mean']}  origin err: {overall['origin_error_mean']}")
+    if overall["failed"]:
+        print(f"Failed: {overall['failed']} samples failed (see \"error\" rows in {args.output_file})")
+    for category, block in summary["by_category"].items():
+        print(f"  {category:<24} n={block['objects']:<5} mIoU={block['mIoU']}  type acc={block['joint_type_acc']}  "
+              f"axis={block['axis_error_mean']}  origin={block['origin_error_mean']}")
+    print(f"Results: {args.output_file}\nSummary: {summary_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_root", type=str, required=True, help="URDFReasoningDataset root (train_test_txt/...)")
+    parser.add_argument("--split", type=str, default="test")
+    parser.add_argument("--task_mode", type=str, default="all_parameters")
+    parser.add_argument("--pred-file", type=str, required=True,
+                        help="JSONL with json_path (or index), text and pred_masks ((K, N) list or .npy/.npz path)")
+    parser.add_argument("--output-file", type=str, default="tables/urdf_result.jsonl")
+    parser.add_argument("--summary-file", type=str, default=None)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--chunksize", type=int, default=8)
+    parser.add_argument("--subset_nums", type=int, default=-1)  # * only use "subset_nums" of samples, mainly for debug
+    args = parser.parse_args()
+
+    main(args)
@@ -9,8 +9,9 @@ from tqdm import tqdm
 from llava.utils import disable_torch_init
 from llava.model.builder import load_pretrained_model
 from llava.conversation import conv_templates, SeparatorStyle
-from llava.mm_utils import tokenizer_point_token, get_model_name_from_path, load_pts, process_pts
-from llava.constants import POINT_TOKEN_INDEX, DEFAULT_POINT_TOKEN, DEFAULT_PT_START_TOKEN, DEFAULT_PT_END_TOKEN
+from llava.mm_utils import get_model_name_from_path, load_pts, process_pts
+from llava.prompt_template import PromptTemplate
+from llava.constants import DEFAULT_POINT_TOKEN
 
 
 def split_list(lst, n):
@@ -35,22 +36,16 @@ def eval_model(args):
     answers_file = os.path.expanduser(args.answers_file)
     os.makedirs(os.path.dirname(answers_file), exist_ok=True)
     ans_file = open(answers_file, "w")
+    prompt_template = PromptTemplate(tokenizer, conv_templates[args.conv_mode],
+                                     mm_use_pt_start_end=model.config.mm_use_pt_start_end)
+    conv = prompt_template.conv
     for line in tqdm(questions):
         idx = line["question_id"]
         point_file = line["point"]
         qs = line["text"]
         cur_prompt = qs
-        if model.config.mm_use_pt_start_end:
-            qs = DEFAULT_PT_START_TOKEN + DEFAULT_POINT_TOKEN + DEFAULT_PT_END_TOKEN + '\n' + qs
-        else:
-            qs = DEFAULT_POINT_TOKEN + '\n' + qs
-
-        conv = conv_templates[args.conv_mode].copy()
-        conv.append_message(conv.roles[0], qs)
-        conv.append_message(conv.roles[1], None)
-        prompt = conv.get_prompt()
-
-        input_ids = tokenizer_point_token(prompt, tokenizer, POINT_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).cuda()
+        input_ids, _ = prompt_template.encode(DEFAULT_POINT_TOKEN + '\n' + qs)
+        input_ids = torch.tensor(input_ids, dtype=torch.long).unsqueeze(0).cuda()
 
         point = load_pts(os.path.join(args.point_folder, point_file))
         pts_tensor = process_pts(point, model.config).unsqueeze(0)
@@ -1,3 +1,6 @@
+import io
+import base64
+
 import torch
 import numpy as np
 from plyfile import PlyData
@@ -127,6 +130,35 @@ def load_pts(path, separator=',', verbose=False):
     return pcl
 
 
+def load_pts_from_bytes(data, fmt='npy'):
+    if fmt == 'npy':
+        pcl = np.load(io.BytesIO(data), allow_pickle=False)
+    elif fmt == 'ply':
+        vertex = PlyData.read(io.BytesIO(data))['vertex']
+        pcl = np.column_stack([vertex[t] for t in ('x', 'y', 'z')])
+        names = [p.name for p in vertex.properties]
+        if all(c in names for c in ('red', 'green', 'blue')):
+            rgb = np.column_stack([vertex[t] for t in ('red', 'green', 'blue')]).astype(np.float32)
+            if rgb.max() > 1.0:
+                rgb = rgb / 255.0
+            pcl = np.column_stack((pcl, rgb))
+    else:
+        raise ValueError(f'Unsupported point cloud format: {fmt}')
+
+    pcl = np.asarray(pcl, dtype=np.float32)
+    if pcl.ndim == 3:
+        pcl = pcl[0]
+    if pcl.shape[0] in (3, 6) and pcl.shape[-1] not in (3, 6):
+        pcl = pcl.T
+    if pcl.ndim != 2 or pcl.shape[-1] not in (3, 6):
+        raise ValueError(f'Expected an Nx3 or Nx6 point cloud, got {pcl.shape}')
+    return pcl
+
+
+def load_pts_from_base64(pts, fmt='npy'):
+    return load_pts_from_bytes(base64.b64decode(pts), fmt)
+
+
 def pc_norm(pc):
     """ pc: NxC, return NxC """
     centroid = np.mean(pc, axis=0)
@@ -205,9 +237,9 @@ class KeywordsStoppingCriteria(StoppingCriteria):
             self.keyword_ids.append(torch.tensor(cur_keyword_ids))
         self.tokenizer = tokenizer
         self.start_len = input_ids.shape[1]
+        self.stopped = None
 
-    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        assert output_ids.shape[0] == 1, "Only support batch size 1 (yet)"  # TODO
+    def call_for_batch(self, output_ids: torch.LongTensor) -> bool:
         offset = min(output_ids.shape[1] - self.start_len, self.max_keyword_len)
         self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
         for keyword_id in self.keyword_ids:
@@ -218,3 +250,24 @@ class KeywordsStoppingCriteria(StoppingCriteria):
             if keyword in outputs:
                 return True
         return False
+
+    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        # Rows stop independently; `stopped` remembers them so generation ends once every row has.
+        if self.stopped is None or len(self.stopped) != output_ids.shape[0]:
+            self.stopped = [False] * output_ids.shape[0]
+        for i in range(output_ids.shape[0]):
+            if not self.stopped[i]:
+                self.stopped[i] = self.call_for_batch(output_ids[i:i + 1])
+        return all(self.stopped)
+
+
+def left_pad_input_ids(input_ids_list, pad_token_id):
+    """Stack 1-D id tensors/lists into a left-padded (B, L) batch and its attention mask."""
+    input_ids_list = [torch.as_tensor(ids, dtype=torch.long) for ids in input_ids_list]
+    max_len = max(ids.shape[0] for ids in input_ids_list)
+    input_ids = torch.full((len(input_ids_list), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids_list), max_len), dtype=torch.bool)
+    for i, ids in enumerate(input_ids_list):
+        input_ids[i, max_len - ids.shape[0]:] = ids
+        attention_mask[i, max_len - ids.shape[0]:] = True
+    return input_ids, attention_mask
@@ -0,0 +1,67 @@
+import warnings
+
+from .builder import load_non_lora_trainables
+
+
+# Full (non-LoRA) modules trained next to the adapters; see train_lightning.py.
+NON_LORA_MODULES = ("lm_head", "embed_tokens", "text_hidden_fcs", "seg_decoder", "seg_emb_head")
+
+
+class AdapterBank:
+    """
+    Several LoRA adapters on one frozen, unmerged base model. Each adapter brings its own
+    copy of the non-LoRA trainables (lm_head, embed_tokens and the seg head); activating an
+    adapter switches the PEFT adapter and points those parameters at its tensors, so a
+    swap costs no copies and every extra adapter costs only its own weights.
+    """
+    def __init__(self, peft_model, name, model_path):
+        self.model = peft_model
+        self.params = {k: p for k, p in peft_model.get_base_model().named_parameters()
+                       if any(m in k for m in NON_LORA_MODULES)}
+        # The first adapter's trainables were loaded into the live parameters by the builder.
+        self.trainables = {name: {k: p.data for k, p in self.params.items()}}
+        self.paths = {name: model_path}
+        self.default = name
+        self.active = name
+        self.num_swaps = 0
+
+    def add(self, name, model_path):
+        if name in self.trainables:
+            raise ValueError(f"Adapter {name} is already loaded")
+        self.model.load_adapter(model_path, adapter_name=name)
+        state_dict = load_non_lora_trainables(model_path)
+        trainables = {}
+        for k, p in self.params.items():
+            v = state_dict.get(k)
+            if v is None or v.shape != p.shape:
+                warnings.warn(f"Adapter {name} has no {k}; sharing the one of {self.default}")
+                v = self.trainables[self.default][k]
+            trainables[k] = v.to(device=p.device, dtype=p.dtype)
+        self.trainables[name] = trainables
+        self.paths[name] = model_path
+
+    def activate(self, name):
+        if name == self.active:
+            return
+        if name not in self.trainables:
+            raise ValueError(f"Unknown adapter: {name}")
+        self.model.set_adapter(name)
+        for k, v in self.trainables[name].items():
+            self.params[k].data = v
+        self.active = name
+        self.num_swaps += 1
+
+    def names(self):
+        return list(self.trainables)
+
+    def __contains__(self, name):
+        return name in self.trainables
+
+    def stats(self):
+        return {
+            "adapters": self.names(),
+            "active": self.active,
+            "swaps": self.num_swaps,
+            "trainable_bytes": {name: sum(v.numel() * v.element_size() for v in t.values())
+                                for name, t in self.trainables.items()},
+        }
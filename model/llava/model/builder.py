@@ -23,7 +23,27 @@ from llava.model import *
 from llava.constants import DEFAULT_POINT_PATCH_TOKEN, DEFAULT_PT_START_TOKEN, DEFAULT_PT_END_TOKEN
 
 
-def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="auto", device="cuda"):
+def load_non_lora_trainables(model_path):
+    if os.path.exists(os.path.join(model_path, 'non_lora_trainables.bin')):
+        non_lora_trainables = torch.load(os.path.join(model_path, 'non_lora_trainables.bin'), map_location='cpu')
+    else:
+        # this is probably from HF Hub
+        from huggingface_hub import hf_hub_download
+        def load_from_hf(repo_id, filename, subfolder=None):
+            cache_file = hf_hub_download(
+                repo_id=repo_id,
+                filename=filename,
+                subfolder=subfolder)
+            return torch.load(cache_file, map_location='cpu')
+        non_lora_trainables = load_from_hf(model_path, 'non_lora_trainables.bin')
+    non_lora_trainables = {(k[11:] if k.startswith('base_model.') else k): v for k, v in non_lora_trainables.items()}
+    if any(k.startswith('model.model.') for k in non_lora_trainables):
+        non_lora_trainables = {(k[6:] if k.startswith('model.') else k): v for k, v in non_lora_trainables.items()}
+    return non_lora_trainables
+
+
+def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="auto", device="cuda",
+                          merge_lora=True, adapter_name="default"):
     kwargs = {"device_map": device_map}
 
     if load_8bit:
@@ -42,7 +62,7 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
     # Load LLaVA model
     if 'lora' in model_name.lower() and model_base is None:
         warnings.warn('There is `lora` in model name but no `model_base` is provided. If you are loading a LoRA model, please provide the `model_base` argument. Detailed instruction: https://github.com/haotian-liu/LLaVA#launch-a-model-worker-lora-weights-unmerged.')
-    if 'lora' in model_name.lower() and model_base is not None:
+    if ('lora' in model_name.lower() or not merge_lora) and model_base is not None:
         lora_cfg_pretrained = AutoConfig.from_pretrained(model_path)
         tokenizer = AutoTokenizer.from_pretrained(model_base, use_fast=False)
         print('Loading LLaVA from base model...')
@@ -53,28 +73,18 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
             model.model.embed_tokens.weight = torch.nn.Parameter(torch.empty(token_num, tokem_dim, device=model.device, dtype=model.dtype))
 
         print('Loading additional LLaVA weights...')
-        if os.path.exists(os.path.join(model_path, 'non_lora_trainables.bin')):
-            non_lora_trainables = torch.load(os.path.join(model_path, 'non_lora_trainables.bin'), map_location='cpu')
-        else:
-            # this is probably from HF Hub
-            from huggingface_hub import hf_hub_download
-            def load_from_hf(repo_id, filename, subfolder=None):
-                cache_file = hf_hub_download(
-                    repo_id=repo_id,
-                    filename=filename,
-                    subfolder=subfolder)
-                return torch.load(cache_file, map_location='cpu')
-            non_lora_trainables = load_from_hf(model_path, 'non_lora_trainables.bin')
-        non_lora_trainables = {(k[11:] if k.startswith('base_model.') else k): v for k, v in non_lora_trainables.items()}
-        if any(k.startswith('model.model.') for k in non_lora_trainables):
-            non_lora_trainables = {(k[6:] if k.startswith('model.') else k): v for k, v in non_lora_trainables.items()}
+        non_lora_trainables = load_non_lora_trainables(model_path)
         model.load_state_dict(non_lora_trainables, strict=False)
 
         from peft import PeftModel
         print('Loading LoRA weights...')
-        model = PeftModel.from_pretrained(model, model_path)
-        print('Merging LoRA weights...')
-        model = model.merge_and_unload()
+        model = PeftModel.from_pretrained(model, model_path, adapter_name=adapter_name)
+        if merge_lora:
+            print('Merging LoRA weights...')
+            model = model.merge_and_unload()
+        else:
+            # Kept unmerged so more adapters can be loaded next to this one (see adapter_bank.py).
+            print('Keeping LoRA weights unmerged...')
         print('Model is loaded...')
     elif model_base is not None:
         # this may be mm projector only
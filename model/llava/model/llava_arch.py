@@ -21,6 +21,7 @@ import os
 
 from .multimodal_encoder.builder import build_vision_tower
 from .multimodal_projector.builder import build_vision_projector
+from .prefix_cache import PointPrefixCache, PrefixCacheEntry
 
 from llava.constants import IGNORE_INDEX, POINT_TOKEN_INDEX, DEFAULT_POINT_PATCH_TOKEN, DEFAULT_PT_START_TOKEN, \
     DEFAULT_PT_END_TOKEN
@@ -104,14 +105,227 @@ class LlavaMetaForCausalLM(ABC):
         point_features = self.get_model().mm_projector(pos_features, local_features, global_features)
         return point_features
 
+    def build_point_prefix(self, prefix_ids, points):
+        """
+        Prefill the shared prompt prefix once. `prefix_ids` is 1-D and holds a single
+        POINT_TOKEN_INDEX, which is replaced by the projected features of `points` (1, N, C).
+        """
+        point_token_indices = torch.where(prefix_ids == POINT_TOKEN_INDEX)[0]
+        assert point_token_indices.numel() == 1, "prefix must contain exactly one point token"
+        point_token_start = point_token_indices[0]
+
+        point_features = self.encode_points(points)[0]
+        embed_tokens = self.get_model().embed_tokens
+        prefix_embeds = torch.cat([
+            embed_tokens(prefix_ids[:point_token_start]),
+            point_features.to(dtype=embed_tokens.weight.dtype, device=self.device),
+            embed_tokens(prefix_ids[point_token_start + 1:]),
+        ], dim=0).unsqueeze(0)
+
+        outputs = self.get_model()(inputs_embeds=prefix_embeds, use_cache=True, return_dict=True)
+        return PrefixCacheEntry(point_features=point_features,
+                                past_key_values=outputs.past_key_values,
+                                prefix_len=prefix_embeds.shape[1])
+
+    @staticmethod
+    def point_prefix_end(input_ids, prefix_end=None):
+        if prefix_end is None:
+            prefix_end = int(torch.where(input_ids[0] == POINT_TOKEN_INDEX)[0][0]) + 1
+        return prefix_end
+
+    def prefill_with_prefix_cache(self, input_ids, points, prefix_cache=None, prefix_end=None):
+        """
+        Prefill `input_ids` (1, L), reusing the point prefix from `prefix_cache` when the same
+        cloud and prefix were seen before. By default the prefix ends right after the point token,
+        so only the question tokens are run on a hit.
+        Returns (past_key_values, last_hidden_state of the suffix, cache entry).
+        """
+        assert input_ids.shape[0] == 1, "prefix cache only supports batch size 1"
+        prefix_end = self.point_prefix_end(input_ids, prefix_end)
+        prefix_ids, suffix_ids = input_ids[0, :prefix_end], input_ids[0, prefix_end:]
+        assert suffix_ids.numel() > 0, "prompt must contain tokens after the cached prefix"
+
+        key, entry = None, None
+        if prefix_cache is not None:
+            key = PointPrefixCache.make_key(points, prefix_ids)
+            entry = prefix_cache.get(key)
+        if entry is None:
+            entry = self.build_point_prefix(prefix_ids, points)
+            if prefix_cache is not None:
+                prefix_cache.put(key, entry)
+
+        attention_mask = torch.ones((1, entry.prefix_len + suffix_ids.shape[0]), dtype=torch.bool,
+                                    device=input_ids.device)
+        outputs = self.get_model()(input_ids=suffix_ids.unsqueeze(0), attention_mask=attention_mask,
+                                   past_key_values=entry.past_key_values, use_cache=True, return_dict=True)
+        return outputs.past_key_values, outputs.last_hidden_state, entry
+
+    @staticmethod
+    def sample_next_token(logits, temperature=0.0, top_p=None):
+        if temperature < 1e-3:
+            return torch.argmax(logits, dim=-1)
+        probs = torch.softmax(logits.float() / temperature, dim=-1)
+        if top_p is not None and top_p < 1.0:
+            sorted_probs, sorted_indices = torch.sort(probs, descending=True, dim=-1)
+            cum_probs = torch.cumsum(sorted_probs, dim=-1)
+            sorted_probs[cum_probs - sorted_probs > top_p] = 0.0
+            probs = torch.zeros_like(probs).scatter_(-1, sorted_indices, sorted_probs)
+        return torch.multinomial(probs, num_samples=1).squeeze(-1)
+
+    @torch.inference_mode()
+    def iter_decode_with_prefix_cache(self, input_ids, points, prefix_cache=None, prefix_end=None,
+                                      max_new_tokens=512, temperature=0.0, top_p=None,
+                                      stopping_criteria=None, eos_token_id=None):
+        """Yield (output_ids, next_token, last_hidden_state) after every decoded token."""
+        if eos_token_id is None:
+            eos_token_id = self.config.eos_token_id
+        past_key_values, hidden_states, entry = self.prefill_with_prefix_cache(
+            input_ids, points, prefix_cache=prefix_cache, prefix_end=prefix_end)
+        seq_len = past_key_values[0][0].shape[2]
+
+        output_ids = input_ids
+        for _ in range(max_new_tokens):
+            last_hidden = hidden_states[:, -1, :]
+            logits = self.lm_head(last_hidden)
+            next_token = self.sample_next_token(logits, temperature, top_p)
+            output_ids = torch.cat([output_ids, next_token[:, None].to(output_ids.device)], dim=1)
+            yield output_ids, next_token, last_hidden
+
+            if eos_token_id is not None and next_token.item() == eos_token_id:
+                break
+            if stopping_criteria is not None and any(c(output_ids, logits) for c in stopping_criteria):
+                break
+
+            seq_len += 1
+            attention_mask = torch.ones((1, seq_len), dtype=torch.bool, device=input_ids.device)
+            outputs = self.get_model()(input_ids=next_token[:, None], attention_mask=attention_mask,
+                                       past_key_values=past_key_values, use_cache=True, return_dict=True)
+            past_key_values, hidden_states = outputs.past_key_values, outputs.last_hidden_state
+
+    @torch.inference_mode()
+    def generate_with_prefix_cache(self, input_ids, points, prefix_cache=None, **kwargs):
+        output_ids = input_ids
+        for output_ids, _, _ in self.iter_decode_with_prefix_cache(input_ids, points, prefix_cache, **kwargs):
+            pass
+        return output_ids
+
+    @staticmethod
+    def left_pad_past_key_values(past_list):
+        """
+        Merge per-request legacy caches (one (k, v) per layer, batch 1, different lengths)
+        into a single left-padded batch. Returns (past_key_values, attention_mask, lengths).
+        """
+        lengths = [past[0][0].shape[2] for past in past_list]
+        max_len = max(lengths)
+        batched = []
+        for layer_idx in range(len(past_list[0])):
+            layer_kv = []
+            for kv_idx in range(len(past_list[0][layer_idx])):
+                parts = []
+                for past, cur_len in zip(past_list, lengths):
+                    x = past[layer_idx][kv_idx]
+                    if cur_len < max_len:
+                        pad = x.new_zeros(x.shape[:2] + (max_len - cur_len,) + x.shape[3:])
+                        x = torch.cat([pad, x], dim=2)
+                    parts.append(x)
+                layer_kv.append(torch.cat(parts, dim=0))
+            batched.append(tuple(layer_kv))
+
+        device = past_list[0][0][0].device
+        attention_mask = torch.zeros((len(lengths), max_len), dtype=torch.bool, device=device)
+        for i, cur_len in enumerate(lengths):
+            attention_mask[i, max_len - cur_len:] = True
+        return tuple(batched), attention_mask, torch.tensor(lengths, dtype=torch.long, device=device)
+
+    @staticmethod
+    def select_batch_rows(past_key_values, attention_mask, index):
+        """
+        Keep only the batch rows `index` of a legacy cache and its attention mask, dropping the
+        left-padding columns none of the kept rows attends to. Returns (past_key_values, attention_mask).
+        """
+        attention_mask = attention_mask.index_select(0, index)
+        start = int(attention_mask.any(dim=0).long().argmax())
+        past_key_values = tuple(tuple(x.index_select(0, index.to(x.device))[:, :, start:] for x in layer)
+                                for layer in past_key_values)
+        return past_key_values, attention_mask[:, start:]
+
+    @torch.inference_mode()
+    def iter_decode_batch_with_prefix_cache(self, input_ids_list, points_list, prefix_cache=None,
+                                            generate_kwargs_list=None, eos_token_id=None):
+        """
+        Batched counterpart of iter_decode_with_prefix_cache for requests with different prompts
+        and clouds. Each request is prefilled on its own (hitting the prefix cache when possible),
+        the caches are left-padded into one batch and all rows are decoded together.
+        `generate_kwargs_list` holds per-request max_new_tokens / temperature / top_p /
+        stopping_criteria. Yields (row, output_ids, next_token, last_hidden, finished) per active row.
+        A row that finishes (eos, max_new_tokens or a stopping criterion such as a cancelled client)
+        is dropped from the cache before the next forward, so the rest of the batch stops paying for it.
+        """
+        if eos_token_id is None:
+            eos_token_id = self.config.eos_token_id
+        if generate_kwargs_list is None:
+            generate_kwargs_list = [{} for _ in input_ids_list]
+        batch_size = len(input_ids_list)
+
+        past_list, hidden_list = [], []
+        for input_ids, points in zip(input_ids_list, points_list):
+            past_key_values, hidden_states, _ = self.prefill_with_prefix_cache(
+                input_ids, points, prefix_cache=prefix_cache)
+            past_list.append(past_key_values)
+            hidden_list.append(hidden_states[:, -1:, :])
+        past_key_values, attention_mask, position = self.left_pad_past_key_values(past_list)
+        hidden_states = torch.cat(hidden_list, dim=0)
+
+        output_ids = list(input_ids_list)
+        rows = list(range(batch_size))  # batch position -> request index
+        max_steps = max(kw.get("max_new_tokens", 512) for kw in generate_kwargs_list)
+        for step in range(max_steps):
+            last_hidden = hidden_states[:, -1, :]
+            logits = self.lm_head(last_hidden)
+            next_tokens = torch.empty((len(rows),), dtype=torch.long, device=logits.device)
+            keep = []
+            for b, i in enumerate(rows):
+                kw = generate_kwargs_list[i]
+                next_tokens[b] = self.sample_next_token(logits[b:b + 1], kw.get("temperature", 0.0),
+                                                        kw.get("top_p", None))[0]
+                output_ids[i] = torch.cat([output_ids[i], next_tokens[b:b + 1, None].to(output_ids[i].device)], dim=1)
+
+                finished = step + 1 >= kw.get("max_new_tokens", 512)
+                if eos_token_id is not None and next_tokens[b].item() == eos_token_id:
+                    finished = True
+                stopping_criteria = kw.get("stopping_criteria", None)
+                if stopping_criteria is not None and any(c(output_ids[i], logits[b:b + 1]) for c in stopping_criteria):
+                    finished = True
+                if not finished:
+                    keep.append(b)
+                yield i, output_ids[i], next_tokens[b:b + 1], last_hidden[b:b + 1], finished
+
+            if not keep:
+                break
+            if len(keep) < len(rows):
+                index = torch.tensor(keep, dtype=torch.long, device=attention_mask.device)
+                past_key_values, attention_mask = self.select_batch_rows(past_key_values, attention_mask, index)
+                position = position.index_select(0, index)
+                next_tokens = next_tokens.index_select(0, index.to(next_tokens.device))
+                rows = [rows[b] for b in keep]
+
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(rows), 1))], dim=1)
+            outputs = self.get_model()(input_ids=next_tokens[:, None], attention_mask=attention_mask,
+                                       position_ids=position[:, None], past_key_values=past_key_values,
+                                       use_cache=True, return_dict=True)
+            position = position + 1
+            past_key_values, hidden_states = outputs.past_key_values, outputs.last_hidden_state
+
     def prepare_inputs_labels_for_multimodal(
             self, input_ids, attention_mask, past_key_values, labels, points
     ):
         vision_tower = self.get_vision_tower()
         if vision_tower is None or points is None or input_ids.shape[1] == 1:
             if past_key_values is not None and vision_tower is not None and points is not None and input_ids.shape[1] == 1:
-                attention_mask = torch.ones((attention_mask.shape[0], past_key_values[-1][-1].shape[-2] + 1),
-                                            dtype=attention_mask.dtype, device=attention_mask.device)
+                # The caller's mask counts each point token once; everything after the (left) padding
+                # is attended to, so the missing point-feature positions are appended as ones.
+                num_missing = past_key_values[-1][-1].shape[-2] + 1 - attention_mask.shape[1]
+                attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], num_missing))], dim=1)
             return input_ids, attention_mask, past_key_values, None, labels
 
         if type(points) is list:
@@ -196,6 +410,16 @@ class LlavaMetaForCausalLM(ABC):
                 cur_new_labels = torch.cat(cur_new_labels, dim=0)
                 new_labels.append(cur_new_labels)
 
+        if attention_mask is not None:
+            # Expand every point token's mask entry over its point features, so left padding stays in place.
+            expanded_attention_mask = []
+            for cur_input_ids, cur_attention_mask, cur_new_embed in zip(input_ids, attention_mask, new_input_embeds):
+                repeats = torch.ones_like(cur_input_ids)
+                point_token_indices = torch.where(cur_input_ids == POINT_TOKEN_INDEX)[0]
+                if point_token_indices.numel() > 0:
+                    repeats[point_token_indices] = (cur_new_embed.shape[0] - cur_input_ids.shape[0]) // point_token_indices.numel() + 1
+                expanded_attention_mask.append(cur_attention_mask.repeat_interleave(repeats))
+
         if any(x.shape != new_input_embeds[0].shape for x in new_input_embeds):
             max_len = max(x.shape[0] for x in new_input_embeds)
 
@@ -209,7 +433,6 @@ class LlavaMetaForCausalLM(ABC):
 
             if labels is not None:
                 new_labels_align = []
-                _new_labels = new_labels
                 for cur_new_label in new_labels:
                     cur_new_label = torch.cat((cur_new_label,
                                                torch.full((max_len - cur_new_label.shape[0],), IGNORE_INDEX,
@@ -220,28 +443,20 @@ class LlavaMetaForCausalLM(ABC):
 
             if attention_mask is not None:
                 new_attention_mask = []
-                for cur_attention_mask, cur_new_labels, cur_new_labels_align in zip(attention_mask, _new_labels,
-                                                                                    new_labels):
-                    new_attn_mask_pad_left = torch.full((cur_new_labels.shape[0] - labels.shape[1],), True,
-                                                        dtype=attention_mask.dtype, device=attention_mask.device)
-                    new_attn_mask_pad_right = torch.full((cur_new_labels_align.shape[0] - cur_new_labels.shape[0],),
+                for cur_attention_mask in expanded_attention_mask:
+                    new_attn_mask_pad_right = torch.full((max_len - cur_attention_mask.shape[0],),
                                                          False, dtype=attention_mask.dtype,
                                                          device=attention_mask.device)
-                    cur_new_attention_mask = torch.cat(
-                        (new_attn_mask_pad_left, cur_attention_mask, new_attn_mask_pad_right), dim=0)
-                    new_attention_mask.append(cur_new_attention_mask)
+                    new_attention_mask.append(torch.cat((cur_attention_mask, new_attn_mask_pad_right), dim=0))
                 attention_mask = torch.stack(new_attention_mask, dim=0)
-                assert attention_mask.shape == new_labels.shape
+                assert attention_mask.shape == new_input_embeds.shape[:2]
         else:
             new_input_embeds = torch.stack(new_input_embeds, dim=0)
             if labels is not None:
                 new_labels = torch.stack(new_labels, dim=0)
 
             if attention_mask is not None:
-                new_attn_mask_pad_left = torch.full(
-                    (attention_mask.shape[0], new_input_embeds.shape[1] - input_ids.shape[1]), True,
-                    dtype=attention_mask.dtype, device=attention_mask.device)
-                attention_mask = torch.cat((new_attn_mask_pad_left, attention_mask), dim=1)
+                attention_mask = torch.stack(expanded_attention_mask, dim=0)
                 assert attention_mask.shape == new_input_embeds.shape[:2]
 
         return None, attention_mask, past_key_values, new_input_embeds, new_labels
@@ -0,0 +1,116 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+
+
+GB = 1 << 30
+
+
+def _nbytes(obj):
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(x) for x in obj)
+    if isinstance(obj, dict):
+        return sum(_nbytes(x) for x in obj.values())
+    return 0
+
+
+@dataclass
+class PrefixCacheEntry:
+    """Prefill state shared by every question asked about one point cloud."""
+    point_features: torch.Tensor
+    past_key_values: Tuple[Tuple[torch.Tensor, ...], ...]
+    prefix_len: int
+    extras: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def nbytes(self):
+        return _nbytes(self.point_features) + _nbytes(self.past_key_values) + _nbytes(self.extras)
+
+
+class PointPrefixCache:
+    """
+    LRU cache of projected point embeddings and LLM past_key_values, keyed by
+    a hash of the point cloud and the prompt prefix ids that precede the question.
+    Entries are evicted oldest-first once `max_bytes` is exceeded.
+    """
+    def __init__(self, max_bytes=4 * GB):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(points, prefix_ids):
+        h = hashlib.sha1()
+        h.update(points.detach().float().cpu().contiguous().numpy().tobytes())
+        h.update(prefix_ids.detach().cpu().to(torch.long).contiguous().numpy().tobytes())
+        return h.hexdigest()
+
+    def get(self, key) -> Optional[PrefixCacheEntry]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry: PrefixCacheEntry):
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key).nbytes
+        size = entry.nbytes
+        if size > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.total_bytes += size
+        self._evict()
+
+    def attach(self, key, name, value):
+        """Store an extra tensor (e.g. segmentation point features) on an existing entry."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        old_size = entry.nbytes
+        previous = entry.extras.get(name)
+        entry.extras[name] = value
+        if entry.nbytes > self.max_bytes:
+            # like put: an entry that cannot fit on its own is not grown
+            if previous is None:
+                del entry.extras[name]
+            else:
+                entry.extras[name] = previous
+            return
+        self.total_bytes += entry.nbytes - old_size
+        self.entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries until within max_bytes; the newest entry is kept."""
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, old = self.entries.popitem(last=False)
+            self.total_bytes -= old.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
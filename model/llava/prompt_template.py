@@ -0,0 +1,177 @@
+"""
+Precompiled single-turn conversation prompts.
+
+`Conversation.get_prompt()` + `tokenizer_point_token()` rebuild and re-tokenize the
+system prompt and role separators for every sample. PromptTemplate renders the
+conversation once with marker messages, tokenizes the fixed segments once and then
+assembles input ids by concatenating cached ids around the per-sample question and
+answer ids. The first `verify_first` prompts (and any prompt whose boundaries are
+not safe to split) are checked against / routed through the string path, so the
+ids are always identical to what the string path produces.
+"""
+import logging
+
+from llava.constants import POINT_TOKEN_INDEX, DEFAULT_POINT_TOKEN, DEFAULT_PT_START_TOKEN, DEFAULT_PT_END_TOKEN
+from llava.mm_utils import tokenizer_point_token
+
+
+logger = logging.getLogger(__name__)
+
+QUESTION_MARKER = "\x00QUESTION\x00"
+ANSWER_MARKER = "\x00ANSWER\x00"
+# Any short text that ends on a token boundary; continuation ids are taken relative to it.
+ANCHOR = "."
+
+
+class PromptTemplate:
+    def __init__(self, tokenizer, conv, mm_use_pt_start_end=False, point_token_index=POINT_TOKEN_INDEX,
+                 verify_first=64):
+        self.tokenizer = tokenizer
+        self.conv = conv.copy()
+        self.conv.messages = []
+        self.mm_use_pt_start_end = mm_use_pt_start_end
+        self.point_token_index = point_token_index
+        self.verify_first = verify_first
+        self.num_encoded = 0
+        self.num_fallbacks = 0
+        self.enabled = True
+
+        # "{system} USER: " | question | " ASSISTANT:" | " " answer "</s>"
+        train_text = self.render(QUESTION_MARKER, ANSWER_MARKER, replace=False)
+        prefix, rest = train_text.split(QUESTION_MARKER)
+        qa_sep, self.suffix = rest.split(ANSWER_MARKER)
+        self.prefix = prefix
+        self.qa_sep = qa_sep.rstrip()
+        self.answer_lead = qa_sep[len(self.qa_sep):]
+        gen_text = self.render(QUESTION_MARKER, None, replace=False)
+        gen_prefix, self.gen_suffix = gen_text.split(QUESTION_MARKER)
+        if gen_prefix != prefix:
+            self.enabled = False
+
+        self.anchor_ids = tokenizer(ANCHOR).input_ids
+        self.offset = 1 if self.anchor_ids and self.anchor_ids[0] == tokenizer.bos_token_id else 0
+        self.qa_sep_ids = self.continuation_ids(self.qa_sep)
+        self.suffix_ids = self.continuation_ids(self.suffix)
+        self.gen_suffix_ids = self.continuation_ids(self.gen_suffix)
+        self.prefix_ids = {}
+
+    def render(self, user_message, answer=None, replace=True):
+        """The string path: the prompt exactly as Conversation.get_prompt() builds it."""
+        if replace and self.mm_use_pt_start_end:
+            user_message = user_message.replace(
+                DEFAULT_POINT_TOKEN, DEFAULT_PT_START_TOKEN + DEFAULT_POINT_TOKEN + DEFAULT_PT_END_TOKEN)
+        conv = self.conv.copy()
+        conv.append_message(conv.roles[0], user_message)
+        conv.append_message(conv.roles[1], answer)
+        return conv.get_prompt()
+
+    def continuation_ids(self, text):
+        """Ids of `text` when it follows other text, i.e. without BOS or a leading dummy space."""
+        ids = self.tokenizer(ANCHOR + text).input_ids
+        if ids[:len(self.anchor_ids)] != self.anchor_ids:
+            self.enabled = False
+        return ids[len(self.anchor_ids):]
+
+    def string_path(self, user_message, answer=None):
+        """(input_ids, instruction_len) computed from the rendered string, as collate_fn does."""
+        input_ids = tokenizer_point_token(self.render(user_message, answer), self.tokenizer, self.point_token_index)
+        if answer is None:
+            return input_ids, len(input_ids)
+        instruction = self.render(user_message, ANSWER_MARKER).split(ANSWER_MARKER)[0]
+        instruction_len = len(tokenizer_point_token(instruction, self.tokenizer, self.point_token_index)) - 1
+        return input_ids, instruction_len
+
+    def is_safe(self, user_message, answer):
+        if user_message.count(DEFAULT_POINT_TOKEN) != 1:
+            return False
+        question = user_message.split(DEFAULT_POINT_TOKEN)[1]
+        if not question or question[-1].isspace():
+            return False
+        if answer is not None and (not answer or answer[0].isspace() or answer[-1].isspace()):
+            return False
+        return True
+
+    def encode(self, user_message, answer=None):
+        """
+        Returns (input_ids, instruction_len) for a single-turn prompt. `user_message` contains
+        one <point>; without `answer` the ids end at the assistant role, ready for generation.
+        instruction_len counts the leading ids that are masked out of the labels.
+        """
+        if not self.enabled or not self.is_safe(user_message, answer):
+            self.num_fallbacks += 1
+            return self.string_path(user_message, answer)
+
+        message = user_message
+        if self.mm_use_pt_start_end:
+            message = message.replace(
+                DEFAULT_POINT_TOKEN, DEFAULT_PT_START_TOKEN + DEFAULT_POINT_TOKEN + DEFAULT_PT_END_TOKEN)
+        before, after = message.split(DEFAULT_POINT_TOKEN)
+        prefix_ids = self.prefix_ids.get(before)
+        if prefix_ids is None:
+            prefix_ids = self.prefix_ids[before] = self.tokenizer(self.prefix + before).input_ids
+
+        input_ids = prefix_ids + [self.point_token_index] + self.tokenizer(after).input_ids[self.offset:]
+        if answer is None:
+            input_ids = input_ids + self.gen_suffix_ids
+            instruction_len = len(input_ids)
+        else:
+            input_ids = input_ids + self.qa_sep_ids
+            instruction_len = len(input_ids)
+            input_ids = input_ids + self.continuation_ids(self.answer_lead + answer) + self.suffix_ids
+
+        if self.num_encoded < self.verify_first:
+            expected = self.string_path(user_message, answer)
+            if expected != (input_ids, instruction_len):
+                logger.warning("PromptTemplate ids differ from the string path; falling back to it")
+                self.enabled = False
+                self.num_fallbacks += 1
+                return expected
+        self.num_encoded += 1
+        return input_ids, instruction_len
+
+    def check(self, pairs):
+        """Exact-match the precompiled path against the string path for (user_message, answer) pairs."""
+        mismatches = []
+        for user_message, answer in pairs:
+            if not self.is_safe(user_message, answer):
+                continue
+            enabled, verify_first = self.enabled, self.verify_first
+            self.verify_first = 0
+            try:
+                fast = self.encode(user_message, answer)
+            finally:
+                self.enabled, self.verify_first = enabled, verify_first
+            if fast != self.string_path(user_message, answer):
+                mismatches.append((user_message, answer))
+        return mismatches
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from transformers import AutoTokenizer
+    from llava.conversation import conv_templates
+
+    parser = argparse.ArgumentParser(description="Exact-match PromptTemplate against the string path")
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--json-list", type=str, required=True, help="train_test_txt/json_{split}_{task_mode}.txt")
+    parser.add_argument("--conv-mode", type=str, default="vicuna_v1")
+    parser.add_argument("--mm-use-pt-start-end", action="store_true")
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_fast=False)
+    template = PromptTemplate(tokenizer, conv_templates[args.conv_mode], args.mm_use_pt_start_end)
+    with open(args.json_list) as f:
+        paths = [line.strip() for line in f if line.strip()][:args.limit]
+    pairs = []
+    for path in paths:
+        with open(path) as f:
+            content = json.load(f)
+        pairs.append((DEFAULT_POINT_TOKEN + "\n" + content["question"], content["answer"]))
+    pairs += [(user_message, None) for user_message, _ in pairs]
+    mismatches = template.check(pairs)
+    print(f"{len(pairs) - len(mismatches)}/{len(pairs)} prompts match the string path")
+    for user_message, answer in mismatches[:10]:
+        print(repr(user_message), repr(answer))
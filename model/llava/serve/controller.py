@@ -20,14 +20,20 @@ import uvicorn
 
 from llava.constants import CONTROLLER_HEART_BEAT_EXPIRATION
 from llava.utils import build_logger, server_error_msg
+from llava.serve.wire import CONTENT_TYPE, pack_frame, peek_meta
 
 
 logger = build_logger("controller", "controller.log")
 
+DEFAULT_NEW_TOKENS = 256
+MIN_GPU_FREE_RATIO = 0.05
+LOW_MEMORY_PENALTY = 4.0
+
 
 class DispatchMethod(Enum):
     LOTTERY = auto()
     SHORTEST_QUEUE = auto()
+    LEAST_COMPLETION_TIME = auto()
 
     @classmethod
     def from_str(cls, name):
@@ -35,6 +41,8 @@ class DispatchMethod(Enum):
             return cls.LOTTERY
         elif name == "shortest_queue":
             return cls.SHORTEST_QUEUE
+        elif name == "least_completion_time":
+            return cls.LEAST_COMPLETION_TIME
         else:
             raise ValueError(f"Invalid dispatch method")
 
@@ -46,6 +54,8 @@ class WorkerInfo:
     queue_length: int
     check_heart_beat: bool
     last_heart_beat: str
+    metrics: dict = dataclasses.field(default_factory=dict)
+    dispatched: int = 0
 
 
 def heart_beat_controller(controller):
@@ -80,7 +90,7 @@ class Controller:
 
         self.worker_info[worker_name] = WorkerInfo(
             worker_status["model_names"], worker_status["speed"], worker_status["queue_length"],
-            check_heart_beat, time.time())
+            check_heart_beat, time.time(), worker_status.get("metrics", {}))
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
@@ -167,15 +177,46 @@ class Controller:
             self.worker_info[w_name].queue_length += 1
             logger.info(f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}")
             return w_name
+        elif self.dispatch_method == DispatchMethod.LEAST_COMPLETION_TIME:
+            worker_names = []
+            worker_eta = []
+            for w_name, w_info in self.worker_info.items():
+                if model_name in w_info.model_names:
+                    worker_names.append(w_name)
+                    worker_eta.append(self.expected_completion_time(w_info))
+            if len(worker_names) == 0:
+                return ""
+            min_index = np.argmin(worker_eta)
+            w_name = worker_names[min_index]
+            self.worker_info[w_name].dispatched += 1
+            logger.info(f"names: {worker_names}, etas: {worker_eta}, ret: {w_name}")
+            return w_name
         else:
             raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
 
-    def receive_heart_beat(self, worker_name: str, queue_length: int):
+    def expected_completion_time(self, w_info: WorkerInfo):
+        # Work ahead of a new request: what the worker reported at its last heart beat
+        # plus whatever we sent it since, all drained at the measured aggregate tokens/sec.
+        metrics = w_info.metrics
+        tokens_per_sec = metrics.get("tokens_per_sec") or w_info.speed or 1.0
+        new_tokens = metrics.get("avg_new_tokens") or DEFAULT_NEW_TOKENS
+        pending = w_info.queue_length + w_info.dispatched + 1
+        eta = pending * new_tokens / tokens_per_sec
+
+        gpu_total = metrics.get("gpu_total_bytes", 0)
+        if gpu_total and metrics.get("gpu_free_bytes", 0) / gpu_total < MIN_GPU_FREE_RATIO:
+            eta *= LOW_MEMORY_PENALTY
+        return eta
+
+    def receive_heart_beat(self, worker_name: str, queue_length: int, metrics: dict = None):
         if worker_name not in self.worker_info:
             logger.info(f"Receive unknown heart beat. {worker_name}")
             return False
 
         self.worker_info[worker_name].queue_length = queue_length
+        self.worker_info[worker_name].dispatched = 0
+        if metrics is not None:
+            self.worker_info[worker_name].metrics = metrics
         self.worker_info[worker_name].last_heart_beat = time.time()
         logger.info(f"Receive heart beat. {worker_name}")
         return True
@@ -214,6 +255,24 @@ class Controller:
             }
             yield json.dumps(ret).encode() + b"\0"
 
+    def worker_api_generate_stream_binary(self, body):
+        params = peek_meta(body)
+        worker_addr = self.get_worker_address(params["model"])
+        if not worker_addr:
+            logger.info(f"no worker: {params['model']}")
+            yield pack_frame({"text": server_error_msg, "error_code": 2})
+            return
+
+        try:
+            response = requests.post(worker_addr + "/worker_generate_stream_binary",
+                data=body, headers={"Content-Type": CONTENT_TYPE}, stream=True, timeout=5)
+            for chunk in response.iter_content(chunk_size=None):
+                if chunk:
+                    yield chunk
+        except requests.exceptions.RequestException as e:
+            logger.info(f"worker timeout: {worker_addr}")
+            yield pack_frame({"text": server_error_msg, "error_code": 3})
+
 
     # Let the controller act as a worker to achieve hierarchical
     # management. This can be used to connect isolated sub networks.
@@ -269,7 +328,7 @@ async def get_worker_address(request: Request):
 async def receive_heart_beat(request: Request):
     data = await request.json()
     exist = controller.receive_heart_beat(
-        data["worker_name"], data["queue_length"])
+        data["worker_name"], data["queue_length"], data.get("metrics", None))
     return {"exist": exist}
 
 
@@ -280,6 +339,13 @@ async def worker_api_generate_stream(request: Request):
     return StreamingResponse(generator)
 
 
+@app.post("/worker_generate_stream_binary")
+async def worker_api_generate_stream_binary(request: Request):
+    body = await request.body()
+    generator = controller.worker_api_generate_stream_binary(body)
+    return StreamingResponse(generator, media_type=CONTENT_TYPE)
+
+
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
     return controller.worker_api_get_status()
@@ -290,7 +356,7 @@ if __name__ == "__main__":
     parser.add_argument("--host", type=str, default="localhost")
     parser.add_argument("--port", type=int, default=21001)
     parser.add_argument("--dispatch-method", type=str, choices=[
-        "lottery", "shortest_queue"], default="shortest_queue")
+        "lottery", "shortest_queue", "least_completion_time"], default="shortest_queue")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
@@ -0,0 +1,184 @@
+"""
+A fake model worker for testing controller dispatch under synthetic load.
+It speaks the same protocol as model_worker.py but simulates a batched GPU:
+every decode step takes 1 / step_rate seconds regardless of batch size, so
+aggregate tokens/sec grows with occupancy up to --max-batch-size.
+"""
+import argparse
+import json
+import queue
+import random
+import threading
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+import requests
+import uvicorn
+
+from llava.constants import WORKER_HEART_BEAT_INTERVAL
+from llava.utils import build_logger
+
+
+worker_id = str(uuid.uuid4())[:6]
+logger = build_logger("fake_worker", f"fake_worker_{worker_id}.log")
+
+
+def heart_beat_worker(worker):
+    while True:
+        time.sleep(WORKER_HEART_BEAT_INTERVAL)
+        worker.send_heart_beat()
+
+
+class FakeWorker:
+    def __init__(self, controller_addr, worker_addr, model_name, no_register,
+                 step_rate, max_batch_size, batch_wait_ms, gpu_total_gb, gb_per_request):
+        self.controller_addr = controller_addr
+        self.worker_addr = worker_addr
+        self.model_name = model_name
+        self.step_rate = step_rate
+        self.max_batch_size = max_batch_size
+        self.max_wait = batch_wait_ms / 1000.0
+        self.gpu_total = gpu_total_gb * (1 << 30)
+        self.bytes_per_request = gb_per_request * (1 << 30)
+
+        self.queue = queue.Queue()
+        self.in_flight = 0
+        self.num_batches = 0
+        self.num_requests = 0
+        self.num_new_tokens = 0
+        self.tokens_per_sec = 0.0
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+        if not no_register:
+            self.register_to_controller()
+            self.heart_beat_thread = threading.Thread(target=heart_beat_worker, args=(self,), daemon=True)
+            self.heart_beat_thread.start()
+
+    def register_to_controller(self):
+        r = requests.post(self.controller_addr + "/register_worker", json={
+            "worker_name": self.worker_addr,
+            "check_heart_beat": True,
+            "worker_status": self.get_status(),
+        })
+        assert r.status_code == 200
+
+    def send_heart_beat(self):
+        metrics = self.get_metrics()
+        try:
+            ret = requests.post(self.controller_addr + "/receive_heart_beat", json={
+                "worker_name": self.worker_addr,
+                "queue_length": metrics["queue_length"],
+                "metrics": metrics}, timeout=5)
+            if not ret.json()["exist"]:
+                self.register_to_controller()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"heart beat error: {e}")
+
+    def get_metrics(self):
+        used = self.in_flight * self.bytes_per_request
+        return {
+            "queue_length": self.queue.qsize() + self.in_flight,
+            "in_flight": self.in_flight,
+            "batch_size": self.in_flight,
+            "avg_batch_size": self.num_requests / self.num_batches if self.num_batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "tokens_per_sec": self.tokens_per_sec,
+            "avg_new_tokens": self.num_new_tokens / self.num_requests if self.num_requests else 0.0,
+            "gpu_free_bytes": max(self.gpu_total - used, 0),
+            "gpu_total_bytes": self.gpu_total,
+        }
+
+    def get_status(self):
+        metrics = self.get_metrics()
+        return {
+            "model_names": [self.model_name],
+            "speed": max(metrics["tokens_per_sec"], 1),
+            "queue_length": metrics["queue_length"],
+            "metrics": metrics,
+        }
+
+    def loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.in_flight = len(batch)
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            start, num_tokens = time.time(), 0
+            remaining_tokens = [n for n, _ in batch]
+            step = 0
+            while any(n > step for n in remaining_tokens):
+                time.sleep(1.0 / self.step_rate)
+                step += 1
+                for n, out in batch:
+                    if n >= step:
+                        num_tokens += 1
+                        out.put({"text": " ".join(["tok"] * step), "error_code": 0})
+            for _, out in batch:
+                out.put(None)
+
+            elapsed = time.time() - start
+            self.num_new_tokens += num_tokens
+            if elapsed > 0 and num_tokens > 0:
+                speed = num_tokens / elapsed
+                self.tokens_per_sec = speed if self.tokens_per_sec == 0 else 0.8 * self.tokens_per_sec + 0.2 * speed
+            self.in_flight = 0
+
+    def generate_stream(self, params):
+        max_new_tokens = int(params.get("max_new_tokens", 64))
+        num_tokens = random.randint(max(1, max_new_tokens // 2), max_new_tokens)
+        out = queue.Queue()
+        self.queue.put((num_tokens, out))
+        while True:
+            ret = out.get()
+            if ret is None:
+                break
+            yield json.dumps(ret).encode() + b"\0"
+
+
+app = FastAPI()
+
+
+@app.post("/worker_generate_stream")
+async def generate_stream(request: Request):
+    params = await request.json()
+    return StreamingResponse(worker.generate_stream(params))
+
+
+@app.post("/worker_get_status")
+async def get_status(request: Request):
+    return worker.get_status()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=21102)
+    parser.add_argument("--worker-address", type=str, default="http://localhost:21102")
+    parser.add_argument("--controller-address", type=str, default="http://localhost:21001")
+    parser.add_argument("--model-name", type=str, default="fake-model")
+    parser.add_argument("--no-register", action="store_true")
+    parser.add_argument("--step-rate", type=float, default=20.0, help="decode steps per second")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--batch-wait-ms", type=float, default=10)
+    parser.add_argument("--gpu-total-gb", type=float, default=24)
+    parser.add_argument("--gb-per-request", type=float, default=0.6)
+    args = parser.parse_args()
+    logger.info(f"args: {args}")
+
+    worker = FakeWorker(args.controller_address, args.worker_address, args.model_name, args.no_register,
+                        args.step_rate, args.max_batch_size, args.batch_wait_ms,
+                        args.gpu_total_gb, args.gb_per_request)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -3,26 +3,30 @@ A model worker executes the model.
 """
 import argparse
 import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import json
 import time
 import threading
 import uuid
+from dataclasses import dataclass, field
 
-from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
 import requests
+import numpy as np
 import torch
 import uvicorn
-from functools import partial
 
 from llava.constants import WORKER_HEART_BEAT_INTERVAL
-from llava.utils import (build_logger, server_error_msg,
-    pretty_print_semaphore)
+from llava.utils import build_logger, server_error_msg
 from llava.model.builder import load_pretrained_model
-from llava.mm_utils import process_images, load_image_from_base64, tokenizer_image_token, KeywordsStoppingCriteria
+from llava.model.adapter_bank import AdapterBank
+from llava.model.prefix_cache import PointPrefixCache
+from llava.serve.result_cache import ResultCache, masks_to_voxels, voxels_to_points
+from llava.serve.wire import CONTENT_TYPE, decode_points, encode_mask, pack_frame, unpack_frame
+from llava.mm_utils import load_pts_from_base64, process_pts, tokenizer_point_token, KeywordsStoppingCriteria
 from llava.constants import POINT_TOKEN_INDEX, DEFAULT_POINT_TOKEN, DEFAULT_PT_START_TOKEN, DEFAULT_PT_END_TOKEN
-from transformers import TextIteratorStreamer
-from threading import Thread
 
 
 GB = 1 << 30
@@ -31,8 +35,6 @@ worker_id = str(uuid.uuid4())[:6]
 logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
 global_counter = 0
 
-model_semaphore = None
-
 
 def heart_beat_worker(controller):
 
@@ -41,11 +43,161 @@ def heart_beat_worker(controller):
         controller.send_heart_beat()
 
 
+@dataclass
+class PointRequest:
+    input_ids: torch.Tensor
+    points: torch.Tensor
+    generate_kwargs: dict
+    prompt: str
+    stop_str: str
+    sample_indices: np.ndarray = None
+    adapter: str = None
+    output: asyncio.Queue = None
+    loop: asyncio.AbstractEventLoop = None
+    cancelled: bool = False
+    created: float = field(default_factory=time.time)
+
+    def emit(self, ret):
+        """Called from the GPU thread; hands `ret` to the request's event loop."""
+        self.loop.call_soon_threadsafe(self.output.put_nowait, ret)
+
+
+class CancelledCriteria:
+    """Stopping criterion that finishes a batch row as soon as its client has gone away."""
+    def __init__(self, request):
+        self.request = request
+
+    def __call__(self, output_ids, scores, **kwargs):
+        return self.request.cancelled
+
+
+class InferenceLoop:
+    """
+    Single owner of the GPU, running as one asyncio task. Requests arrive on an
+    asyncio.Queue; up to `max_batch_size` of them are collected for `max_wait`
+    seconds and decoded as one batch on a dedicated thread, so the event loop
+    only holds idle connections and per-request output queues.
+    Requests wait in per-adapter FIFOs and a batch only holds requests of one
+    adapter, picked by the oldest waiting request.
+    """
+    def __init__(self, worker, max_batch_size=8, max_wait=0.01):
+        self.worker = worker
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.pending = {}
+        self.task = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu")
+        self.in_flight = 0
+        self.last_batch_size = 0
+        self.num_batches = 0
+        self.num_requests = 0
+        self.num_cancelled = 0
+        self.num_new_tokens = 0
+        self.tokens_per_sec = 0.0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def submit(self, request):
+        request.loop = asyncio.get_running_loop()
+        request.output = asyncio.Queue()
+        await self.queue.put(request)
+
+    def stash(self, request):
+        if not request.cancelled:
+            self.pending.setdefault(request.adapter, deque()).append(request)
+
+    def num_pending(self):
+        return sum(len(q) for q in self.pending.values())
+
+    async def next_batch(self):
+        while True:
+            while not self.queue.empty():
+                self.stash(self.queue.get_nowait())
+            for q in self.pending.values():
+                while q and q[0].cancelled:
+                    q.popleft()
+            if self.num_pending():
+                break
+            self.stash(await self.queue.get())
+
+        adapter = min((a for a, q in self.pending.items() if q), key=lambda a: self.pending[a][0].created)
+        deadline = time.time() + self.max_wait
+        while len(self.pending[adapter]) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                self.stash(await asyncio.wait_for(self.queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        batch = []
+        q = self.pending[adapter]
+        while q and len(batch) < self.max_batch_size:
+            request = q.popleft()
+            if not request.cancelled:
+                batch.append(request)
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            if not batch:
+                continue
+            self.in_flight = len(batch)
+            self.last_batch_size = len(batch)
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            start = time.time()
+            try:
+                num_tokens = await loop.run_in_executor(self.executor, self.worker.run_batch, batch)
+                self.update_speed(num_tokens, time.time() - start)
+            except Exception as e:
+                logger.error(f"batch failed: {e}")
+                for request in batch:
+                    request.output.put_nowait({"text": server_error_msg, "error_code": 1})
+            finally:
+                for request in batch:
+                    request.output.put_nowait(None)
+                self.in_flight = 0
+
+    def update_speed(self, num_tokens, elapsed):
+        self.num_new_tokens += num_tokens
+        if num_tokens == 0 or elapsed <= 0:
+            return
+        speed = num_tokens / elapsed
+        self.tokens_per_sec = speed if self.tokens_per_sec == 0 else 0.8 * self.tokens_per_sec + 0.2 * speed
+
+    def get_metrics(self):
+        gpu_free, gpu_total = 0, 0
+        if torch.cuda.is_available():
+            gpu_free, gpu_total = torch.cuda.mem_get_info()
+        return {
+            "queue_length": (self.queue.qsize() if self.queue is not None else 0) + self.num_pending() + self.in_flight,
+            "in_flight": self.in_flight,
+            "batch_size": self.last_batch_size,
+            "avg_batch_size": self.num_requests / self.num_batches if self.num_batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "tokens_per_sec": self.tokens_per_sec,
+            "avg_new_tokens": self.num_new_tokens / self.num_requests if self.num_requests else 0.0,
+            "cancelled": self.num_cancelled,
+            "gpu_free_bytes": gpu_free,
+            "gpu_total_bytes": gpu_total,
+        }
+
+
 class ModelWorker:
     def __init__(self, controller_addr, worker_addr,
                  worker_id, no_register,
                  model_path, model_base, model_name,
-                 load_8bit, load_4bit, device):
+                 load_8bit, load_4bit, device,
+                 max_batch_size=8, batch_wait_ms=10, prefix_cache_gb=4,
+                 result_cache_dir=None, result_cache_gb=8, model_version=None,
+                 lora_adapters=None):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
         self.worker_id = worker_id
@@ -62,9 +214,30 @@ class ModelWorker:
 
         self.device = device
         logger.info(f"Loading the model {self.model_name} on worker {worker_id} ...")
-        self.tokenizer, self.model, self.context_len = load_pretrained_model(
-            model_path, model_base, self.model_name, load_8bit, load_4bit, device=self.device)
-        self.is_multimodal = 'llava' in self.model_name.lower()
+        self.adapters = None
+        if lora_adapters:
+            # One frozen base with unmerged LoRA adapters; a request picks its adapter by name.
+            name, path = lora_adapters[0]
+            self.tokenizer, self.model, self.context_len = load_pretrained_model(
+                path, model_base, self.model_name, load_8bit, load_4bit, device=self.device,
+                merge_lora=False, adapter_name=name)
+            self.adapters = AdapterBank(self.model, name, path)
+            for name, path in lora_adapters[1:]:
+                logger.info(f"Loading LoRA adapter {name} from {path} ...")
+                self.adapters.add(name, path)
+            self.model_names = self.adapters.names()
+        else:
+            self.tokenizer, self.model, self.context_len = load_pretrained_model(
+                model_path, model_base, self.model_name, load_8bit, load_4bit, device=self.device)
+            self.model_names = [self.model_name]
+        self.has_seg_head = hasattr(self.model, "seg_decoder")
+        # Cached prefixes depend on the LoRA weights, so each adapter gets its own share.
+        self.prefix_caches = {
+            name: PointPrefixCache(max_bytes=int(prefix_cache_gb * GB / len(self.model_names)))
+            for name in (self.model_names if self.adapters is not None else [None])}
+        self.model_version = model_version or self.model_name
+        self.result_cache = ResultCache(cache_dir=result_cache_dir, max_disk_bytes=int(result_cache_gb * GB))
+        self.batcher = InferenceLoop(self, max_batch_size=max_batch_size, max_wait=batch_wait_ms / 1000.0)
 
         if not no_register:
             self.register_to_controller()
@@ -85,8 +258,9 @@ class ModelWorker:
         assert r.status_code == 200
 
     def send_heart_beat(self):
-        logger.info(f"Send heart beat. Models: {[self.model_name]}. "
-                    f"Semaphore: {pretty_print_semaphore(model_semaphore)}. "
+        metrics = self.batcher.get_metrics()
+        logger.info(f"Send heart beat. Models: {self.model_names}. "
+                    f"Metrics: {metrics}. "
                     f"global_counter: {global_counter}")
 
         url = self.controller_addr + "/receive_heart_beat"
@@ -95,7 +269,8 @@ class ModelWorker:
             try:
                 ret = requests.post(url, json={
                     "worker_name": self.worker_addr,
-                    "queue_length": self.get_queue_length()}, timeout=5)
+                    "queue_length": metrics["queue_length"],
+                    "metrics": metrics}, timeout=5)
                 exist = ret.json()["exist"]
                 break
             except requests.exceptions.RequestException as e:
@@ -106,141 +281,268 @@ class ModelWorker:
             self.register_to_controller()
 
     def get_queue_length(self):
-        if model_semaphore is None:
-            return 0
-        else:
-            return args.limit_model_concurrency - model_semaphore._value + (len(
-                model_semaphore._waiters) if model_semaphore._waiters is not None else 0)
+        return self.batcher.get_metrics()["queue_length"]
 
     def get_status(self):
-        return {
-            "model_names": [self.model_name],
-            "speed": 1,
-            "queue_length": self.get_queue_length(),
+        metrics = self.batcher.get_metrics()
+        status = {
+            "model_names": self.model_names,
+            "speed": max(metrics["tokens_per_sec"], 1),
+            "queue_length": metrics["queue_length"],
+            "metrics": metrics,
+            "result_cache": self.result_cache.stats(),
         }
-
-    @torch.inference_mode()
-    def generate_stream(self, params):
-        tokenizer, model, image_processor = self.tokenizer, self.model, self.image_processor
+        if self.adapters is not None:
+            status["adapters"] = self.adapters.stats()
+        return status
+
+    def resolve_adapter(self, params):
+        if self.adapters is None:
+            return None
+        name = params.get("adapter") or params.get("model") or self.adapters.default
+        if name not in self.adapters:
+            raise ValueError(f"Unknown adapter: {name}")
+        return name
+
+    def load_points(self, params):
+        pts = params.get("points", None)
+        if pts is None:
+            raise ValueError("A point cloud is required")
+        if isinstance(pts, str):
+            pts = load_pts_from_base64(pts, params.get("points_format", "npy"))
+        if getattr(self.model.config, "with_color", True) and pts.shape[1] == 3:
+            pts = np.concatenate([pts, np.ones_like(pts)], axis=1)
+        return pts
+
+    def build_request(self, params, pts):
+        tokenizer, model = self.tokenizer, self.model
 
         prompt = params["prompt"]
-        ori_prompt = prompt
-        images = params.get("images", None)
-        num_image_tokens = 0
-        if images is not None and len(images) > 0 and self.is_multimodal:
-            if len(images) > 0:
-                if len(images) != prompt.count(DEFAULT_POINT_TOKEN):
-                    raise ValueError("Number of images does not match number of <image> tokens in prompt")
-
-                images = [load_image_from_base64(image) for image in images]
-                images = process_images(images, image_processor, model.config)
-
-                if type(images) is list:
-                    images = [image.to(self.model.device, dtype=torch.float16) for image in images]
-                else:
-                    images = images.to(self.model.device, dtype=torch.float16)
-
-                replace_token = DEFAULT_POINT_TOKEN
-                if getattr(self.model.config, 'mm_use_pt_start_end', False):
-                    replace_token = DEFAULT_PT_START_TOKEN + replace_token + DEFAULT_PT_END_TOKEN
-                prompt = prompt.replace(DEFAULT_POINT_TOKEN, replace_token)
-
-                num_image_tokens = prompt.count(replace_token) * model.get_vision_tower().num_patches
-            else:
-                images = None
-            image_args = {"images": images}
-        else:
-            images = None
-            image_args = {}
+        if prompt.count(DEFAULT_POINT_TOKEN) != 1:
+            raise ValueError("Prompt must contain exactly one <point> token")
+
+        sample_indices = np.arange(len(pts))
+        if len(pts) > model.config.sample_points_num:
+            sample_indices = np.random.permutation(len(pts))[:model.config.sample_points_num]
+        points = process_pts(pts[sample_indices].copy(), model.config).unsqueeze(0).to(self.device, dtype=torch.float16)
+
+        replace_token = DEFAULT_POINT_TOKEN
+        if getattr(model.config, 'mm_use_pt_start_end', False):
+            replace_token = DEFAULT_PT_START_TOKEN + replace_token + DEFAULT_PT_END_TOKEN
+        prompt = prompt.replace(DEFAULT_POINT_TOKEN, replace_token)
+        num_point_tokens = model.get_vision_tower().num_patches
 
         temperature = float(params.get("temperature", 1.0))
         top_p = float(params.get("top_p", 1.0))
         max_context_length = getattr(model.config, 'max_position_embeddings', 2048)
         max_new_tokens = min(int(params.get("max_new_tokens", 256)), 1024)
         stop_str = params.get("stop", None)
-        do_sample = True if temperature > 0.001 else False
-
-        input_ids = tokenizer_image_token(prompt, tokenizer, POINT_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).to(self.device)
-        keywords = [stop_str]
-        stopping_criteria = KeywordsStoppingCriteria(keywords, tokenizer, input_ids)
-        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=15)
-
-        max_new_tokens = min(max_new_tokens, max_context_length - input_ids.shape[-1] - num_image_tokens)
 
+        input_ids = tokenizer_point_token(prompt, tokenizer, POINT_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).to(self.device)
+        max_new_tokens = min(max_new_tokens, max_context_length - input_ids.shape[-1] - num_point_tokens)
         if max_new_tokens < 1:
-            yield json.dumps({"text": ori_prompt + "Exceeds max token length. Please start a new conversation, thanks.", "error_code": 0}).encode() + b"\0"
+            raise ValueError("Exceeds max token length")
+
+        request = PointRequest(
+            input_ids=input_ids,
+            points=points,
+            generate_kwargs=dict(
+                max_new_tokens=max_new_tokens,
+                temperature=temperature if temperature > 0.001 else 0.0,
+                top_p=top_p,
+            ),
+            prompt=params["prompt"],
+            stop_str=stop_str,
+            sample_indices=sample_indices,
+            adapter=self.resolve_adapter(params),
+        )
+        stopping_criteria = [CancelledCriteria(request)]
+        if stop_str:
+            stopping_criteria.append(KeywordsStoppingCriteria([stop_str], tokenizer, input_ids))
+        request.generate_kwargs["stopping_criteria"] = stopping_criteria
+        return request
+
+    @torch.inference_mode()
+    def run_batch(self, batch):
+        tokenizer, model = self.tokenizer, self.model
+        # InferenceLoop never mixes adapters within a batch.
+        if self.adapters is not None:
+            self.adapters.activate(batch[0].adapter)
+        prefix_cache = self.prefix_caches[batch[0].adapter]
+        states = [{"prev_hidden": None, "point_feat": None, "num_masks": 0} for _ in batch]
+        num_tokens = 0
+
+        for row, output_ids, next_token, last_hidden, finished in model.iter_decode_batch_with_prefix_cache(
+                [r.input_ids for r in batch], [r.points for r in batch], prefix_cache=prefix_cache,
+                generate_kwargs_list=[r.generate_kwargs for r in batch]):
+            request, state = batch[row], states[row]
+            num_tokens += 1
+            if request.cancelled:
+                continue
+            ret = {"error_code": 0}
+
+            if self.has_seg_head and next_token.item() == model.seg_token_idx:
+                if state["point_feat"] is None:
+                    state["point_feat"] = model.get_cached_visual_embs(
+                        request.points, request.input_ids, prefix_cache)[0]
+                mask = model.decode_seg_mask(last_hidden, state["prev_hidden"], state["point_feat"])
+                ret["mask"] = (mask > 0.5).cpu().numpy()
+                ret["mask_index"] = state["num_masks"]
+                state["num_masks"] += 1
+            state["prev_hidden"] = last_hidden
+
+            generated_text = tokenizer.decode(output_ids[0, request.input_ids.shape[1]:], skip_special_tokens=True)
+            if request.stop_str and generated_text.endswith(request.stop_str):
+                generated_text = generated_text[:-len(request.stop_str)]
+            ret["text"] = request.prompt + generated_text
+            request.emit(ret)
+        return num_tokens
+
+    def result_cache_key(self, params, pts):
+        model_version = self.model_version
+        adapter = self.resolve_adapter(params)
+        if adapter is not None:
+            model_version = f"{model_version}/{adapter}"
+        return self.result_cache.make_key(
+            pts, params["prompt"], model_version,
+            temperature=float(params.get("temperature", 1.0)),
+            top_p=float(params.get("top_p", 1.0)),
+            max_new_tokens=int(params.get("max_new_tokens", 256)),
+            stop=params.get("stop", None))
+
+    def prepare(self, params):
+        pts = self.load_points(params)
+        key, voxel_ids, occupied = self.result_cache_key(params, pts)
+        cached = self.result_cache.get(key)
+        request = self.build_request(params, pts) if cached is None else None
+        return key, voxel_ids, occupied, cached, request
+
+    async def iter_results(self, params):
+        # Point decoding, fingerprinting and tokenization run off the event loop.
+        loop = asyncio.get_running_loop()
+        key, voxel_ids, occupied, cached, request = await loop.run_in_executor(None, self.prepare, params)
+
+        if cached is not None:
+            masks = voxels_to_points(cached["voxel_masks"], voxel_ids, cached["occupied"], self.result_cache.resolution)
+            for i, mask in enumerate(masks):
+                yield {"text": params["prompt"], "error_code": 0, "mask": mask, "mask_index": i, "cached": True}
+            ret = {"text": params["prompt"] + cached["text"], "error_code": 0, "cached": True, "cache_key": key}
+            if cached["urdf"] is not None:
+                ret["urdf"] = cached["urdf"]
+            yield ret
             return
 
-        thread = Thread(target=model.generate, kwargs=dict(
-            inputs=input_ids,
-            do_sample=do_sample,
-            temperature=temperature,
-            top_p=top_p,
-            max_new_tokens=max_new_tokens,
-            streamer=streamer,
-            stopping_criteria=[stopping_criteria],
-            use_cache=True,
-            **image_args
-        ))
-        thread.start()
-
-        generated_text = ori_prompt
-        for new_text in streamer:
-            generated_text += new_text
-            if generated_text.endswith(stop_str):
-                generated_text = generated_text[:-len(stop_str)]
-            yield json.dumps({"text": generated_text, "error_code": 0}).encode() + b"\0"
-
-    def generate_stream_gate(self, params):
+        sample_voxel_ids = voxel_ids[request.sample_indices]
+        voxel_masks = []
+        last = None
+        done = False
+        await self.batcher.submit(request)
+        try:
+            while True:
+                ret = await request.output.get()
+                if ret is None:
+                    done = True
+                    break
+                if ret["error_code"] != 0:
+                    last = None
+                    yield ret
+                    continue
+                if "mask" in ret:
+                    voxel_mask = masks_to_voxels(ret["mask"][None], sample_voxel_ids, occupied)
+                    voxel_masks.append(voxel_mask[0])
+                    ret["mask"] = voxels_to_points(voxel_mask, voxel_ids, occupied)[0]
+                ret["cache_key"] = key
+                last = ret
+                yield ret
+        finally:
+            # Reached early when the client disconnects: the row stops at its next decode step.
+            if not done:
+                request.cancelled = True
+                self.batcher.num_cancelled += 1
+
+        if last is not None:
+            text = last["text"][len(params["prompt"]):]
+            voxel_masks = np.stack(voxel_masks) if voxel_masks else np.zeros((0, len(occupied)), dtype=bool)
+            self.result_cache.put(key, text, voxel_masks, occupied)
+
+    @staticmethod
+    def encode_json(ret, params):
+        if "mask" in ret:
+            ret = dict(ret, mask=ret["mask"].astype(int).tolist())
+        return json.dumps(ret).encode() + b"\0"
+
+    @staticmethod
+    def encode_binary(ret, params):
+        blobs = {}
+        if "mask" in ret:
+            blobs["mask"] = encode_mask(ret["mask"], params.get("mask_encoding", "bits"))
+            ret = {k: v for k, v in ret.items() if k != "mask"}
+        return pack_frame(ret, blobs)
+
+    async def generate_stream(self, params):
+        async for ret in self.iter_results(params):
+            yield self.encode_json(ret, params)
+
+    async def generate_stream_gate(self, params, encode=None):
+        encode = encode or self.encode_json
         try:
-            for x in self.generate_stream(params):
-                yield x
+            async for ret in self.iter_results(params):
+                yield encode(ret, params)
         except ValueError as e:
             print("Caught ValueError:", e)
             ret = {
                 "text": server_error_msg,
                 "error_code": 1,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield encode(ret, params)
         except torch.cuda.CudaError as e:
             print("Caught torch.cuda.CudaError:", e)
             ret = {
                 "text": server_error_msg,
                 "error_code": 1,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield encode(ret, params)
         except Exception as e:
             print("Caught Unknown Error", e)
             ret = {
                 "text": server_error_msg,
                 "error_code": 1,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield encode(ret, params)
 
 
 app = FastAPI()
 
 
-def release_model_semaphore(fn=None):
-    model_semaphore.release()
-    if fn is not None:
-        fn()
+@app.on_event("startup")
+async def start_inference_loop():
+    worker.batcher.start()
 
 
 @app.post("/worker_generate_stream")
 async def generate_stream(request: Request):
-    global model_semaphore, global_counter
+    global global_counter
     global_counter += 1
     params = await request.json()
-
-    if model_semaphore is None:
-        model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
-    await model_semaphore.acquire()
-    worker.send_heart_beat()
     generator = worker.generate_stream_gate(params)
-    background_tasks = BackgroundTasks()
-    background_tasks.add_task(partial(release_model_semaphore, fn=worker.send_heart_beat))
-    return StreamingResponse(generator, background=background_tasks)
+    return StreamingResponse(generator)
+
+
+@app.post("/worker_generate_stream_binary")
+async def generate_stream_binary(request: Request):
+    global global_counter
+    global_counter += 1
+    params, blobs = unpack_frame(await request.body())
+    if "points" in blobs:
+        params["points"] = decode_points(blobs["points"])
+    generator = worker.generate_stream_gate(params, encode=worker.encode_binary)
+    return StreamingResponse(generator, media_type=CONTENT_TYPE)
+
+
+@app.post("/worker_cache_urdf")
+async def cache_urdf(request: Request):
+    data = await request.json()
+    return {"stored": worker.result_cache.attach_urdf(data["cache_key"], data["urdf"])}
 
 
 @app.post("/worker_get_status")
@@ -261,7 +563,14 @@ if __name__ == "__main__":
     parser.add_argument("--model-name", type=str)
     parser.add_argument("--device", type=str, default="cuda")
     parser.add_argument("--multi-modal", action="store_true", help="Multimodal mode is automatically detected with model name, please make sure `llava` is included in the model path.")
-    parser.add_argument("--limit-model-concurrency", type=int, default=5)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--batch-wait-ms", type=float, default=10)
+    parser.add_argument("--prefix-cache-gb", type=float, default=4)
+    parser.add_argument("--result-cache-dir", type=str, default=None)
+    parser.add_argument("--result-cache-gb", type=float, default=8)
+    parser.add_argument("--model-version", type=str, default=None)
+    parser.add_argument("--lora-adapters", type=str, nargs="+", default=None,
+                        help="name=path LoRA checkpoints served unmerged on top of --model-base")
     parser.add_argument("--stream-interval", type=int, default=1)
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument("--load-8bit", action="store_true")
@@ -269,6 +578,14 @@ if __name__ == "__main__":
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
+    lora_adapters = None
+    if args.lora_adapters:
+        if args.model_base is None:
+            parser.error("--lora-adapters requires --model-base")
+        lora_adapters = [tuple(item.split("=", 1)) for item in args.lora_adapters]
+        if any(len(item) != 2 for item in lora_adapters):
+            parser.error("--lora-adapters expects name=path pairs")
+
     if args.multi_modal:
         logger.warning("Multimodal mode is automatically detected with model name, please make sure `llava` is included in the model path.")
 
@@ -281,5 +598,12 @@ if __name__ == "__main__":
                          args.model_name,
                          args.load_8bit,
                          args.load_4bit,
-                         args.device)
+                         args.device,
+                         args.max_batch_size,
+                         args.batch_wait_ms,
+                         args.prefix_cache_gb,
+                         args.result_cache_dir,
+                         args.result_cache_gb,
+                         args.model_version,
+                         lora_adapters)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -0,0 +1,96 @@
+import argparse
+import base64
+import io
+import json
+
+import numpy as np
+import requests
+
+from llava.constants import DEFAULT_POINT_TOKEN
+from llava.conversation import conv_templates
+from llava.mm_utils import load_pts
+from llava.serve.wire import CONTENT_TYPE, decode_mask, encode_points, iter_frames, pack_frame
+
+
+def iter_json(response):
+    for chunk in response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b"\0"):
+        if chunk:
+            data = json.loads(chunk.decode("utf-8"))
+            if "mask" in data:
+                data["mask"] = np.asarray(data["mask"], dtype=bool)
+            yield data
+
+
+def iter_binary(response):
+    for meta, blobs in iter_frames(response.iter_content(chunk_size=None)):
+        if "mask" in blobs:
+            meta["mask"] = decode_mask(blobs["mask"])
+        yield meta
+
+
+def main():
+    if args.worker_address:
+        addr = args.worker_address
+    else:
+        addr = args.controller_address
+
+    pts = load_pts(args.points_file).astype(np.float32)
+
+    conv = conv_templates[args.conv_mode].copy()
+    conv.append_message(conv.roles[0], DEFAULT_POINT_TOKEN + "\n" + args.message)
+    conv.append_message(conv.roles[1], None)
+    prompt = conv.get_prompt()
+
+    pload = {
+        "model": args.model_name,
+        "prompt": prompt,
+        "max_new_tokens": args.max_new_tokens,
+        "temperature": args.temperature,
+        "stop": conv.sep if conv.sep2 is None else conv.sep2,
+        "mask_encoding": args.mask_encoding,
+    }
+    headers = {"User-Agent": "LLaVA Client"}
+    if args.binary:
+        headers["Content-Type"] = CONTENT_TYPE
+        body = pack_frame(pload, {"points": encode_points(pts, args.dtype)})
+        response = requests.post(addr + "/worker_generate_stream_binary", headers=headers,
+                                 data=body, stream=True)
+        results = iter_binary(response)
+    else:
+        buf = io.BytesIO()
+        np.save(buf, pts)
+        pload["points"] = base64.b64encode(buf.getvalue()).decode()
+        pload["points_format"] = "npy"
+        body = json.dumps(pload).encode()
+        response = requests.post(addr + "/worker_generate_stream", headers=headers,
+                                 json=pload, stream=True)
+        results = iter_json(response)
+    print(f"request: {len(body)} bytes")
+
+    output = ""
+    for data in results:
+        if data["error_code"] != 0:
+            print(f"error: {data['text']}")
+            return
+        if "mask" in data:
+            print(f"mask {data['mask_index']}: {int(data['mask'].sum())}/{len(data['mask'])} points")
+        output = data["text"][len(prompt):]
+    print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--controller-address", type=str, default="http://localhost:21001")
+    parser.add_argument("--worker-address", type=str)
+    parser.add_argument("--model-name", type=str, required=True)
+    parser.add_argument("--points-file", type=str, required=True)
+    parser.add_argument("--conv-mode", type=str, default="vicuna_v1")
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--message", type=str, default="Please segment the movable parts of this object.")
+    parser.add_argument("--binary", action="store_true", help="send float16/32 points and receive bit-packed masks")
+    parser.add_argument("--dtype", type=str, choices=["float16", "float32"], default="float16")
+    parser.add_argument("--mask-encoding", type=str, choices=["bits", "rle"], default="bits")
+    args = parser.parse_args()
+
+    main()
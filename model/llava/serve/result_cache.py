@@ -0,0 +1,347 @@
+"""
+Cache of finished reconstructions (text, [SEG] masks, URDF), keyed tolerantly on the point cloud.
+
+Two samplings of the same asset (e.g. mine/glb_to_obj.py with different seeds) never occupy
+exactly the same voxels, so the cloud is not hashed. Entries are grouped in buckets by
+(model, prompt, sampling params); within a bucket the coarse 8^3 occupancy ranks candidates
+and a dilated 64^3 occupancy overlap >= `min_overlap` accepts one. Masks are stored per
+occupied voxel of the cloud that produced them and projected onto whichever cloud hits.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+GB = 1 << 30
+
+# 3x3x3 neighbourhood offsets (including the voxel itself)
+NEIGHBORS = np.stack(np.meshgrid(*[np.arange(-1, 2)] * 3, indexing="ij"), axis=-1).reshape(-1, 3)
+
+
+def voxelize(xyz, resolution=64):
+    """Return the linear voxel id of every point of the unit-sphere-normalized cloud."""
+    xyz = np.asarray(xyz[:, :3], dtype=np.float64)
+    xyz = xyz - xyz.mean(axis=0)
+    m = np.max(np.linalg.norm(xyz, axis=1))
+    if m > 1e-6:
+        xyz = xyz / m
+    grid = np.clip(np.floor((xyz + 1.0) * 0.5 * resolution), 0, resolution - 1).astype(np.int64)
+    return (grid[:, 0] * resolution + grid[:, 1]) * resolution + grid[:, 2]
+
+
+def point_cloud_fingerprint(pts, resolution=64, color_levels=0):
+    """
+    Returns (voxel_ids, occupied, color): the voxel id of every point, the sorted unique occupied
+    ids and, with color_levels > 0, the cloud's mean color quantized to that many levels (else None).
+    """
+    voxel_ids = voxelize(pts, resolution)
+    occupied = np.unique(voxel_ids)
+    color = None
+    if color_levels > 0 and pts.shape[1] >= 6:
+        rgb = np.asarray(pts[:, 3:6], dtype=np.float64)
+        if rgb.max() > 1.0:
+            rgb = rgb / 255.0
+        color = np.round(rgb.mean(axis=0) * (color_levels - 1)).astype(int).tolist()
+    return voxel_ids, occupied, color
+
+
+def coarse_occupancy(occupied, resolution=64, coarse_resolution=8):
+    """(coarse_resolution^3,) bool occupancy of the fine voxel ids `occupied`."""
+    grid = np.stack(np.unravel_index(occupied, (resolution,) * 3), axis=1) * coarse_resolution // resolution
+    out = np.zeros(coarse_resolution ** 3, dtype=bool)
+    out[np.ravel_multi_index(grid.T, (coarse_resolution,) * 3)] = True
+    return out
+
+
+def dilate(occupied, resolution=64):
+    """Sorted voxel ids of `occupied` grown by one voxel in every direction."""
+    grid = np.stack(np.unravel_index(occupied, (resolution,) * 3), axis=1)
+    grid = (grid[:, None, :] + NEIGHBORS[None]).reshape(-1, 3)
+    grid = grid[((grid >= 0) & (grid < resolution)).all(axis=1)]
+    return np.unique(np.ravel_multi_index(grid.T, (resolution,) * 3))
+
+
+def occupancy_overlap(a, b, resolution=64):
+    """
+    Fraction of each voxel set lying within one voxel of the other (the smaller of the two).
+    Resamplings of one surface score ~1 from ~4k points up; an exact IoU at 64^3 stays far below.
+    """
+    if len(a) == 0 or len(b) == 0:
+        return 0.0
+    return float(min(np.isin(a, dilate(b, resolution)).mean(), np.isin(b, dilate(a, resolution)).mean()))
+
+
+def lookup_voxels(occupied, voxel_ids):
+    """Returns (index into `occupied`, found) for every id in `voxel_ids`."""
+    idx = np.clip(np.searchsorted(occupied, voxel_ids), 0, max(len(occupied) - 1, 0))
+    found = occupied[idx] == voxel_ids if len(occupied) else np.zeros(len(voxel_ids), dtype=bool)
+    return idx, found
+
+
+def masks_to_voxels(masks, voxel_ids, occupied):
+    """Majority-vote per-point masks (K, N) into per-voxel masks (K, V) over `occupied`."""
+    masks = np.asarray(masks, dtype=np.float64).reshape(-1, len(voxel_ids))
+    inverse = np.searchsorted(occupied, voxel_ids)
+    counts = np.maximum(np.bincount(inverse, minlength=len(occupied)), 1)
+    votes = np.stack([np.bincount(inverse, weights=m, minlength=len(occupied)) for m in masks]) \
+        if len(masks) else np.zeros((0, len(occupied)))
+    return votes / counts > 0.5
+
+
+def voxels_to_points(voxel_masks, voxel_ids, occupied, resolution=64):
+    """
+    Project per-voxel masks (K, V) over `occupied` onto the points with `voxel_ids`.
+    A point whose voxel is not in `occupied` (another sampling of the asset) takes the mask of an
+    occupied neighbour voxel; points with none get 0.
+    """
+    voxel_masks = np.asarray(voxel_masks, dtype=bool)
+    idx, known = lookup_voxels(occupied, voxel_ids)
+    missing = np.flatnonzero(~known)
+    if len(missing) and len(occupied):
+        grid = np.stack(np.unravel_index(voxel_ids[missing], (resolution,) * 3), axis=1)
+        for offset in NEIGHBORS:
+            neighbor = grid + offset
+            inside = ((neighbor >= 0) & (neighbor < resolution)).all(axis=1)
+            n_idx, found = lookup_voxels(occupied, np.ravel_multi_index(
+                np.clip(neighbor, 0, resolution - 1).T, (resolution,) * 3))
+            found &= inside & ~known[missing]
+            idx[missing[found]] = n_idx[found]
+            known[missing[found]] = True
+    if len(occupied) == 0:
+        return np.zeros((len(voxel_masks), len(voxel_ids)), dtype=bool)
+    return voxel_masks[:, idx] & known[None, :]
+
+
+class ResultCache:
+    """
+    Two-tier LRU: a small in-memory OrderedDict in front of a directory of .npz files
+    bounded by `max_disk_bytes` (least recently used files are removed first).
+    Keys are "<bucket>-<cloud>"; `index` maps each bucket to the coarse occupancy of its entries
+    (read lazily from disk after a restart).
+    """
+    def __init__(self, cache_dir=None, max_memory_entries=256, max_disk_bytes=8 * GB,
+                 resolution=64, color_levels=0, coarse_resolution=8, min_overlap=0.9, max_candidates=4):
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.resolution = resolution
+        self.color_levels = color_levels
+        self.coarse_resolution = coarse_resolution
+        self.min_overlap = min_overlap
+        self.max_candidates = max_candidates
+        self.memory = OrderedDict()
+        self.index = {}
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "puts": 0, "evictions": 0}
+
+        self.disk_index = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            files = [f for f in os.listdir(cache_dir) if f.endswith(".npz")]
+            files.sort(key=lambda f: os.path.getmtime(os.path.join(cache_dir, f)))
+            for f in files:
+                key = f[:-4]
+                self.disk_index[key] = os.path.getsize(os.path.join(cache_dir, f))
+                if "-" in key:
+                    # entries written before the tolerant keys have no occupancy and are left to the LRU
+                    self.index.setdefault(key.split("-")[0], OrderedDict())[key] = None
+
+    def make_key(self, pts, prompt, model_version, **params):
+        """
+        Returns (key, voxel_ids, occupied) for a raw submitted cloud. The key is that of a stored
+        entry for another sampling of the same asset if there is one, otherwise a new key.
+        """
+        voxel_ids, occupied, color = point_cloud_fingerprint(pts, self.resolution, self.color_levels)
+        h = hashlib.sha1()
+        h.update(json.dumps([self.resolution, color, model_version, prompt, params], sort_keys=True).encode())
+        bucket = h.hexdigest()
+        key = self.match(bucket, occupied)
+        if key is None:
+            key = f"{bucket}-{hashlib.sha1(occupied.tobytes()).hexdigest()[:16]}"
+        return key, voxel_ids, occupied
+
+    def match(self, bucket, occupied):
+        """Key of the entry in `bucket` whose cloud overlaps `occupied` best (>= min_overlap), or None."""
+        coarse = coarse_occupancy(occupied, self.resolution, self.coarse_resolution)
+        with self.lock:
+            entries = self.index.get(bucket)
+            if not entries:
+                return None
+            for key, signature in entries.items():
+                if signature is None:
+                    entries[key] = self._load_field(key, "coarse")
+            keys = [key for key, signature in entries.items() if signature is not None]
+            if not keys:
+                return None
+            signatures = np.unpackbits(np.stack([entries[key] for key in keys]), axis=1,
+                                       count=len(coarse)).astype(bool)
+            inter = (signatures & coarse).sum(axis=1)
+            union = np.maximum((signatures | coarse).sum(axis=1), 1)
+            ious = inter / union
+            for i in np.argsort(-ious, kind="stable")[:self.max_candidates]:
+                if ious[i] < 0.5:
+                    break
+                other = self.memory[keys[i]]["occupied"] if keys[i] in self.memory \
+                    else self._load_field(keys[i], "occupied")
+                if other is not None and occupancy_overlap(occupied, other, self.resolution) >= self.min_overlap:
+                    return keys[i]
+        return None
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def _load_field(self, key, name):
+        if self.cache_dir is None or key not in self.disk_index:
+            return None
+        try:
+            with np.load(self._path(key), allow_pickle=False) as f:
+                return f[name]
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return self.memory[key]
+            if self.cache_dir is None or key not in self.disk_index:
+                self.counters["misses"] += 1
+                return None
+            try:
+                with np.load(self._path(key), allow_pickle=False) as f:
+                    num_voxels = int(f["num_voxels"])
+                    result = {
+                        "text": str(f["text"]),
+                        "urdf": str(f["urdf"]) if f["has_urdf"] else None,
+                        "voxel_masks": np.unpackbits(f["voxel_masks"], axis=1, count=num_voxels).astype(bool),
+                        "occupied": f["occupied"],
+                    }
+            except (OSError, KeyError, ValueError):
+                self.disk_index.pop(key, None)
+                self._forget(key)
+                self.counters["misses"] += 1
+                return None
+            os.utime(self._path(key))
+            self.disk_index.move_to_end(key)
+            self.counters["disk_hits"] += 1
+            self._remember(key, result)
+            return result
+
+    def put(self, key, text, voxel_masks, occupied, urdf=None):
+        """`voxel_masks` (K, V) are over `occupied` (V,), the voxels of the cloud that produced them."""
+        voxel_masks = np.asarray(voxel_masks, dtype=bool)
+        occupied = np.asarray(occupied, dtype=np.int64)
+        if voxel_masks.ndim != 2:
+            voxel_masks = voxel_masks.reshape(-1, len(occupied))
+        coarse = np.packbits(coarse_occupancy(occupied, self.resolution, self.coarse_resolution))
+        result = {"text": text, "urdf": urdf, "voxel_masks": voxel_masks, "occupied": occupied}
+        with self.lock:
+            self.counters["puts"] += 1
+            self.index.setdefault(key.split("-")[0], OrderedDict())[key] = coarse
+            self._remember(key, result)
+            if self.cache_dir is None:
+                return
+            path = self._path(key)
+            np.savez(path, text=np.array(text), urdf=np.array(urdf or ""), has_urdf=np.array(urdf is not None),
+                     num_voxels=np.array(voxel_masks.shape[1]),
+                     # text-only answers are (0, V); packbits keeps that as (0, ceil(V / 8))
+                     voxel_masks=np.packbits(voxel_masks, axis=1),
+                     occupied=occupied, coarse=coarse)
+            self.disk_index[key] = os.path.getsize(path)
+            self.disk_index.move_to_end(key)
+            while sum(self.disk_index.values()) > self.max_disk_bytes and len(self.disk_index) > 1:
+                old, _ = self.disk_index.popitem(last=False)
+                try:
+                    os.remove(self._path(old))
+                except OSError:
+                    pass
+                self._forget(old)
+                self.counters["evictions"] += 1
+
+    def attach_urdf(self, key, urdf):
+        result = self.get(key)
+        if result is None:
+            return False
+        self.put(key, result["text"], result["voxel_masks"], result["occupied"], urdf=urdf)
+        return True
+
+    def _remember(self, key, result):
+        self.memory[key] = result
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            old, _ = self.memory.popitem(last=False)
+            self._forget(old)
+
+    def _forget(self, key):
+        """Drop `key` from its bucket once neither tier holds it."""
+        if key in self.memory or key in self.disk_index:
+            return
+        entries = self.index.get(key.split("-")[0])
+        if entries is not None:
+            entries.pop(key, None)
+            if not entries:
+                del self.index[key.split("-")[0]]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            return dict(self.counters,
+                        hit_rate=hits / lookups if lookups else 0.0,
+                        memory_entries=len(self.memory),
+                        disk_entries=len(self.disk_index),
+                        disk_bytes=sum(self.disk_index.values()))
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    def sample_box_surface(n, size, seed):
+        """n points uniformly on the surface of an axis-aligned box of edge lengths `size`."""
+        rng = np.random.default_rng(seed)
+        half = np.asarray(size, dtype=np.float64) / 2
+        areas = np.array([half[1] * half[2], half[0] * half[2], half[0] * half[1]])
+        axis = rng.choice(3, size=n, p=areas / areas.sum())
+        pts = rng.uniform(-half, half, size=(n, 3))
+        pts[np.arange(n), axis] = rng.choice([-1.0, 1.0], size=n) * half[axis]
+        return pts
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # put/get round trip through the disk tier, including a text-only answer with zero masks
+        cache = ResultCache(cache_dir=tmp)
+        occupied = np.arange(77) * 3
+        masks = np.random.default_rng(0).random((3, 77)) > 0.5
+        cache.put("a-with_masks", "answer [SEG]", masks, occupied)
+        cache.put("a-no_masks", "text only", np.zeros((0, 77), dtype=bool), occupied)
+        reloaded = ResultCache(cache_dir=tmp)
+        got = reloaded.get("a-with_masks")
+        assert np.array_equal(got["voxel_masks"], masks) and np.array_equal(got["occupied"], occupied)
+        got = reloaded.get("a-no_masks")
+        assert got["text"] == "text only" and got["voxel_masks"].shape == (0, 77)
+        assert reloaded.stats()["disk_hits"] == 2
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # two independent samplings of one mesh share an entry; another mesh does not
+        cache = ResultCache(cache_dir=tmp)
+        first = sample_box_surface(8192, (1.0, 0.5, 0.3), seed=0)
+        key, voxel_ids, occupied = cache.make_key(first, "segment", "v1")
+        assert cache.get(key) is None
+        cache.put(key, "answer [SEG]", masks_to_voxels((first[:, 0] > 0)[None], voxel_ids, occupied), occupied)
+
+        reloaded = ResultCache(cache_dir=tmp)
+        for n, seed in ((20000, 1), (100000, 2)):
+            second = sample_box_surface(n, (1.0, 0.5, 0.3), seed=seed)
+            key2, voxel_ids2, occupied2 = reloaded.make_key(second, "segment", "v1")
+            assert key2 == key and not np.array_equal(occupied2, occupied)
+            got = reloaded.get(key2)
+            mask = voxels_to_points(got["voxel_masks"], voxel_ids2, got["occupied"])[0]
+            assert (mask == (second[:, 0] > 0)).mean() > 0.95
+        assert reloaded.make_key(second, "segment", "v2")[0] != key
+        other = sample_box_surface(8192, (1.0, 1.0, 1.0), seed=3)
+        assert reloaded.make_key(other, "segment", "v1")[0] != key
+    print("result cache round trip ok")
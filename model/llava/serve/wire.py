@@ -0,0 +1,109 @@
+"""
+Binary wire format for the point-cloud serving stack.
+
+Frame:   <u32 frame_len> <u32 meta_len> <meta json> <blob bytes ...>
+         meta["blobs"] = [[name, nbytes], ...] lists the blobs in order.
+Points:  <4s magic "UAPT"> <u8 version> <u8 dtype> <u16 channels> <u32 num_points> <raw little-endian array>
+Masks:   <4s magic "UAMK"> <u8 version> <u8 encoding> <u16 reserved> <u32 num_points> <payload>
+         encoding 0 = bit-packed (np.packbits), 1 = run lengths (u32, alternating, starting with a 0-run)
+"""
+import json
+import struct
+
+import numpy as np
+
+
+CONTENT_TYPE = "application/x-ua-frame"
+WIRE_VERSION = 1
+
+_FRAME_HEADER = struct.Struct("<II")
+_POINTS_HEADER = struct.Struct("<4sBBHI")
+_MASK_HEADER = struct.Struct("<4sBBHI")
+
+_DTYPES = {0: np.dtype("<f2"), 1: np.dtype("<f4")}
+_DTYPE_CODES = {"float16": 0, "float32": 1}
+MASK_ENCODINGS = {"bits": 0, "rle": 1}
+
+
+def encode_points(pts, dtype="float16"):
+    pts = np.ascontiguousarray(pts, dtype=_DTYPES[_DTYPE_CODES[dtype]])
+    if pts.ndim != 2:
+        raise ValueError(f"Expected an NxC point array, got {pts.shape}")
+    header = _POINTS_HEADER.pack(b"UAPT", WIRE_VERSION, _DTYPE_CODES[dtype], pts.shape[1], pts.shape[0])
+    return header + pts.tobytes()
+
+
+def decode_points(buf):
+    magic, version, dtype, channels, num_points = _POINTS_HEADER.unpack_from(buf, 0)
+    if magic != b"UAPT" or version != WIRE_VERSION:
+        raise ValueError("Not a point-cloud blob")
+    arr = np.frombuffer(buf, dtype=_DTYPES[dtype], count=num_points * channels, offset=_POINTS_HEADER.size)
+    return arr.reshape(num_points, channels).astype(np.float32)
+
+
+def encode_mask(mask, encoding="bits"):
+    mask = np.asarray(mask).astype(bool).ravel()
+    code = MASK_ENCODINGS[encoding]
+    header = _MASK_HEADER.pack(b"UAMK", WIRE_VERSION, code, 0, len(mask))
+    if code == 0:
+        return header + np.packbits(mask).tobytes()
+    change = np.flatnonzero(np.diff(mask.astype(np.int8))) + 1
+    bounds = np.concatenate([[0], change, [len(mask)]])
+    runs = np.diff(bounds)
+    if len(mask) and mask[0]:
+        runs = np.concatenate([[0], runs])
+    return header + runs.astype("<u4").tobytes()
+
+
+def decode_mask(buf):
+    magic, version, code, _, num_points = _MASK_HEADER.unpack_from(buf, 0)
+    if magic != b"UAMK" or version != WIRE_VERSION:
+        raise ValueError("Not a mask blob")
+    payload = np.frombuffer(buf, dtype=np.uint8, offset=_MASK_HEADER.size)
+    if code == 0:
+        return np.unpackbits(payload, count=num_points).astype(bool)
+    runs = payload.view("<u4")
+    values = np.arange(len(runs)) % 2 == 1
+    return np.repeat(values, runs)
+
+
+def pack_frame(meta, blobs=None):
+    blobs = blobs or {}
+    meta = dict(meta, blobs=[[name, len(data)] for name, data in blobs.items()])
+    meta_bytes = json.dumps(meta).encode()
+    body = meta_bytes + b"".join(blobs.values())
+    return _FRAME_HEADER.pack(len(body) + 4, len(meta_bytes)) + body
+
+
+def unpack_frame(buf):
+    """Decode one complete frame (including its length prefix) into (meta, blobs)."""
+    frame_len, meta_len = _FRAME_HEADER.unpack_from(buf, 0)
+    offset = _FRAME_HEADER.size
+    meta = json.loads(bytes(buf[offset:offset + meta_len]))
+    offset += meta_len
+    blobs = {}
+    for name, nbytes in meta.pop("blobs", []):
+        blobs[name] = bytes(buf[offset:offset + nbytes])
+        offset += nbytes
+    return meta, blobs
+
+
+def peek_meta(buf):
+    """Read only the meta json of the first frame in `buf`."""
+    _, meta_len = _FRAME_HEADER.unpack_from(buf, 0)
+    return json.loads(bytes(buf[_FRAME_HEADER.size:_FRAME_HEADER.size + meta_len]))
+
+
+def iter_frames(chunks):
+    """Reassemble frames from an iterable of arbitrarily split byte chunks."""
+    buf = bytearray()
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buf.extend(chunk)
+        while len(buf) >= 4:
+            frame_len = struct.unpack_from("<I", buf, 0)[0]
+            if len(buf) < 4 + frame_len:
+                break
+            yield unpack_frame(bytes(buf[:4 + frame_len]))
+            del buf[:4 + frame_len]
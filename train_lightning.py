@@ -25,6 +25,7 @@ from model.UA import LISAForCausalLM
 from model.llava.mm_utils import tokenizer_point_token
 from model.llava.constants import IGNORE_INDEX
 from model.llava import conversation as conversation_lib
+from model.llava.prompt_template import PromptTemplate
 from utils.reason_seg_dataset import URDFReasoningDataset, collate_fn
 from model.llava.constants import POINT_TOKEN_INDEX
 from tqdm import tqdm
@@ -43,8 +44,10 @@ class LISADataModule(pl.LightningDataModule):
         self.predict_type = data_args.predict_type
 
     def setup(self, stage=None):
-        self.train_dataset = URDFReasoningDataset(data_root=self.data_args.data_path, task_mode=self.predict_type, split="train", max_samples=self.data_args.max_samples)
-        self.val_dataset = URDFReasoningDataset(data_root=self.data_args.data_path, task_mode=self.predict_type, split="test", max_samples=self.data_args.max_samples)
+        prompt_template = PromptTemplate(self.tokenizer, conversation_lib.default_conversation,
+                                         mm_use_pt_start_end=self.model_args.mm_use_pt_start_end)
+        self.train_dataset = URDFReasoningDataset(data_root=self.data_args.data_path, task_mode=self.predict_type, split="train", max_samples=self.data_args.max_samples, prompt_template=prompt_template)
+        self.val_dataset = URDFReasoningDataset(data_root=self.data_args.data_path, task_mode=self.predict_type, split="test", max_samples=self.data_args.max_samples, prompt_template=prompt_template)
         self.test_dataset = self.val_dataset
         print(f"Train dataset size: {len(self.train_dataset)}")
         print(f"Val dataset size: {len(self.val_dataset)}")
@@ -0,0 +1,216 @@
+"""
+Export the [SEG] mask head (text_hidden_fcs, seg_emb_head, seg_decoder) for CPU
+post-processing nodes: BatchNorm is folded into the 1x1 convs, every Linear is
+dynamically quantized to int8, and the result is traced to TorchScript (or wrapped
+with torch.compile). The GPU node only ships the [SEG] hidden states and the Uni3D
+intermediates (xyz, centers, H4, H8, H12); masks are decoded here.
+
+The exported module is checked against the fp32 head on random inputs before it is
+written, and the script exits non-zero if the masks disagree.
+"""
+
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+from collections import defaultdict
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model.UA import PartSegmentationEmbHead, PointCrossAttentionDecoder
+
+
+SEG_HEAD_KEYS = ["text_hidden_fcs", "seg_emb_head", "seg_decoder"]
+
+
+class SegHead(nn.Module):
+    """
+    The three trainable mask modules of LISAForCausalLM, with the same math as
+    LISAForCausalLM.get_visual_embs (after the backbone) and decode_seg_mask.
+    """
+    def __init__(self, text_fc, seg_emb_head, seg_decoder, context_fusion):
+        super().__init__()
+        self.text_fc = text_fc
+        self.seg_emb_head = seg_emb_head
+        self.seg_decoder = seg_decoder
+        self.context_fusion = context_fusion
+
+    @classmethod
+    def from_model(cls, model):
+        return cls(model.text_hidden_fcs[0], model.seg_emb_head, model.seg_decoder, model.context_fusion)
+
+    def point_features(self, xyz, centers, H4, H8, H12):
+        """(1, N, 3) points and Uni3D intermediates -> (N, C) per-point features."""
+        return self.seg_emb_head(xyz, centers, H4, H8, H12)[0]
+
+    def decode(self, hidden, prev_hidden, point_feat):
+        """(K, D) [SEG] hidden states (and the states before them) -> (K, N) sigmoid masks."""
+        h_seg = self.text_fc(hidden)
+        if self.context_fusion:
+            h_seg = torch.cat([self.text_fc(prev_hidden), h_seg], dim=-1)
+        return torch.sigmoid(self.seg_decoder(h_seg, point_feat))
+
+    def forward(self, hidden, prev_hidden, xyz, centers, H4, H8, H12):
+        return self.decode(hidden, prev_hidden, self.point_features(xyz, centers, H4, H8, H12))
+
+
+class PointwiseLinear(nn.Module):
+    """A kernel-size-1 Conv1d on (B, C, N) expressed as a Linear so dynamic quantization applies."""
+    def __init__(self, linear):
+        super().__init__()
+        self.linear = linear
+
+    def forward(self, x):
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+def fold_conv_bn(conv, bn):
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    linear = nn.Linear(conv.in_channels, conv.out_channels)
+    with torch.no_grad():
+        linear.weight.copy_(conv.weight[:, :, 0] * scale[:, None])
+        linear.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return PointwiseLinear(linear)
+
+
+def prepare_for_cpu(head, quantize=True):
+    """Returns an eval-mode fp32 copy of `head` with BN folded, int8-quantized if `quantize`."""
+    head = copy.deepcopy(head).float().cpu().eval()
+    propagation = head.seg_emb_head.propagation
+    for i, (conv, bn) in enumerate(zip(propagation.mlp_convs, propagation.mlp_bns)):
+        propagation.mlp_convs[i] = fold_conv_bn(conv, bn)
+        propagation.mlp_bns[i] = nn.Identity()
+    if quantize:
+        head = torch.ao.quantization.quantize_dynamic(head, {nn.Linear}, dtype=torch.qint8)
+    return head
+
+
+def example_inputs(head, num_points=10000, num_groups=512, num_masks=4, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    hidden_dim = head.text_fc[0].in_features
+    feat_dim = head.seg_emb_head.propagation.mlp_convs[0].in_channels // 3
+    xyz = torch.rand(1, num_points, 3, generator=generator) * 2 - 1
+    centers = xyz[:, torch.randperm(num_points, generator=generator)[:num_groups]]
+    H4, H8, H12 = (torch.randn(1, num_groups, feat_dim, generator=generator) for _ in range(3))
+    hidden = torch.randn(num_masks, hidden_dim, generator=generator)
+    prev_hidden = torch.randn(num_masks, hidden_dim, generator=generator)
+    return hidden, prev_hidden, xyz, centers, H4, H8, H12
+
+
+def export(head, inputs, method="trace"):
+    hidden, prev_hidden, xyz, centers, H4, H8, H12 = inputs
+    if method == "compile":
+        return torch.compile(head, dynamic=True)
+    with torch.no_grad():
+        point_feat = head.point_features(xyz, centers, H4, H8, H12)
+        return torch.jit.trace_module(head, {
+            "forward": inputs,
+            "point_features": (xyz, centers, H4, H8, H12),
+            "decode": (hidden, prev_hidden, point_feat),
+        })
+
+
+@torch.no_grad()
+def check_parity(reference, candidate, inputs, atol=0.05, min_iou=0.98):
+    """Compares sigmoid masks of `candidate` against the fp32 `reference` head."""
+    expected = reference(*inputs)
+    start = time.time()
+    actual = candidate(*inputs)
+    elapsed = time.time() - start
+    pred, gt = actual > 0.5, expected > 0.5
+    union = (pred | gt).sum(dim=1).clamp(min=1)
+    iou = ((pred & gt).sum(dim=1) / union).min().item()
+    max_abs = (actual - expected).abs().max().item()
+    return {
+        "max_abs_diff": max_abs,
+        "min_mask_iou": iou,
+        "latency_ms": elapsed * 1000,
+        "passed": max_abs <= atol and iou >= min_iou,
+    }
+
+
+def load_seg_head_state_dict(model_path):
+    """Collects the seg head weights from a checkpoint folder, like extract_mm_projector.py."""
+    ckpt_to_key = defaultdict(list)
+    try:
+        model_indices = json.load(open(os.path.join(model_path, 'pytorch_model.bin.index.json')))
+        for k, v in model_indices['weight_map'].items():
+            if any(key_match in k for key_match in SEG_HEAD_KEYS):
+                ckpt_to_key[v].append(k)
+    except FileNotFoundError:
+        for v in ['pytorch_model.bin', 'non_lora_trainables.bin']:
+            if not os.path.exists(os.path.join(model_path, v)):
+                continue
+            for k in torch.load(os.path.join(model_path, v), map_location='cpu').keys():
+                if any(key_match in k for key_match in SEG_HEAD_KEYS):
+                    ckpt_to_key[v].append(k)
+
+    state_dict = {}
+    for ckpt_name, weight_keys in ckpt_to_key.items():
+        ckpt = torch.load(os.path.join(model_path, ckpt_name), map_location='cpu')
+        for k in weight_keys:
+            name = k[k.index(next(key for key in SEG_HEAD_KEYS if key in k)):]
+            state_dict[name] = ckpt[k].float()
+    return state_dict
+
+
+def build_seg_head(state_dict):
+    """Rebuilds SegHead with dimensions read off the checkpoint shapes."""
+    hidden_dim = state_dict["text_hidden_fcs.0.0.weight"].shape[1]
+    out_dim = state_dict["text_hidden_fcs.0.2.weight"].shape[0]
+    feat_dim = state_dict["seg_emb_head.propagation.mlp_convs.0.weight"].shape[1] // 3
+    query_dim = state_dict["seg_decoder.query_proj.weight"].shape[1]
+
+    text_fc = nn.Sequential(
+        nn.Linear(hidden_dim, hidden_dim), nn.ReLU(inplace=True),
+        nn.Linear(hidden_dim, out_dim), nn.Dropout(0.0),
+    )
+    head = SegHead(
+        text_fc,
+        PartSegmentationEmbHead(embed_dim=feat_dim, mlp=[out_dim, out_dim]),
+        PointCrossAttentionDecoder(query_dim=query_dim, point_feat_dim=out_dim),
+        context_fusion=query_dim == 2 * out_dim,
+    )
+    head.load_state_dict({k.replace("text_hidden_fcs.0.", "text_fc."): v for k, v in state_dict.items()})
+    return head.eval()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export the [SEG] mask head for CPU inference')
+    parser.add_argument('--model-path', type=str, required=True, help='checkpoint folder')
+    parser.add_argument('--output', type=str, required=True, help='output TorchScript file')
+    parser.add_argument('--method', type=str, choices=['trace', 'compile'], default='trace')
+    parser.add_argument('--no-quantize', action='store_true')
+    parser.add_argument('--num-points', type=int, default=10000)
+    parser.add_argument('--num-threads', type=int, default=None)
+    parser.add_argument('--atol', type=float, default=0.05)
+    parser.add_argument('--min-iou', type=float, default=0.98)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    reference = build_seg_head(load_seg_head_state_dict(args.model_path))
+    inputs = example_inputs(reference, num_points=args.num_points)
+    exported = export(prepare_for_cpu(reference, quantize=not args.no_quantize), inputs, args.method)
+
+    # Parity on a cloud of a different size than the one used for tracing.
+    report = check_parity(reference, exported, example_inputs(reference, num_points=args.num_points // 2 + 1, seed=1))
+    print(json.dumps(report, indent=2))
+    if not report["passed"]:
+        sys.exit(1)
+
+    if args.method == 'trace':
+        torch.jit.save(exported, args.output)
+    else:
+        print("torch.compile artifacts are not serializable; re-run prepare_for_cpu + torch.compile on the node.")
@@ -13,6 +13,7 @@ except:
     from model.llava import conversation as conversation_lib
     from model.llava.mm_utils import tokenizer_point_token
     from model.llava.constants import IGNORE_INDEX
+    from model.llava.prompt_template import PromptTemplate
 import transformers
 import glob
 import json
@@ -84,11 +85,13 @@ class URDFReasoningDataset(torch.utils.data.Dataset):
         split: str = "train",
         task_mode: str = "all_parameters",
         max_samples: int | None = None,
+        prompt_template: "PromptTemplate" = None,
     ):
         self.data_root = data_root
         self.split = split
         self.task_mode = task_mode
         self.max_samples = max_samples
+        self.prompt_template = prompt_template
 
         list_dir = os.path.join(self.data_root, "train_test_txt")
         json_index_file = os.path.join(list_dir, f"json_{split}_{task_mode}.txt")
@@ -122,11 +125,15 @@ class URDFReasoningDataset(torch.utils.data.Dataset):
         user_query = LONG_QUESTION_LIST.format(sent=question)
         model_response = ANSWER_LIST.format(sent=answer)
 
-        conv = conversation_lib.default_conversation.copy()
-        conv.messages = []
-        conv.append_message(conv.roles[0], user_query)
-        conv.append_message(conv.roles[1], model_response)
-        conversation_text = conv.get_prompt()
+        if self.prompt_template is not None:
+            # Token ids assembled from the precompiled template; collate_fn skips re-tokenizing.
+            conversation_text = self.prompt_template.encode(user_query, model_response)
+        else:
+            conv = conversation_lib.default_conversation.copy()
+            conv.messages = []
+            conv.append_message(conv.roles[0], user_query)
+            conv.append_message(conv.roles[1], model_response)
+            conversation_text = conv.get_prompt()
 
         return (
             torch.from_numpy(normalized_coords).float(),
@@ -195,7 +202,7 @@ def collate_fn(
         conversation_list.append(conversations)
         questions_list.append(questions)
         response_list.append(response)
-        cnt += len(conversations)
+        cnt += 1
         offset_list.append(cnt)
         segment_label_list.append(segment_label)
         logist_label_list.append(logist_label)
@@ -222,6 +229,33 @@ def collate_fn(
             "json_path": json_path
         }
 
+    if all(isinstance(c, tuple) for c in conversation_list):
+        # (input_ids, instruction_len) from PromptTemplate: labels are everything after the instruction.
+        input_ids = [torch.tensor(ids, dtype=torch.long) for ids, _ in conversation_list]
+        targets = [ids.clone() for ids in input_ids]
+        for target, (_, instruction_len) in zip(targets, conversation_list):
+            target[:instruction_len] = IGNORE_INDEX
+        input_ids = torch.nn.utils.rnn.pad_sequence(
+            input_ids, batch_first=True, padding_value=tokenizer.pad_token_id
+        )
+        targets = torch.nn.utils.rnn.pad_sequence(targets, batch_first=True, padding_value=IGNORE_INDEX)
+        attention_masks = input_ids.ne(tokenizer.pad_token_id)
+        truncate_len = tokenizer.model_max_length - 1135
+        if input_ids.shape[1] > truncate_len:
+            input_ids = input_ids[:, :truncate_len]
+            targets = targets[:, :truncate_len]
+            attention_masks = attention_masks[:, :truncate_len]
+        return {
+                "points":torch.stack(point_list, dim=0),
+                "rgb":torch.stack(rgb_list, dim=0),
+                "input_ids": input_ids,
+                "labels": targets,
+                "attention_masks": attention_masks,
+                "segment_label":segment_label_list,
+                "logist_label":logist_label_list,
+                "json_path":json_path
+            }
+
     if use_mm_start_end:
         # replace <image> token
         for i in range(len(conversation_list)):